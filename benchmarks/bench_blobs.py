@@ -0,0 +1,53 @@
+"""Receiving a blob in 4 KiB frames: accumulating it in memory vs. streaming it to disk."""
+
+import os
+import tempfile
+from hashlib import sha256
+from time import perf_counter
+
+from ssb.blobs import BlobStore, blob_id
+
+FRAME_SIZE = 4096
+
+
+def concatenate(frames):
+    data = b''
+    for frame in frames:
+        data += frame
+    return blob_id(sha256(data).digest())
+
+
+def stream(store, frames, id_):
+    with store.writer(id_) as writer:
+        for frame in frames:
+            writer.write(frame)
+        return writer.finish()
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = BlobStore(tmpdir, max_size=64 * 1024 * 1024)
+        for size_mb in (1, 2, 4, 8):
+            data = os.urandom(size_mb * 1024 * 1024)
+            frames = [data[n:n + FRAME_SIZE] for n in range(0, len(data), FRAME_SIZE)]
+            id_ = blob_id(sha256(data).digest())
+
+            start = perf_counter()
+            concatenate(frames)
+            concat_time = perf_counter() - start
+
+            start = perf_counter()
+            stream(store, frames, id_)
+            stream_time = perf_counter() - start
+
+            start = perf_counter()
+            for chunk in store.read(id_):
+                pass
+            read_time = perf_counter() - start
+
+            print('{:>3} MiB: concatenate {:>8.1f} ms, stream to disk {:>6.1f} ms, read back {:>6.1f} ms'.format(
+                size_mb, concat_time * 1000, stream_time * 1000, read_time * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+"""Throughput of every available JSON backend, for wire and canonical (feed) encoding."""
+
+from timeit import timeit
+
+from ssb import codec
+
+N = 20000
+
+DATA = (b'{"previous":"%KTGP6W8vF80McRAZHYDWuKOD0KlNyKSq6Gb42iuV7Iw=.sha256","author":"@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH'
+        b'4F2BSxwhYmx8=.ed25519","sequence":116,"timestamp":1496696699331,"hash":"sha256","content":{"type":"post",'
+        b'"channel":"crypto","text":"Does anybody know any good resources (e.g. books) to learn cryptography?",'
+        b'"mentions":[]},"signature":"hqKePbbTXWxEi1njDnOWFsL0M0AoNoWyBFgNE6KXj//DThepaZSy9vRbygDHX5uNmCdyOrsQrwZsZhm'
+        b'UYKwtDQ==.sig.ed25519"}')
+
+
+def main():
+    print('{:>12}  {:>12}  {:>12}  {:>16}'.format('backend', 'loads/s', 'dumps/s', 'canonical/s'))
+    for name in codec.available_codecs():
+        codec.set_codec(name)
+        obj = codec.loads(DATA)
+        rates = [N / timeit(lambda: f(arg), number=N)
+                 for f, arg in ((codec.loads, DATA), (codec.dumps, obj), (codec.dumps_canonical, obj))]
+        print('{:>12}  {:>12.0f}  {:>12.0f}  {:>16.0f}'.format(name, *rates))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""1000 concurrent sync calls over a single connection, answered by an in-memory peer."""
+
+from asyncio import Queue, gather, get_event_loop
+from time import perf_counter
+
+from ssb.muxrpc import MuxRPCAPI
+from ssb.packet_stream import PacketStream
+
+N_CALLS = 1000
+
+
+class PipeConnection(object):
+    """One end of an in-memory duplex connection."""
+
+    def __init__(self):
+        self.is_connected = True
+        self.queue = Queue()
+        self.peer = None
+
+    @classmethod
+    def pair(cls):
+        a, b = cls(), cls()
+        a.peer, b.peer = b, a
+        return a, b
+
+    async def read(self):
+        return await self.queue.get()
+
+    def write(self, data):
+        self.peer.queue.put_nowait(data)
+
+    def disconnect(self):
+        self.is_connected = False
+        self.queue.put_nowait(None)
+        self.peer.queue.put_nowait(None)
+
+
+async def serve(ps):
+    async for msg in ps:
+        ps.send({'id': '@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519'}, req=-msg.req)
+
+
+async def measure():
+    client_conn, server_conn = PipeConnection.pair()
+    client, server = PacketStream(client_conn), PacketStream(server_conn)
+    server_task = get_event_loop().create_task(serve(server))
+
+    api = MuxRPCAPI()
+    api.add_connection(client)
+    client.start()
+
+    start = perf_counter()
+    replies = await gather(*[api.call('whoami', []) for n in range(N_CALLS)])
+    elapsed = perf_counter() - start
+    assert len(replies) == N_CALLS
+
+    client.disconnect()
+    await server_task
+    return elapsed
+
+
+def main():
+    elapsed = get_event_loop().run_until_complete(measure())
+    print('{} concurrent calls: {:.1f} ms, {:.0f} calls/s'.format(N_CALLS, elapsed * 1000, N_CALLS / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+"""Build and hash a long chain of messages.
+
+Every message needs its predecessor's key; with cached keys, the time per block of messages stays constant as the
+feed grows.
+"""
+
+import sys
+from time import perf_counter
+
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed
+
+BLOCK = 10000
+
+
+def main(n_messages=100000):
+    feed = LocalFeed(SigningKey.generate())
+    start = block_start = perf_counter()
+    print('{:>10}  {:>12}'.format('messages', 'msg/s'))
+    for n in range(1, n_messages + 1):
+        feed.publish({'type': 'post', 'text': 'Message #{}'.format(n)})
+        if n % BLOCK == 0:
+            now = perf_counter()
+            print('{:>10}  {:>12.0f}'.format(n, BLOCK / (now - block_start)))
+            block_start = now
+    print('total: {:.1f}s'.format(perf_counter() - start))
+
+
+if __name__ == '__main__':
+    main(*(int(arg) for arg in sys.argv[1:]))
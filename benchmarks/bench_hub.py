@@ -0,0 +1,87 @@
+"""Publishing to 1000 live createHistoryStream subscribers: encoding once through the hub vs. once per subscriber."""
+
+import os
+import tempfile
+from asyncio import ensure_future, get_event_loop, sleep, wait
+from time import perf_counter, process_time
+
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed
+from ssb.feed.store import LogStore
+from ssb.muxrpc import MuxRPCAPI, MuxRPCRequest
+from ssb.packet_stream import PacketStream
+
+N_SUBSCRIBERS = 1000
+N_MESSAGES = 200
+
+
+class NullConnection(object):
+    is_connected = True
+
+    def __init__(self):
+        self.n_bytes = 0
+
+    def write(self, data):
+        self.n_bytes += len(data)
+
+    def disconnect(self):
+        pass
+
+
+async def measure_hub(store, feed):
+    api = MuxRPCAPI(store=store)
+    connections = [PacketStream(NullConnection()) for n in range(N_SUBSCRIBERS)]
+    tasks = [ensure_future(api.create_history_stream(connection, MuxRPCRequest(
+        'createHistoryStream', [{'id': feed.id, 'seq': feed.sequence + 1, 'live': True, 'keys': False}], req=1,
+        type_='source'))) for connection in connections]
+    await sleep(0)
+
+    latencies = []
+    start_cpu = process_time()
+    for n in range(N_MESSAGES):
+        start = perf_counter()
+        feed.publish({'type': 'post', 'text': 'Message #{}'.format(n)})
+        # let every subscriber send it
+        await sleep(0)
+        latencies.append(perf_counter() - start)
+    cpu = process_time() - start_cpu
+
+    for connection in connections:
+        connection._closed.set()
+    await wait(tasks)
+    assert all(connection.connection.n_bytes for connection in connections)
+    return latencies, cpu
+
+
+async def measure_per_subscriber(store, feed):
+    connections = [PacketStream(NullConnection()) for n in range(N_SUBSCRIBERS)]
+
+    latencies = []
+    start_cpu = process_time()
+    for n in range(N_MESSAGES):
+        start = perf_counter()
+        msg = feed.publish({'type': 'post', 'text': 'Message #{}'.format(n)})
+        for connection in connections:
+            connection.send(msg.to_dict(), stream=True, req=-1)
+        latencies.append(perf_counter() - start)
+    cpu = process_time() - start_cpu
+    return latencies, cpu
+
+
+def main():
+    loop = get_event_loop()
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = LogStore(os.path.join(tmpdir, 'log'))
+        for name, measure in (('encode per subscriber', measure_per_subscriber), ('hub', measure_hub)):
+            feed = LocalFeed(SigningKey.generate(), store=store)
+            latencies, cpu = loop.run_until_complete(measure(store, feed))
+            latencies.sort()
+            print('{:>22}: median {:>6.2f} ms, p99 {:>6.2f} ms per message, {:>5.2f} ms CPU per message'.format(
+                name, latencies[len(latencies) // 2] * 1000, latencies[int(len(latencies) * 0.99)] * 1000,
+                cpu / N_MESSAGES * 1000))
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Ingest a history stream: message by message vs. through the ``ingest`` pipeline, with and without a store."""
+
+import os
+from asyncio import get_event_loop
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+from async_generator import async_generator, yield_
+from nacl.signing import SigningKey
+
+from ssb import codec
+from ssb.feed import Feed, LocalFeed, Message, ingest
+from ssb.feed.store import LogStore
+from ssb.packet_stream import PSMessage, PSMessageType
+
+N = 20000
+
+
+@async_generator
+async def history_stream(data):
+    for body in data:
+        await yield_(PSMessage.from_data(PSMessageType.JSON, body, stream=True, end_err=False, req=-1))
+
+
+async def sequential(feed, data):
+    async for ps_msg in history_stream(data):
+        feed.append(Message.parse(ps_msg.body, feed))
+
+
+async def pipelined(feed, data, executor):
+    async for msg in ingest(history_stream(data), feed, executor=executor, batch_size=128):
+        pass
+
+
+def main():
+    local_feed = LocalFeed(SigningKey.generate())
+    data = [codec.dumps(local_feed.publish({'type': 'post', 'text': 'Message #{}'.format(n)}).to_dict())
+            for n in range(N)]
+
+    loop = get_event_loop()
+    executor = ThreadPoolExecutor(os.cpu_count())
+    for with_store in (False, True):
+        for name, coro_factory in (('sequential', lambda feed: sequential(feed, data)),
+                                   ('pipelined', lambda feed: pipelined(feed, data, executor))):
+            with TemporaryDirectory() as path:
+                store = LogStore(os.path.join(path, 'log.offset')) if with_store else None
+                feed = Feed(local_feed.public_key, store=store)
+                start = perf_counter()
+                loop.run_until_complete(coro_factory(feed))
+                elapsed = perf_counter() - start
+                assert feed.sequence == N
+                if store is not None:
+                    store.close()
+            print('{:>20}: {:>8.0f} msg/s'.format(name + (' (store)' if with_store else ''), N / elapsed))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""Memory per object and construction rate of the types that exist in large numbers."""
+
+import tracemalloc
+from time import perf_counter
+
+from nacl.signing import SigningKey
+
+from ssb.feed import Feed, Message
+from ssb.muxrpc import MuxRPCMessage, MuxRPCRequest
+from ssb.packet_stream import PSMessage, PSMessageType
+
+N = 100000
+
+FEED = Feed(SigningKey.generate().verify_key)
+CONTENT = {'type': 'post', 'text': 'hello'}
+SIGNATURE = 'x' * 88 + '.sig.ed25519'
+
+FACTORIES = (
+    ('Message', lambda n: Message(FEED, CONTENT, SIGNATURE, sequence=n, timestamp=n, previous='%prev.sha256')),
+    ('PSMessage', lambda n: PSMessage(PSMessageType.JSON, CONTENT, stream=True, end_err=False, req=n)),
+    ('MuxRPCRequest', lambda n: MuxRPCRequest('createHistoryStream', [], req=n)),
+    ('MuxRPCMessage', lambda n: MuxRPCMessage(CONTENT)),
+)
+
+
+def main():
+    print('{:>14}  {:>12}  {:>12}'.format('type', 'bytes/obj', 'objs/s'))
+    for name, factory in FACTORIES:
+        tracemalloc.start()
+        objects = [factory(n) for n in range(N)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del objects
+
+        start = perf_counter()
+        for n in range(N):
+            factory(n)
+        rate = N / (perf_counter() - start)
+        print('{:>14}  {:>12.0f}  {:>12.0f}'.format(name, size / N, rate))
+
+
+if __name__ == '__main__':
+    main()
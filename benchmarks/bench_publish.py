@@ -0,0 +1,33 @@
+"""Publishing to a feed backed by the log store: one message at a time vs. runs of messages."""
+
+import os
+import tempfile
+from time import perf_counter
+
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed
+from ssb.feed.store import LogStore
+
+N_MESSAGES = 20000
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        contents = [{'type': 'post', 'text': 'Message #{}'.format(n)} for n in range(N_MESSAGES)]
+        for name, batch_size in (('publish', 1), ('publish_many(10)', 10), ('publish_many(100)', 100)):
+            store = LogStore(os.path.join(tmpdir, name))
+            feed = LocalFeed(SigningKey.generate(), store=store)
+            start = perf_counter()
+            if batch_size == 1:
+                for content in contents:
+                    feed.publish(content)
+            else:
+                for n in range(0, N_MESSAGES, batch_size):
+                    feed.publish_many(contents[n:n + batch_size])
+            print('{:>18}: {:>8.0f} msg/s'.format(name, N_MESSAGES / (perf_counter() - start)))
+            store.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""Measure how long ``PacketStream`` takes to assemble bodies of growing size.
+
+Throughput should stay roughly constant from 4 KiB up to 64 MiB, i.e. the time per body grows linearly with its size.
+"""
+
+import struct
+from asyncio import get_event_loop
+from time import perf_counter
+
+from ssb.packet_stream import PacketStream
+
+CHUNK_SIZE = 4096
+
+
+class ChunkConnection(object):
+    """Replays a body in 4 KiB chunks, like a box stream would."""
+
+    is_connected = True
+
+    def __init__(self, header, body):
+        self.chunks = [header] + [body[i:i + CHUNK_SIZE] for i in range(0, len(body), CHUNK_SIZE)]
+        self.chunks.reverse()
+
+    async def read(self):
+        return self.chunks.pop() if self.chunks else None
+
+    def disconnect(self):
+        pass
+
+
+async def measure(size):
+    body = b'\x00' * size
+    header = struct.pack('>BIi', 0x08, size, 1)
+    ps = PacketStream(ChunkConnection(header, body))
+    start = perf_counter()
+    msg = await ps.read()
+    elapsed = perf_counter() - start
+    assert len(msg.body) == size
+    return elapsed
+
+
+def main():
+    loop = get_event_loop()
+    print('{:>10}  {:>10}  {:>10}'.format('size', 'time (ms)', 'MiB/s'))
+    size = 4 * 1024
+    while size <= 64 * 1024 * 1024:
+        elapsed = loop.run_until_complete(measure(size))
+        print('{:>10}  {:>10.2f}  {:>10.1f}'.format(size, elapsed * 1000, size / elapsed / 1024 / 1024))
+        size *= 4
+
+
+if __name__ == '__main__':
+    main()
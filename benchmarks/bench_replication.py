@@ -0,0 +1,91 @@
+"""Replicating many feeds from a few peers over links with some latency, with more or fewer concurrent streams."""
+
+import os
+import tempfile
+from asyncio import Queue, ensure_future, gather, get_event_loop
+from time import perf_counter
+
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed, Replicator
+from ssb.feed.store import LogStore
+from ssb.muxrpc import MuxRPCAPI
+from ssb.packet_stream import PacketStream
+
+N_FEEDS = 200
+N_MESSAGES = 20
+N_PEERS = 4
+LATENCY = 0.01
+
+
+class DelayedPipeConnection(object):
+    """One end of an in-memory duplex connection, where data takes ``LATENCY`` seconds to get across."""
+
+    def __init__(self):
+        self.is_connected = True
+        self.queue = Queue()
+        self.peer = None
+
+    @classmethod
+    def pair(cls):
+        a, b = cls(), cls()
+        a.peer, b.peer = b, a
+        return a, b
+
+    async def read(self):
+        return await self.queue.get()
+
+    def write(self, data):
+        get_event_loop().call_later(LATENCY, self.peer.queue.put_nowait, bytes(data))
+
+    def disconnect(self):
+        self.is_connected = False
+        self.queue.put_nowait(None)
+        self.peer.queue.put_nowait(None)
+
+
+async def measure(source_store, path, max_streams):
+    store = LogStore(path)
+    feed_ids = [msg.feed.id for msg in (source_store.read(offset) for offset in source_store._by_key.values())
+                if msg.sequence == 1]
+    replicator = Replicator(MuxRPCAPI(), store, follows=feed_ids, max_streams=max_streams)
+    server_api = MuxRPCAPI(store=source_store)
+
+    connections, tasks = [], []
+    for n in range(N_PEERS):
+        a, b = DelayedPipeConnection.pair()
+        client, server = PacketStream(a), PacketStream(b)
+        connections.append(client)
+        tasks += (ensure_future(replicator.api.serve(client)), ensure_future(server_api.serve(server)))
+        replicator.add_peer(client)
+
+    start = perf_counter()
+    await replicator.sync()
+    elapsed = perf_counter() - start
+    assert replicator.n_messages == N_FEEDS * N_MESSAGES
+
+    for connection in connections:
+        connection.disconnect()
+    await gather(*tasks)
+    store.close()
+    return elapsed
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        source_store = LogStore(os.path.join(tmpdir, 'source'))
+        for n in range(N_FEEDS):
+            feed = LocalFeed(SigningKey.generate(), store=source_store)
+            for i in range(N_MESSAGES):
+                feed.publish({'type': 'post', 'text': 'Message #{}'.format(i)})
+
+        loop = get_event_loop()
+        for max_streams in (1, 4, 16, 64):
+            elapsed = loop.run_until_complete(measure(source_store, os.path.join(tmpdir, str(max_streams)),
+                                                      max_streams))
+            print('{} feeds x {} messages, {} peers, {:>2} streams: {:>7.0f} ms'.format(
+                N_FEEDS, N_MESSAGES, N_PEERS, max_streams, elapsed * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Append rate and point lookup latency of the on-disk log store."""
+
+import os
+import random
+import tempfile
+from time import perf_counter
+
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed
+from ssb.feed.store import LogStore
+
+N_FEEDS = 10
+N_MESSAGES = 5000
+N_LOOKUPS = 20000
+
+
+def main():
+    feeds = [LocalFeed(SigningKey.generate()) for n in range(N_FEEDS)]
+    messages = [feed.publish({'type': 'post', 'text': 'Message #{}'.format(n)})
+                for n in range(N_MESSAGES) for feed in feeds]
+    # cache the serialized form, so that only the store is measured
+    for msg in messages:
+        msg.serialize()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for name, batch_size in (('append', 1), ('append_many(100)', 100)):
+            store = LogStore(os.path.join(tmpdir, name))
+            start = perf_counter()
+            for n in range(0, len(messages), batch_size):
+                store.append_many(messages[n:n + batch_size])
+            print('{:>18}: {:>8.0f} msg/s'.format(name, len(messages) / (perf_counter() - start)))
+
+        start = perf_counter()
+        store.close()
+        store = LogStore(os.path.join(tmpdir, name))
+        print('{:>18}: {:>8.1f} ms for {} messages'.format('reopen', (perf_counter() - start) * 1000, len(store)))
+
+        keys = [msg.key for msg in random.sample(messages, N_LOOKUPS)]
+        start = perf_counter()
+        for key in keys:
+            store.get(key)
+        print('{:>18}: {:>8.1f} us'.format('lookup by key', (perf_counter() - start) / N_LOOKUPS * 1e6))
+
+        lookups = [(random.choice(feeds).id, random.randint(1, N_MESSAGES)) for n in range(N_LOOKUPS)]
+        start = perf_counter()
+        for feed_id, sequence in lookups:
+            store.get_by_sequence(feed_id, sequence)
+        print('{:>18}: {:>8.1f} us'.format('lookup by sequence', (perf_counter() - start) / N_LOOKUPS * 1e6))
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
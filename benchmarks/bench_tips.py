@@ -0,0 +1,69 @@
+"""Vector clock of a log with many feeds: rebuilt from the log vs. read from the tip index."""
+
+import os
+import random
+import tempfile
+from time import perf_counter
+
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed
+from ssb.feed.store import LogStore
+from ssb.feed.tips import TipIndex
+
+N_FEEDS = 2000
+N_MESSAGES = 10
+N_CHANGED = 20
+
+
+def main():
+    with tempfile.TemporaryDirectory() as tmpdir:
+        log_path, index_path = os.path.join(tmpdir, 'log'), os.path.join(tmpdir, 'tips')
+        store = LogStore(log_path)
+        index = TipIndex(index_path, store=store)
+        feeds = [LocalFeed(SigningKey.generate(), store=store) for n in range(N_FEEDS)]
+        for n in range(N_MESSAGES):
+            for feed in feeds:
+                feed.publish({'type': 'post', 'text': 'Message #{}'.format(n)})
+        index.close()
+        store.close()
+
+        start = perf_counter()
+        store = LogStore(log_path)
+        clock = {}
+        for msg in store.scan():
+            clock[msg.feed.id] = msg.sequence
+        print('{:>28}: {:>8.1f} ms'.format('clock by scanning the log', (perf_counter() - start) * 1000))
+        store.close()
+
+        start = perf_counter()
+        index = TipIndex(index_path)
+        assert index.clock() == clock
+        print('{:>28}: {:>8.1f} ms'.format('clock from the index', (perf_counter() - start) * 1000))
+        index.close()
+
+        store = LogStore(log_path)
+        index = TipIndex(index_path, store=store)
+        version = index.version
+        changed = random.sample(feeds, N_CHANGED)
+        for feed in changed:
+            feed._init_store(store)
+            feed.publish({'type': 'post', 'text': 'New'})
+        start = perf_counter()
+        version, changes = index.changes(version)
+        print('{:>28}: {:>8.1f} us for {} changed feeds out of {}'.format(
+            'changes since last exchange', (perf_counter() - start) * 1e6, len(changes), N_FEEDS))
+
+        peer_clock = dict(clock)
+        for feed in random.sample(feeds, N_CHANGED):
+            peer_clock[feed.id] += 1
+        start = perf_counter()
+        need, have = index.diff(peer_clock)
+        print('{:>28}: {:>8.1f} ms for a clock of {} feeds'.format('diff with a peer', (perf_counter() - start) * 1000,
+                                                                   len(peer_clock)))
+        index.close()
+        store.close()
+
+
+if __name__ == '__main__':
+    main()
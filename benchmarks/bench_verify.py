@@ -0,0 +1,44 @@
+"""Signature verifications per second, in process and spread over thread and process pools."""
+
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from time import perf_counter
+
+from nacl.signing import SigningKey
+
+from ssb.feed import Feed, LocalFeed, Message, verify_messages
+
+N = 20000
+
+
+def build_messages():
+    local_feed = LocalFeed(SigningKey.generate())
+    remote_feed = Feed(local_feed.public_key)
+    messages = []
+    for n in range(N):
+        msg = local_feed.publish({'type': 'post', 'text': 'Message #{}'.format(n)})
+        messages.append(Message(remote_feed, msg.content, msg.signature, sequence=msg.sequence,
+                                previous=msg.previous, timestamp=msg.timestamp))
+    return messages
+
+
+def measure(messages, executor=None):
+    start = perf_counter()
+    assert all(verify_messages(messages, executor=executor, chunk_size=256))
+    return N / (perf_counter() - start)
+
+
+def main():
+    messages = build_messages()
+    n_cores = os.cpu_count()
+    print('{:>20}  {:>10}  {:>14}'.format('mode', 'verif/s', 'verif/s/core'))
+    rate = measure(messages)
+    print('{:>20}  {:>10.0f}  {:>14.0f}'.format('single', rate, rate))
+    for name, executor_cls in (('threads', ThreadPoolExecutor), ('processes', ProcessPoolExecutor)):
+        with executor_cls(n_cores) as executor:
+            rate = measure(messages, executor)
+        print('{:>20}  {:>10.0f}  {:>14.0f}'.format('{} ({})'.format(name, n_cores), rate, rate / n_cores))
+
+
+if __name__ == '__main__':
+    main()
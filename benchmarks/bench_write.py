@@ -0,0 +1,59 @@
+"""Compare outgoing messages/sec with and without write batching.
+
+Frames go through a real secret-handshake ``BoxStream``, so the cost of boxing each write is accounted for.
+"""
+
+from asyncio import get_event_loop
+from time import perf_counter
+
+from nacl.utils import random
+from secret_handshake.boxstream import BoxStream
+
+from ssb.packet_stream import PacketStream
+
+N_MESSAGES = 100000
+
+
+class NullWriter(object):
+    def __init__(self):
+        self.n_writes = 0
+
+    def write(self, data):
+        self.n_writes += 1
+
+
+class BoxConnection(object):
+    is_connected = True
+
+    def __init__(self):
+        self.writer = NullWriter()
+        self.box_stream = BoxStream(self.writer, random(32), random(24))
+
+    def write(self, data):
+        self.box_stream.write(data)
+
+    def disconnect(self):
+        pass
+
+
+async def measure(**kwargs):
+    connection = BoxConnection()
+    ps = PacketStream(connection, **kwargs)
+    msg = {'type': 'post', 'text': 'hello world'}
+    start = perf_counter()
+    for n in range(N_MESSAGES):
+        ps.send(msg, stream=True, req=-1)
+    ps.flush()
+    elapsed = perf_counter() - start
+    return N_MESSAGES / elapsed, connection.writer.n_writes
+
+
+def main():
+    loop = get_event_loop()
+    for name, kwargs in (('unbatched', {}), ('batched', {'batch': True})):
+        rate, n_writes = loop.run_until_complete(measure(**kwargs))
+        print('{:>10}: {:>10.0f} msg/s, {:>7} socket writes'.format(name, rate, n_writes))
+
+
+if __name__ == '__main__':
+    main()
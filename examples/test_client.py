@@ -1,72 +1,59 @@
 import logging
 import struct
 import time
-from asyncio import get_event_loop, gather, ensure_future
+from asyncio import get_event_loop, gather
 
 from colorlog import ColoredFormatter
 
-from secret_handshake.network import SHSClient
+from ssb.blobs import BlobStore, WantManager
 from ssb.muxrpc import MuxRPCAPI, MuxRPCAPIException
-from ssb.packet_stream import PacketStream, PSMessageType
+from ssb.packet_stream import PSMessageType
+from ssb.peers import PeerPool
 from ssb.util import load_ssb_secret
 
-import hashlib
-import base64
 
+blob_store = BlobStore('./blobs')
+api = MuxRPCAPI(blob_store=blob_store)
+# serves blobs.createWants
+wants = WantManager(api, blob_store)
 
-api = MuxRPCAPI()
 
-
-@api.define('createHistoryStream')
-def create_history_stream(connection, msg):
-    print('create_history_stream', msg)
-    # msg = PSMessage(PSMessageType.JSON, True, stream=True, end_err=True, req=-req)
-    # connection.write(msg)
-
-
-@api.define('blobs.createWants')
-def create_wants(connection, msg):
-    print('create_wants', msg)
-
-
-async def test_client():
+async def test_client(pool, key):
+    # every call goes over the same connection, opened (or reopened) by the pool as needed
+    connection = await pool.get(key)
     async for msg in api.call('createHistoryStream', [{
         'id': "@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519",
         'seq': 1,
         'live': False,
         'keys': False
-    }], 'source'):
+    }], 'source', connection=connection):
         print('> RESPONSE:', msg)
 
     try:
-        print('> RESPONSE:', await api.call('whoami', [], 'sync'))
+        print('> RESPONSE:', await api.call('whoami', [], 'sync', connection=await pool.get(key)))
     except MuxRPCAPIException as e:
         print(e)
 
-    handler = api.call('gossip.ping', [], 'duplex')
+    handler = api.call('gossip.ping', [], 'duplex', connection=await pool.get(key))
     handler.send(struct.pack('l', int(time.time() * 1000)), msg_type=PSMessageType.BUFFER)
     async for msg in handler:
         print('> RESPONSE:', msg)
         handler.send(True, end=True)
         break
 
-    img_data = b''
-    async for msg in api.call('blobs.get', ['&kqZ52sDcJSHOx7m4Ww80kK1KIZ65gpGnqwZlfaIVWWM=.sha256'], 'source'):
-        if msg.type.name == 'BUFFER':
-            img_data += msg.data
-        if msg.type.name == 'JSON' and msg.data == b'true':
-            assert (base64.b64encode(hashlib.sha256(img_data).digest()) ==
-                    b'kqZ52sDcJSHOx7m4Ww80kK1KIZ65gpGnqwZlfaIVWWM=')
-            with open('./ub1k.jpg', 'wb') as f:
-                f.write(img_data)
+    # streamed to disk and hashed as it arrives
+    connection = await pool.get(key)
+    blob_id = await blob_store.fetch(api, '&kqZ52sDcJSHOx7m4Ww80kK1KIZ65gpGnqwZlfaIVWWM=.sha256', connection=connection)
+    print('> BLOB:', blob_id, blob_store.size(blob_id))
 
 
 async def main():
-    client = SHSClient('127.0.0.1', 8008, keypair, bytes(keypair.verify_key))
-    packet_stream = PacketStream(client)
-    await client.open()
-    api.add_connection(packet_stream)
-    await gather(ensure_future(api), test_client())
+    pool = PeerPool(api, keypair)
+    key = bytes(keypair.verify_key)
+    pool.add('127.0.0.1', 8008, key, keep=True)
+    connection = await pool.get(key)
+    await gather(wants.track(connection), test_client(pool, key))
+    pool.close()
 
 
 if __name__ == '__main__':
@@ -4,24 +4,31 @@ from asyncio import gather, get_event_loop, ensure_future
 from colorlog import ColoredFormatter
 
 from secret_handshake import SHSServer
+from ssb.feed.store import LogStore
 from ssb.packet_stream import PacketStream
 from ssb.muxrpc import MuxRPCAPI
 from ssb.util import load_ssb_secret
 
-api = MuxRPCAPI()
+# createHistoryStream is served out of the log
+api = MuxRPCAPI(store=LogStore('./log.offset'))
+
+
+@api.define('whoami')
+def whoami(connection, request):
+    connection.send({'id': server_id}, req=-request.req)
 
 
 async def on_connect(conn):
     packet_stream = PacketStream(conn)
-    api.add_connection(packet_stream)
 
     print('connect', conn)
-    async for msg in packet_stream:
-        print(msg)
+    # every peer gets its own dispatch loop
+    await api.serve(packet_stream)
+    print('disconnect', conn)
 
 
 async def main():
-    server = SHSServer('127.0.0.1', 8008, load_ssb_secret()['keypair'])
+    server = SHSServer('127.0.0.1', 8008, secret['keypair'])
     server.on_connect(on_connect)
     await server.listen()
 
@@ -43,6 +50,9 @@ if __name__ == '__main__':
     logger.setLevel(logging.DEBUG)
     logger.addHandler(ch)
 
+    secret = load_ssb_secret()
+    server_id = secret['id']
+
     loop = get_event_loop()
     loop.run_until_complete(main())
     loop.run_forever()
@@ -42,6 +42,9 @@ extras_require = {
     'docs': [
         'Sphinx>=2.1.1',
     ],
+    'orjson': [
+        'orjson>=3.0',
+    ],
     'tests': tests_require,
 }
 extras_require['all'] = sum((lst for lst in extras_require.values()), [])
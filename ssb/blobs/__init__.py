@@ -0,0 +1,5 @@
+from .store import (BlobStore, BlobWriter, BlobException, BlobTooLargeException, InvalidBlobException, blob_id)
+from .wants import WantManager
+
+__all__ = ('BlobStore', 'BlobWriter', 'BlobException', 'BlobTooLargeException', 'InvalidBlobException', 'blob_id',
+           'WantManager')
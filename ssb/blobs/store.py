@@ -0,0 +1,168 @@
+import logging
+import os
+from base64 import b64decode, b64encode
+from binascii import Error as Base64Error
+from hashlib import sha256
+from tempfile import mkstemp
+
+
+logger = logging.getLogger('blobs')
+
+# same default as ssb-blobs
+DEFAULT_MAX_SIZE = 5 * 1024 * 1024
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class BlobException(Exception):
+    pass
+
+
+class BlobTooLargeException(BlobException):
+    pass
+
+
+class InvalidBlobException(BlobException):
+    pass
+
+
+def blob_id(digest):
+    """Return the ID of the blob with SHA-256 ``digest``."""
+    return '&' + b64encode(digest).decode('ascii') + '.sha256'
+
+
+def _blob_digest(id_):
+    try:
+        digest = b64decode(id_[1:-len('.sha256')], validate=True)
+    except Base64Error:
+        digest = None
+    if not id_.startswith('&') or not id_.endswith('.sha256') or digest is None or len(digest) != 32:
+        raise InvalidBlobException('Not a blob ID: {}'.format(id_))
+    return digest
+
+
+class BlobWriter(object):
+    """Writes a blob to a temporary file as its data comes in, hashing it along the way.
+
+    Writing more than ``max_size`` bytes raises :class:`BlobTooLargeException` right away. :meth:`finish` moves the
+    file into the store, once its hash is known to match ``expected_id`` (if given).
+    """
+
+    def __init__(self, store, expected_id=None, max_size=None):
+        self.store = store
+        self.expected_id = expected_id
+        self.max_size = store.max_size if max_size is None else max_size
+        self.size = 0
+        self._hash = sha256()
+        fd, self._tmp_path = mkstemp(dir=store.path, prefix='.incoming-')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.abort()
+            raise BlobTooLargeException('Blob is larger than {} bytes'.format(self.max_size))
+        self._hash.update(data)
+        self._file.write(data)
+
+    def abort(self):
+        if not self._file.closed:
+            self._file.close()
+            os.unlink(self._tmp_path)
+
+    def finish(self):
+        """Store the blob, returning its ID."""
+        self._file.close()
+        id_ = blob_id(self._hash.digest())
+        if self.expected_id is not None and id_ != self.expected_id:
+            os.unlink(self._tmp_path)
+            raise InvalidBlobException('Expected blob {}, got {}'.format(self.expected_id, id_))
+        path = self.store._path(id_)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self._tmp_path, path)
+        return id_
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+
+
+class BlobStore(object):
+    """Content-addressed blob storage, one file per blob (laid out like ``~/.ssb/blobs``).
+
+    Blobs are streamed in and out in chunks of ``chunk_size`` bytes, so they are never held in memory as a whole.
+    Blobs larger than ``max_size`` are refused.
+    """
+
+    def __init__(self, path, max_size=DEFAULT_MAX_SIZE, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        os.makedirs(path, exist_ok=True)
+
+    def _path(self, id_):
+        hex_digest = _blob_digest(id_).hex()
+        return os.path.join(self.path, 'sha256', hex_digest[:2], hex_digest[2:])
+
+    def has(self, id_):
+        return os.path.exists(self._path(id_))
+
+    def __contains__(self, id_):
+        return self.has(id_)
+
+    def size(self, id_):
+        """Return the size of a blob in bytes (``None`` if it isn't in the store)."""
+        try:
+            return os.stat(self._path(id_)).st_size
+        except FileNotFoundError:
+            return None
+
+    def read(self, id_):
+        """Iterate over the contents of a blob.
+
+        Each chunk is read straight into a fresh buffer and yielded as a :class:`memoryview` of it, so it can be kept
+        around (e.g. in a write buffer) without copying it.
+        """
+        with open(self._path(id_), 'rb', buffering=0) as f:
+            while True:
+                buf = bytearray(self.chunk_size)
+                n = f.readinto(buf)
+                if not n:
+                    return
+                yield memoryview(buf)[:n]
+
+    def writer(self, expected_id=None, max_size=None):
+        """Return a :class:`BlobWriter` for a new blob."""
+        return BlobWriter(self, expected_id=expected_id, max_size=max_size)
+
+    def add(self, data, expected_id=None):
+        """Store ``data`` (bytes, or an iterable of chunks), returning the blob's ID."""
+        with self.writer(expected_id) as writer:
+            for chunk in ([data] if isinstance(data, (bytes, bytearray, memoryview)) else data):
+                writer.write(chunk)
+            return writer.finish()
+
+    async def fetch(self, api, id_, size=None, connection=None):
+        """Download a blob with ``blobs.get``, writing it to disk as it arrives.
+
+        The download is aborted as soon as it goes over ``size`` (if known) or ``max_size``, and the blob is only
+        stored if its hash matches ``id_``. Returns the blob's ID.
+        """
+        if connection is None:
+            connection = api.connection
+        max_size = self.max_size if size is None else min(size, self.max_size)
+        args = {'key': id_, 'max': max_size}
+        if size is not None:
+            args['size'] = size
+
+        handler = api.call('blobs.get', [args], 'source', connection=connection)
+        with self.writer(id_, max_size) as writer:
+            try:
+                await handler.write_to(writer)
+            except BlobTooLargeException:
+                # let the peer know that we're not interested in the rest
+                connection.send(True, stream=True, end_err=True, req=handler.ps_handler.req)
+                raise
+            return writer.finish()
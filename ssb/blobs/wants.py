@@ -0,0 +1,145 @@
+import logging
+from asyncio import IncompleteReadError, Semaphore, ensure_future, get_event_loop, shield
+
+from ssb.muxrpc import MuxRPCAPIException
+from ssb.packet_stream import PSTimeoutException
+
+from .store import BlobException, InvalidBlobException, _blob_digest
+
+
+logger = logging.getLogger('blobs')
+
+
+class WantManager(object):
+    """Keeps track of the blobs wanted here and by peers (``blobs.createWants``), and downloads the wanted ones.
+
+    Each blob is wanted once, whatever the number of peers and callers: a download goes to one of the peers that
+    announced having the blob, then to the next one if that fails. At most ``max_downloads`` blobs are downloaded at
+    the same time. Wants from peers are answered out of ``blob_store``.
+
+    Serves ``blobs.createWants`` on ``api``. Call :meth:`track` for every connected peer.
+    """
+
+    def __init__(self, api, blob_store, max_downloads=4):
+        self.api = api
+        self.blob_store = blob_store
+        self.max_downloads = max_downloads
+        self.n_downloads = 0
+        # blob ID -> future, resolved once the blob is stored
+        self._wants = {}
+        # blob ID -> {connection: size} of the peers that have it
+        self._sources = {}
+        self._downloading = set()
+        self._slots = Semaphore(max_downloads)
+        # connection -> req of the peer's createWants call, where our wants (and haves) go
+        self._peers = {}
+        # connection -> blob IDs that the peer has asked for
+        self._peer_wants = {}
+        api.handlers['blobs.createWants'] = self.create_wants
+
+    async def want(self, id_):
+        """Wait until blob ``id_`` is in the store, downloading it from peers if needed."""
+        if self.blob_store.has(id_):
+            return id_
+        if id_ not in self._wants:
+            self._wants[id_] = get_event_loop().create_future()
+            self._broadcast({id_: -1})
+        # one caller giving up doesn't cancel the want for the others
+        return await shield(self._wants[id_])
+
+    @property
+    def wants(self):
+        return list(self._wants)
+
+    def _broadcast(self, body):
+        for connection, req in self._peers.items():
+            connection.send(body, stream=True, req=-req)
+
+    def _send_has(self, connection, ids):
+        if connection not in self._peers:
+            # the peer hasn't asked for our haves yet; see create_wants
+            return
+        haves = {}
+        for id_ in ids:
+            size = self.blob_store.size(id_)
+            if size is not None:
+                haves[id_] = size
+        if haves:
+            connection.send(haves, stream=True, req=-self._peers[connection])
+
+    async def create_wants(self, connection, request):
+        """Stream our wants (and what we have of the peer's wants) to the peer, for as long as it is connected."""
+        self._peers[connection] = request.req
+        # this lasts as long as the connection; don't hold up the peer's other requests
+        self.api.release_slots(request)
+        try:
+            if self._wants:
+                connection.send({id_: -1 for id_ in self._wants}, stream=True, req=-request.req)
+            self._send_has(connection, self._peer_wants.get(connection, ()))
+            await connection.wait_closed()
+        finally:
+            # unless the peer has called createWants again since
+            if self._peers.get(connection) == request.req:
+                del self._peers[connection]
+                self._peer_wants.pop(connection, None)
+
+    async def track(self, connection):
+        """Follow the wants and haves of the peer at the other end of ``connection``, until it goes away."""
+        try:
+            async for msg in self.api.call('blobs.createWants', [], 'source', connection=connection):
+                if msg.end_err:
+                    break
+                if isinstance(msg.body, dict):
+                    self._process(connection, msg.body)
+        finally:
+            for sources in self._sources.values():
+                sources.pop(connection, None)
+
+    def _process(self, connection, body):
+        peer_wants = []
+        for id_, value in body.items():
+            try:
+                _blob_digest(id_)
+            except InvalidBlobException:
+                logger.warning('Ignoring invalid blob ID from peer: %r', id_)
+                continue
+            if not isinstance(value, (int, float)) or isinstance(value, bool):
+                logger.warning('Ignoring invalid want/have of %s from peer: %r', id_, value)
+                continue
+            if value < 0:
+                peer_wants.append(id_)
+            elif id_ in self._wants:
+                self._sources.setdefault(id_, {})[connection] = value
+                if id_ not in self._downloading:
+                    self._downloading.add(id_)
+                    ensure_future(self._download(id_))
+        if peer_wants:
+            self._peer_wants.setdefault(connection, set()).update(peer_wants)
+            self._send_has(connection, peer_wants)
+
+    async def _download(self, id_):
+        try:
+            async with self._slots:
+                sources = self._sources[id_]
+                while sources:
+                    connection = next(iter(sources))
+                    size = sources.pop(connection)
+                    if not connection.is_connected:
+                        continue
+                    try:
+                        await self.blob_store.fetch(self.api, id_, size=size, connection=connection)
+                    except (BlobException, MuxRPCAPIException, PSTimeoutException, IncompleteReadError, OSError) as e:
+                        logger.warning('Could not download %s: %s', id_, e)
+                        continue
+                    self.n_downloads += 1
+                    future = self._wants.pop(id_)
+                    if not future.done():
+                        future.set_result(id_)
+                    del self._sources[id_]
+                    for peer, ids in self._peer_wants.items():
+                        if id_ in ids:
+                            self._send_has(peer, [id_])
+                    return
+                # no more sources for now; this starts over when a peer announces the blob
+        finally:
+            self._downloading.discard(id_)
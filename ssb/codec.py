@@ -0,0 +1,217 @@
+"""JSON codecs used for packet-stream bodies and feed messages.
+
+Several backends are supported; the fastest one that is installed gets picked at import time and can be overridden
+with :func:`set_codec`. Every backend must produce the same bytes:
+
+* :func:`dumps` - compact JSON (no whitespace, no ASCII escaping), used on the wire;
+* :func:`dumps_canonical` - the format used by ``ssb-keys`` (``JSON.stringify(msg, null, 2)``), which message hashes
+  and signatures are computed over.
+
+Backends don't agree with each other (or with JavaScript) on how to write floats. That doesn't matter on the wire,
+where only the values count, but canonical forms that contain floats are produced by a reference encoder, which writes
+numbers like ``JSON.stringify`` does. Decoded objects keep the order of their keys, as the canonical form depends on
+it.
+"""
+
+import json
+import sys
+from collections import OrderedDict
+
+
+class CodecException(Exception):
+    pass
+
+
+def _js_number(value):
+    """Format a float like JavaScript's ``Number.prototype.toString`` (which ``JSON.stringify`` uses)."""
+    if value != value or value in (float('inf'), float('-inf')):
+        return 'null'
+    if value == 0:
+        # -0 too
+        return '0'
+    sign = '-' if value < 0 else ''
+    # repr() gives the shortest digits that round-trip, as JavaScript does; only the layout differs
+    mantissa, _, exponent = repr(abs(value)).partition('e')
+    whole, _, fraction = mantissa.partition('.')
+    all_digits = whole + fraction
+    digits = all_digits.lstrip('0')
+    # the value is 0.<digits> * 10 ** n
+    n = len(whole) + int(exponent or 0) - (len(all_digits) - len(digits))
+    digits = digits.rstrip('0')
+    k = len(digits)
+
+    if k <= n <= 21:
+        text = digits + '0' * (n - k)
+    elif 0 < n <= 21:
+        text = digits[:n] + '.' + digits[n:]
+    elif -6 < n <= 0:
+        text = '0.' + '0' * -n + digits
+    else:
+        text = '{}{}e{}{}'.format(digits[0], '.' + digits[1:] if k > 1 else '', '+' if n > 0 else '-', abs(n - 1))
+    return sign + text
+
+
+def _has_floats(obj):
+    for value in (obj.values() if isinstance(obj, dict) else obj):
+        type_ = type(value)
+        if type_ is float:
+            return True
+        if (type_ is dict or type_ is list or isinstance(value, (dict, list, tuple))) and _has_floats(value):
+            return True
+    return False
+
+
+def _js_canonical(obj, depth=0):
+    """Reference canonical encoder, with the output of ``JSON.stringify(obj, null, 2)``."""
+    if isinstance(obj, float):
+        return _js_number(obj)
+    if isinstance(obj, dict):
+        if not obj:
+            return '{}'
+        items = [json.dumps(str(key), ensure_ascii=False) + ': ' + _js_canonical(value, depth + 1)
+                 for key, value in obj.items()]
+        brackets = '{}'
+    elif isinstance(obj, (list, tuple)):
+        if not obj:
+            return '[]'
+        items = [_js_canonical(value, depth + 1) for value in obj]
+        brackets = '[]'
+    else:
+        return json.dumps(obj, ensure_ascii=False)
+    inner = '\n' + '  ' * (depth + 1)
+    return brackets[0] + inner + (',' + inner).join(items) + '\n' + '  ' * depth + brackets[1]
+
+
+class JSONCodec(object):
+    name = 'json'
+
+    def loads(self, data):
+        return json.loads(bytes(data) if isinstance(data, memoryview) else data, object_pairs_hook=OrderedDict)
+
+    def dumps(self, obj):
+        return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def dumps_canonical(self, obj):
+        if isinstance(obj, float) or (isinstance(obj, (dict, list, tuple)) and _has_floats(obj)):
+            return _js_canonical(obj).encode('utf-8')
+        return self._dumps_canonical(obj)
+
+    def _dumps_canonical(self, obj):
+        return json.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+def _require_ordered_dicts(name):
+    if sys.version_info < (3, 6):
+        # its objects are plain dicts, which don't keep the order of their keys here
+        raise ImportError('{} needs Python 3.6+'.format(name))
+
+
+class SimpleJSONCodec(JSONCodec):
+    name = 'simplejson'
+
+    def __init__(self):
+        import simplejson
+        self._simplejson = simplejson
+
+    def loads(self, data):
+        return self._simplejson.loads(str(data, 'utf-8'), object_pairs_hook=OrderedDict)
+
+    def dumps(self, obj):
+        return self._simplejson.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+    def _dumps_canonical(self, obj):
+        return self._simplejson.dumps(obj, indent=2, ensure_ascii=False).encode('utf-8')
+
+
+class UJSONCodec(JSONCodec):
+    name = 'ujson'
+
+    def __init__(self):
+        _require_ordered_dicts(self.name)
+        import ujson
+        self._ujson = ujson
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+    def _dumps_canonical(self, obj):
+        return self._ujson.dumps(obj, indent=2, ensure_ascii=False, escape_forward_slashes=False).encode('utf-8')
+
+
+class ORJSONCodec(JSONCodec):
+    name = 'orjson'
+
+    def __init__(self):
+        _require_ordered_dicts(self.name)
+        import orjson
+        self._orjson = orjson
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+    def dumps(self, obj):
+        try:
+            return self._orjson.dumps(obj)
+        except TypeError:
+            # orjson can't handle e.g. integers beyond 64 bits
+            return super(ORJSONCodec, self).dumps(obj)
+
+    def _dumps_canonical(self, obj):
+        try:
+            return self._orjson.dumps(obj, option=self._orjson.OPT_INDENT_2)
+        except TypeError:
+            return super(ORJSONCodec, self)._dumps_canonical(obj)
+
+
+# fastest first
+BACKENDS = (ORJSONCodec, UJSONCodec, JSONCodec, SimpleJSONCodec)
+
+
+def available_codecs():
+    """Return the names of the backends that can be used here, fastest first."""
+    names = []
+    for cls in BACKENDS:
+        try:
+            cls()
+        except ImportError:
+            continue
+        names.append(cls.name)
+    return names
+
+
+def get_codec():
+    return _codec
+
+
+def set_codec(codec):
+    """Set the codec in use, either as a backend name or a :class:`JSONCodec` instance."""
+    global _codec
+    if isinstance(codec, str):
+        for cls in BACKENDS:
+            if cls.name == codec:
+                break
+        else:
+            raise CodecException('Unknown JSON codec: ' + codec)
+        try:
+            codec = cls()
+        except ImportError:
+            raise CodecException('JSON codec not available: ' + codec)
+    _codec = codec
+
+
+def loads(data):
+    return _codec.loads(data)
+
+
+def dumps(obj):
+    return _codec.dumps(obj)
+
+
+def dumps_canonical(obj):
+    return _codec.dumps_canonical(obj)
+
+
+set_codec(available_codecs()[0])
@@ -1,3 +1,7 @@
-from .models import Feed, LocalFeed, Message, LocalMessage, NoPrivateKeyException
+from .models import (Feed, LocalFeed, Message, LocalMessage, NoPrivateKeyException, NoStoreException,
+                     InvalidMessageException, InvalidSignatureException, verify_messages)
+from .ingest import ingest
+from .replication import Replicator
 
-__all__ = ('Feed', 'LocalFeed', 'Message', 'LocalMessage', 'NoPrivateKeyException')
+__all__ = ('Feed', 'LocalFeed', 'Message', 'LocalMessage', 'NoPrivateKeyException', 'NoStoreException',
+           'InvalidMessageException', 'InvalidSignatureException', 'verify_messages', 'ingest', 'Replicator')
@@ -0,0 +1,149 @@
+import logging
+from asyncio import Event
+from collections import deque
+
+from ssb import codec
+
+
+logger = logging.getLogger('hub')
+
+DROP = 'drop'
+BUFFER = 'buffer'
+
+
+class Subscription(object):
+    """A live stream of a feed's new messages to a peer, as reply ``req`` on ``connection``.
+
+    Messages are written to the connection right away, unless it is backed up (see :class:`LiveHub`); then they wait
+    in a queue for the stream's handler to send them (see :meth:`get`). ``limit`` is the number of messages still to
+    be sent, if any.
+
+    Once the subscription is over, ``dropped`` tells whether it was because the peer couldn't keep up.
+    """
+
+    def __init__(self, hub, feed_id, connection, req, keys=True, limit=None):
+        self.hub = hub
+        self.feed_id = feed_id
+        self.connection = connection
+        self.req = req
+        self.keys = keys
+        self.limit = limit
+        self.dropped = False
+        self.closed = False
+        self._queue = deque()
+        self._ready = Event()
+
+    @property
+    def queued(self):
+        return len(self._queue)
+
+    def push(self, data):
+        if self.closed:
+            return
+        hub = self.hub
+        if not self._queue and self.connection.write_buffer_size <= hub.max_buffered:
+            self.connection.send_encoded(data, -self.req, stream=True)
+        elif hub.slow_policy == DROP or (hub.max_queued and len(self._queue) >= hub.max_queued):
+            logger.info('Dropping slow subscriber to %s', self.feed_id)
+            self.dropped = True
+            hub.n_dropped += 1
+            self.close()
+            return
+        else:
+            self._queue.append(data)
+            self._ready.set()
+
+        if self.limit is not None:
+            self.limit -= 1
+            if not self.limit:
+                self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._ready.set()
+            self.hub.unsubscribe(self)
+
+    async def get(self):
+        """Wait for queued messages, and return them all. Returns an empty list once the subscription is over."""
+        while not self._queue or self.dropped:
+            if self.closed:
+                return []
+            self._ready.clear()
+            await self._ready.wait()
+        items = list(self._queue)
+        self._queue.clear()
+        return items
+
+
+class LiveHub(object):
+    """Fans new feed messages out to live subscribers (``createHistoryStream`` with ``live: true``).
+
+    Register :meth:`publish` as a store listener (see :class:`ssb.feed.store.LogStore`). Each message is encoded once
+    (in each of the ``keys``/no ``keys`` forms that are subscribed to), and the same bytes are written to every
+    subscriber's connection; only the packet header differs.
+
+    A subscriber whose connection has more than ``max_buffered`` bytes waiting to go out is slow. With
+    ``slow_policy='drop'``, its subscription is ended; with ``'buffer'``, up to ``max_queued`` messages are held back
+    for it (``0`` means no limit) before it is dropped.
+    """
+
+    def __init__(self, max_buffered=1024 * 1024, max_queued=1000, slow_policy=DROP):
+        if slow_policy not in {DROP, BUFFER}:
+            raise ValueError('Unknown slow subscriber policy: {}'.format(slow_policy))
+        self.max_buffered = max_buffered
+        self.max_queued = max_queued
+        self.slow_policy = slow_policy
+        self.n_dropped = 0
+        # feed ID -> subscriptions
+        self._subscriptions = {}
+
+    def subscribe(self, feed_id, connection, req, keys=True, limit=None):
+        subscription = Subscription(self, feed_id, connection, req, keys=keys, limit=limit)
+        self._subscriptions.setdefault(feed_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self._subscriptions.get(subscription.feed_id)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self._subscriptions[subscription.feed_id]
+
+    def subscribers(self, feed_id):
+        return len(self._subscriptions.get(feed_id, ()))
+
+    def publish(self, messages):
+        """Send ``messages`` (in order) to the subscribers of their feeds.
+
+        A run of several messages is sent as a burst: each subscriber's connection is corked until all of them are
+        written.
+        """
+        if len(messages) > 1:
+            connections = set(subscription.connection for msg in messages
+                              for subscription in self._subscriptions.get(msg.feed.id, ()))
+            for connection in connections:
+                connection.cork()
+            try:
+                self._publish(messages)
+            finally:
+                for connection in connections:
+                    connection.uncork()
+        else:
+            self._publish(messages)
+
+    def _publish(self, messages):
+        for msg in messages:
+            subscriptions = self._subscriptions.get(msg.feed.id)
+            if not subscriptions:
+                continue
+            encoded = {}
+            # subscriptions can end while being pushed to
+            for subscription in list(subscriptions):
+                data = encoded.get(subscription.keys)
+                if data is None:
+                    value = msg.to_dict()
+                    if subscription.keys:
+                        value = {'key': msg.key, 'value': value, 'timestamp': msg.timestamp}
+                    data = encoded[subscription.keys] = codec.dumps(value)
+                subscription.push(data)
@@ -0,0 +1,83 @@
+from asyncio import Queue, ensure_future, get_event_loop
+
+from async_generator import async_generator, yield_
+
+from .models import InvalidMessageException, InvalidSignatureException, Message, _verify_signatures
+
+
+@async_generator
+async def ingest(source, feed, executor=None, batch_size=64, concurrency=4):
+    """Validate the replies of a ``createHistoryStream`` call and append them to ``feed``.
+
+    Messages are decoded, checked against the chain (sequence and previous key) and hashed as they arrive, in batches
+    of ``batch_size``. The signatures of each batch are then checked in ``executor`` (the event loop's default one if
+    ``None``), with up to ``concurrency`` batches in flight, while the next ones are being read.
+
+    Each batch of validated messages is appended to the feed (and its store) with a single write (see
+    :meth:`ssb.feed.Feed.append_many`), then yielded in order. The first broken link or bad signature raises
+    :class:`InvalidMessageException`, after all the messages that came before it.
+
+    :param source: async iterable of :class:`ssb.packet_stream.PSMessage`, e.g. a
+                   :class:`ssb.muxrpc.MuxRPCSourceHandler`. Both ``keys: true`` and ``keys: false`` replies work.
+    """
+    loop = get_event_loop()
+    pending = Queue(maxsize=concurrency)
+
+    async def _submit(batch):
+        items = [msg._signed_parts() for msg in batch]
+        await pending.put((batch, loop.run_in_executor(executor, _verify_signatures, items)))
+
+    async def _read():
+        batch = []
+        sequence, tip = feed.sequence, feed.tip
+        try:
+            async for ps_msg in source:
+                if ps_msg.end_err:
+                    # end of stream
+                    continue
+                obj = ps_msg.body
+                key = None
+                if 'value' in obj:
+                    key, obj = obj['key'], obj['value']
+
+                msg = Message.parse(obj, feed, verify=False)
+                if msg.sequence != sequence + 1 or msg.previous != tip:
+                    raise InvalidMessageException('Message #{} does not follow {} (#{})'.format(
+                        msg.sequence, tip, sequence))
+                if key is not None and key != msg.key:
+                    raise InvalidMessageException('Message #{} has key {}, not {}'.format(msg.sequence, msg.key, key))
+                sequence, tip = msg.sequence, msg.key
+
+                batch.append(msg)
+                if len(batch) >= batch_size:
+                    await _submit(batch)
+                    batch = []
+        except Exception as e:
+            if batch:
+                await _submit(batch)
+            await pending.put(e)
+        else:
+            if batch:
+                await _submit(batch)
+            await pending.put(None)
+
+    reader = ensure_future(_read())
+    try:
+        while True:
+            item = await pending.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            batch, results = item
+            results = await results
+            # what comes before a bad signature is kept
+            n_valid = results.index(False) if False in results else len(batch)
+            feed.append_many(batch[:n_valid])
+            for msg in batch[:n_valid]:
+                await yield_(msg)
+            if n_valid < len(batch):
+                raise InvalidSignatureException('Invalid signature for message #{} of {}'.format(
+                    batch[n_valid].sequence, feed.id))
+    finally:
+        reader.cancel()
@@ -1,23 +1,71 @@
 import datetime
-from base64 import b64encode
-from collections import namedtuple, OrderedDict
+from base64 import b64decode, b64encode
+from binascii import Error as Base64Error
+from collections import OrderedDict
 from hashlib import sha256
+from itertools import chain
 
-from simplejson import dumps, loads
+from nacl.exceptions import BadSignatureError
+from nacl.signing import VerifyKey
 
+from ssb import codec
 from ssb.util import tag
 
 
-OrderedMsg = namedtuple('OrderedMsg', ('previous', 'author', 'sequence', 'timestamp', 'hash', 'content'))
+class NoPrivateKeyException(Exception):
+    pass
 
 
-class NoPrivateKeyException(Exception):
+class NoStoreException(Exception):
+    pass
+
+
+class InvalidMessageException(Exception):
     pass
 
 
-def to_ordered(data):
-    smsg = OrderedMsg(**data)
-    return OrderedDict((k, getattr(smsg, k)) for k in smsg._fields)
+class InvalidSignatureException(InvalidMessageException):
+    pass
+
+
+SIGNATURE_SUFFIX = '.sig.ed25519'
+
+
+def _verify_signatures(items):
+    """Check a list of ``(public_key, data, signature)`` tuples (all ``bytes``), returning a list of booleans."""
+    keys = {}
+    results = []
+    for public_key, data, signature in items:
+        if signature is None:
+            results.append(False)
+            continue
+        if public_key not in keys:
+            keys[public_key] = VerifyKey(public_key)
+        try:
+            keys[public_key].verify(data, signature)
+            results.append(True)
+        except (BadSignatureError, ValueError):
+            results.append(False)
+    return results
+
+
+def verify_messages(messages, executor=None, chunk_size=64):
+    """Check the signatures of several messages (e.g. a page of a history stream) at once.
+
+    Returns a list of booleans, in the same order as ``messages``. Messages are serialized here, while the actual
+    verification can be spread over a thread or process pool (``executor``), in chunks of ``chunk_size``.
+    """
+    items = [msg._signed_parts() for msg in messages]
+    if executor is None:
+        return _verify_signatures(items)
+    chunks = [items[n:n + chunk_size] for n in range(0, len(items), chunk_size)]
+    return list(chain.from_iterable(executor.map(_verify_signatures, chunks)))
+
+
+def _previous_key_sequence(previous, sequence):
+    if isinstance(previous, Message):
+        return previous.key, previous.sequence + 1
+    return previous, sequence
 
 
 def get_millis_1970():
@@ -25,8 +73,23 @@ def get_millis_1970():
 
 
 class Feed(object):
-    def __init__(self, public_key):
+    """An SSB identity and its feed.
+
+    Only the feed's tip (key and sequence number of the latest message) is kept, so that appending doesn't require
+    any of the previous messages. With a ``store`` (e.g. :class:`ssb.feed.store.LogStore`), appended messages are
+    written to it, and the tip is restored from it.
+    """
+
+    def __init__(self, public_key, store=None):
         self.public_key = public_key
+        self._init_store(store)
+
+    def _init_store(self, store):
+        self.store = store
+        if store is None:
+            self.tip, self.sequence = None, 0
+        else:
+            self.tip, self.sequence = store.tip(self.id)
 
     @property
     def id(self):
@@ -35,10 +98,49 @@ class Feed(object):
     def sign(self, msg):
         raise NoPrivateKeyException('Cannot use remote identity to sign (no private key!)')
 
+    def append(self, msg):
+        """Make ``msg`` the new tip of the feed, checking that it follows the current one."""
+        if msg.sequence != self.sequence + 1 or msg.previous != self.tip:
+            raise InvalidMessageException('Message {} (#{}) does not follow {} (#{})'.format(
+                msg.key, msg.sequence, self.tip, self.sequence))
+        if self.store is not None:
+            self.store.append(msg)
+        self.tip = msg.key
+        self.sequence = msg.sequence
+        return msg
+
+    def append_many(self, messages):
+        """Append a run of messages, each following the one before it, with a single write to the store."""
+        tip, sequence = self.tip, self.sequence
+        for msg in messages:
+            if msg.sequence != sequence + 1 or msg.previous != tip:
+                raise InvalidMessageException('Message {} (#{}) does not follow {} (#{})'.format(
+                    msg.key, msg.sequence, tip, sequence))
+            tip, sequence = msg.key, msg.sequence
+        if self.store is not None and messages:
+            self.store.append_many(messages)
+        self.tip, self.sequence = tip, sequence
+        return messages
+
+    def _check_store(self):
+        if self.store is None:
+            raise NoStoreException('Feed {} has no store, only its tip is kept'.format(self.id))
+
+    def get(self, sequence):
+        """Return message number ``sequence`` from the store (``None`` if it isn't there)."""
+        self._check_store()
+        return self.store.get_by_sequence(self.id, sequence, feed=self)
+
+    def history(self, start=1, limit=None):
+        """Iterate over the stored messages, from sequence number ``start`` on."""
+        self._check_store()
+        return self.store.history(self.id, start=start, limit=limit, feed=self)
+
 
 class LocalFeed(Feed):
-    def __init__(self, private_key):
+    def __init__(self, private_key, store=None):
         self.private_key = private_key
+        self._init_store(store)
 
     @property
     def public_key(self):
@@ -47,8 +149,43 @@ class LocalFeed(Feed):
     def sign(self, msg):
         return self.private_key.sign(msg).signature
 
+    def publish(self, content, timestamp=None):
+        """Create a new message on top of the feed's tip and append it."""
+        return self.append(LocalMessage(self, content, sequence=self.sequence + 1, timestamp=timestamp,
+                                        previous=self.tip))
+
+    def publish_many(self, contents, timestamps=None):
+        """Create a run of messages on top of the feed's tip, one for each item of ``contents``, and append them.
+
+        Each message is chained to the key of the one before it, which was computed when it was signed. With a store,
+        the whole run goes in with a single :meth:`~ssb.feed.store.LogStore.append_many`, so the store's listeners
+        (e.g. a :class:`ssb.feed.hub.LiveHub`) get it as one burst.
+        """
+        messages = []
+        previous, sequence = self.tip, self.sequence
+        for n, content in enumerate(contents):
+            msg = LocalMessage(self, content, sequence=sequence + 1, previous=previous,
+                               timestamp=None if timestamps is None else timestamps[n])
+            previous, sequence = msg.key, msg.sequence
+            messages.append(msg)
+        if self.store is not None and messages:
+            self.store.append_many(messages)
+        self.tip, self.sequence = previous, sequence
+        return messages
+
 
 class Message(object):
+    """A feed message.
+
+    ``previous`` is the key of the preceding message (``None`` for the first one). For convenience, the preceding
+    :class:`Message` itself can be passed instead, in which case ``sequence`` follows from it; only its key is kept.
+
+    The canonical (signed) serialization, hash and key are computed once and cached; assigning ``content`` clears
+    the cache. Other fields are not meant to change once the message is built.
+    """
+
+    __slots__ = ('feed', '_content', 'signature', 'previous', 'sequence', 'timestamp', '_serialized', '_hash')
+
     def __init__(self, feed, content, signature, sequence=1, timestamp=None, previous=None):
         self.feed = feed
         self.content = content
@@ -57,44 +194,79 @@ class Message(object):
             raise ValueError("signature can't be None")
         self.signature = signature
 
-        self.previous = previous
-        if self.previous:
-            self.sequence = self.previous.sequence + 1
-        else:
-            self.sequence = sequence
+        self.previous, self.sequence = _previous_key_sequence(previous, sequence)
 
         self.timestamp = get_millis_1970() if timestamp is None else timestamp
 
     @classmethod
-    def parse(cls, data, feed):
-        obj = loads(data, object_pairs_hook=OrderedDict)
-        msg = cls(feed, obj['content'], timestamp=obj['timestamp'])
+    def parse(cls, data, feed, verify=True):
+        """Build a message out of its JSON representation (or the already decoded object), checking that it was
+        signed by ``feed``."""
+        obj = codec.loads(data) if isinstance(data, (bytes, bytearray, memoryview, str)) else data
+        if obj['author'] != feed.id:
+            raise InvalidMessageException('Message from {} does not belong to {}'.format(obj['author'], feed.id))
+        msg = cls(feed, obj['content'], obj['signature'], sequence=obj['sequence'], timestamp=obj['timestamp'],
+                  previous=obj['previous'])
+        if verify and not msg.verify():
+            raise InvalidSignatureException('Invalid signature for message #{} of {}'.format(msg.sequence, feed.id))
         return msg
 
+    @property
+    def content(self):
+        return self._content
+
+    @content.setter
+    def content(self, value):
+        self._content = value
+        self._serialized = None
+        self._hash = None
+
     def serialize(self, add_signature=True):
-        return dumps(self.to_dict(add_signature=add_signature), indent=2).encode('utf-8')
+        if not add_signature:
+            return codec.dumps_canonical(self.to_dict(add_signature=False))
+        if self._serialized is None:
+            self._serialized = codec.dumps_canonical(self.to_dict())
+        return self._serialized
 
     def to_dict(self, add_signature=True):
-        obj = to_ordered({
-            'previous': self.previous.key if self.previous else None,
-            'author': self.feed.id,
-            'sequence': self.sequence,
-            'timestamp': self.timestamp,
-            'hash': 'sha256',
-            'content': self.content
-        })
+        # the order of the keys is part of the format
+        obj = OrderedDict((
+            ('previous', self.previous),
+            ('author', self.feed.id),
+            ('sequence', self.sequence),
+            ('timestamp', self.timestamp),
+            ('hash', 'sha256'),
+            ('content', self.content)
+        ))
 
         if add_signature:
             obj['signature'] = self.signature
         return obj
 
-    def verify(self, signature):
-        return self.signature == signature
+    def _signed_parts(self):
+        if not self.signature.endswith(SIGNATURE_SUFFIX):
+            return bytes(self.feed.public_key), None, None
+        try:
+            signature = b64decode(self.signature[:-len(SIGNATURE_SUFFIX)], validate=True)
+        except Base64Error:
+            signature = None
+        return bytes(self.feed.public_key), self.serialize(add_signature=False), signature
+
+    def verify(self, signature=None):
+        """Check the message's signature against the author's public key.
+
+        If ``signature`` is given, it also has to match the message's own.
+        """
+        if signature is not None and signature != self.signature:
+            return False
+        return _verify_signatures([self._signed_parts()])[0]
 
     @property
     def hash(self):
-        hash = sha256(self.serialize()).digest()
-        return b64encode(hash).decode('ascii') + '.sha256'
+        if self._hash is None:
+            hash = sha256(self.serialize()).digest()
+            self._hash = b64encode(hash).decode('ascii') + '.sha256'
+        return self._hash
 
     @property
     def key(self):
@@ -102,24 +274,24 @@ class Message(object):
 
 
 class LocalMessage(Message):
+    __slots__ = ()
+
     def __init__(self, feed, content, signature=None, sequence=1, timestamp=None, previous=None):
         self.feed = feed
         self.content = content
 
-        self.previous = previous
-        if self.previous:
-            self.sequence = self.previous.sequence + 1
-        else:
-            self.sequence = sequence
+        self.previous, self.sequence = _previous_key_sequence(previous, sequence)
 
         self.timestamp = get_millis_1970() if timestamp is None else timestamp
 
         if signature is None:
-            self.signature = self._sign()
+            # ensure ordering of keys and indentation of 2 characters, like ssb-keys
+            data = self.serialize(add_signature=False)
+            self.signature = self._sign(data)
+            # the signed form is the same, with the signature as the last key
+            self._serialized = data[:-2] + ',\n  "signature": "{}"\n}}'.format(self.signature).encode('ascii')
         else:
             self.signature = signature
 
-    def _sign(self):
-        # ensure ordering of keys and indentation of 2 characters, like ssb-keys
-        data = self.serialize(add_signature=False)
+    def _sign(self, data):
         return (b64encode(bytes(self.feed.sign(data))) + b'.sig.ed25519').decode('ascii')
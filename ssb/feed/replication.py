@@ -0,0 +1,107 @@
+import logging
+from asyncio import IncompleteReadError, Queue, QueueEmpty, gather
+
+from nacl.signing import VerifyKey
+
+from ssb.muxrpc import MuxRPCAPIException
+from ssb.packet_stream import PSTimeoutException
+
+from .ingest import ingest
+from .models import Feed, InvalidMessageException
+from .store import StoreException, _author_bytes
+
+
+logger = logging.getLogger('replication')
+
+
+class Replicator(object):
+    """Replicates a set of feeds from the connected peers into ``store``.
+
+    Every followed feed is fetched from one peer at a time with ``createHistoryStream``, starting right after the
+    feed's tip in the store (so progress survives restarts). If the peer drops (before ending the stream), errors out,
+    times out or sends invalid messages, or the messages can't be stored, the feed is retried with the next peer. At
+    most ``max_streams`` streams run at the same time, spread over the least busy peers. Signatures are checked in
+    ``executor`` (see :func:`ssb.feed.ingest`).
+    """
+
+    def __init__(self, api, store, follows=(), max_streams=16, executor=None):
+        self.api = api
+        self.store = store
+        self.max_streams = max_streams
+        self.executor = executor
+        self.feeds = {}
+        # connection -> number of streams running over it
+        self.peers = {}
+        self.n_messages = 0
+        for feed_id in follows:
+            self.follow(feed_id)
+
+    def follow(self, feed_id):
+        if feed_id not in self.feeds:
+            self.feeds[feed_id] = Feed(VerifyKey(_author_bytes(feed_id)), store=self.store)
+
+    def unfollow(self, feed_id):
+        self.feeds.pop(feed_id, None)
+
+    def add_peer(self, connection):
+        self.peers.setdefault(connection, 0)
+
+    def remove_peer(self, connection):
+        self.peers.pop(connection, None)
+
+    async def sync(self):
+        """Bring every followed feed up to date with (one of) the connected peers.
+
+        Returns the IDs of the feeds that no peer could be replicated from.
+        """
+        queue = Queue()
+        for feed_id in self.feeds:
+            queue.put_nowait(feed_id)
+        # feed ID -> peers that were tried already
+        tried = {}
+        failed = []
+        await gather(*[self._worker(queue, tried, failed) for n in range(self.max_streams)])
+        return failed
+
+    def _pick_peer(self, exclude):
+        candidates = [(n_streams, n, connection) for n, (connection, n_streams) in enumerate(self.peers.items())
+                      if connection.is_connected and connection not in exclude]
+        return min(candidates)[2] if candidates else None
+
+    async def _worker(self, queue, tried, failed):
+        while True:
+            try:
+                feed_id = queue.get_nowait()
+            except QueueEmpty:
+                return
+            feed = self.feeds.get(feed_id)
+            if feed is None:
+                continue
+            exclude = tried.setdefault(feed_id, set())
+            connection = self._pick_peer(exclude)
+            if connection is None:
+                logger.warning('Could not replicate %s from any peer', feed_id)
+                failed.append(feed_id)
+                continue
+            if not await self._replicate(feed, connection):
+                exclude.add(connection)
+                queue.put_nowait(feed_id)
+
+    async def _replicate(self, feed, connection):
+        if not connection.is_connected:
+            return False
+        self.peers[connection] += 1
+        try:
+            source = self.api.call('createHistoryStream', [{'id': feed.id, 'seq': feed.sequence + 1, 'keys': False}],
+                                   'source', connection=connection)
+            async for msg in ingest(source, feed, executor=self.executor):
+                self.n_messages += 1
+        except (MuxRPCAPIException, InvalidMessageException, PSTimeoutException, IncompleteReadError, OSError,
+                StoreException) as e:
+            logger.warning('Replicating %s failed: %s', feed.id, e)
+            return False
+        finally:
+            if connection in self.peers:
+                self.peers[connection] -= 1
+        # the stream also ends when the connection drops, without the peer's end frame
+        return source.ended
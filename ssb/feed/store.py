@@ -0,0 +1,227 @@
+import logging
+import mmap
+import os
+import struct
+from array import array
+from base64 import b64decode, b64encode
+from zlib import crc32
+
+from nacl.signing import VerifyKey
+
+from .models import Feed, InvalidMessageException, Message
+
+
+logger = logging.getLogger('store')
+
+# payload length, CRC32 (of everything else in the frame), sequence, author's public key, SHA-256 of the payload
+FRAME_HEADER = struct.Struct('>IIQ32s32s')
+
+
+class StoreException(Exception):
+    pass
+
+
+def _author_bytes(feed_id):
+    return b64decode(feed_id[1:-len('.ed25519')])
+
+
+def _key_digest(key):
+    return b64decode(key[1:-len('.sha256')])
+
+
+def _digest_key(digest):
+    return '%' + b64encode(digest).decode('ascii') + '.sha256'
+
+
+def _frame_crc(frame):
+    """CRC32 of a frame (header and payload), leaving out the CRC field itself."""
+    return crc32(frame[8:], crc32(frame[:4]))
+
+
+class LogStore(object):
+    """Append-only, on-disk log of feed messages.
+
+    Each message is stored as a frame: a fixed-size header (see ``FRAME_HEADER``) followed by the message's canonical
+    serialization. The indexes (message key -> offset and author -> offsets by sequence number) are kept in memory and
+    rebuilt from the frame headers on start-up, without decoding any message. Reads go through a memory map of the
+    log.
+
+    If the log ends with an incomplete or corrupted frame (e.g. after a crash halfway through a write), it is
+    truncated back to the last valid one. Each frame's CRC covers its header as well as its payload, so that the
+    indexes are never rebuilt from a damaged header.
+
+    Callables in ``listeners`` are called with the list of messages of each append, once they are in the log (see
+    :class:`ssb.feed.hub.LiveHub`).
+    """
+
+    def __init__(self, path, sync=False):
+        self.path = path
+        self.sync = sync
+        self._by_key = {}
+        # author -> (first sequence, offsets)
+        self._by_author = {}
+        self._file = open(path, 'a+b')
+        self._map = None
+        # end of the last valid frame
+        self.size = 0
+        self.listeners = []
+        self._recover()
+
+    def _recover(self):
+        size = os.fstat(self._file.fileno()).st_size
+        self._remap(size)
+        offset = 0
+        while offset + FRAME_HEADER.size <= size:
+            length, crc, sequence, author, digest = FRAME_HEADER.unpack_from(self._map, offset)
+            end = offset + FRAME_HEADER.size + length
+            if end > size or _frame_crc(self._map[offset:end]) != crc:
+                break
+            self._index(offset, sequence, author, digest)
+            offset = end
+
+        if offset < size:
+            logger.warning('Truncating %s from %d to %d bytes', self.path, size, offset)
+            self._remap(0)
+            self._file.truncate(offset)
+            self._remap(offset)
+        self.size = offset
+
+    def _remap(self, size):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), size, access=mmap.ACCESS_READ)
+
+    def _index(self, offset, sequence, author, digest):
+        self._by_key[digest] = offset
+        if author not in self._by_author:
+            self._by_author[author] = (sequence, array('Q'))
+        first, offsets = self._by_author[author]
+        if sequence != first + len(offsets):
+            raise StoreException('Message #{} does not follow #{} in the log'.format(
+                sequence, first + len(offsets) - 1))
+        offsets.append(offset)
+
+    def append(self, msg):
+        """Write ``msg`` to the end of the log. Returns its offset."""
+        return self.append_many([msg])[0]
+
+    def append_many(self, messages):
+        """Write several messages with a single write. Returns their offsets."""
+        self._file.seek(0, os.SEEK_END)
+        offset = self._file.tell()
+        frames, offsets, entries = [], [], []
+        next_sequence = {}
+        messages = list(messages)
+        for msg in messages:
+            data = msg.serialize()
+            author = bytes(msg.feed.public_key)
+            if author in next_sequence:
+                expected = next_sequence[author]
+            elif author in self._by_author:
+                first, author_offsets = self._by_author[author]
+                expected = first + len(author_offsets)
+            else:
+                # a feed's log can start anywhere
+                expected = msg.sequence
+            if msg.sequence != expected:
+                raise StoreException('Message #{} does not follow #{} in the log'.format(msg.sequence, expected - 1))
+            next_sequence[author] = expected + 1
+            digest = _key_digest(msg.key)
+            header = bytearray(FRAME_HEADER.pack(len(data), 0, msg.sequence, author, digest))
+            struct.pack_into('>I', header, 4, crc32(data, _frame_crc(header)))
+            frames += (header, data)
+            entries.append((offset, msg.sequence, author, digest))
+            offsets.append(offset)
+            offset += FRAME_HEADER.size + len(data)
+
+        self._file.write(b''.join(frames))
+        self._file.flush()
+        if self.sync:
+            os.fsync(self._file.fileno())
+        self.size = offset
+        for entry in entries:
+            self._index(*entry)
+        for listener in self.listeners:
+            try:
+                listener(messages)
+            except Exception:
+                # the messages are in the log all the same
+                logger.exception('Error in store listener %r', listener)
+        return offsets
+
+    def _map_for(self, offset):
+        if self._map is None or offset >= len(self._map):
+            # the log has grown since it was last mapped
+            self._remap(os.fstat(self._file.fileno()).st_size)
+        return self._map
+
+    def _read(self, offset):
+        map_ = self._map_for(offset)
+        length, crc, sequence, author, digest = FRAME_HEADER.unpack_from(map_, offset)
+        start = offset + FRAME_HEADER.size
+        return author, map_[start:start + length]
+
+    def read(self, offset, feed=None):
+        """Return the message stored at ``offset``, belonging to ``feed`` (a new :class:`Feed`, if not given)."""
+        author, data = self._read(offset)
+        if feed is None:
+            feed = Feed(VerifyKey(author))
+        elif bytes(feed.public_key) != author:
+            raise InvalidMessageException('Message at {} does not belong to {}'.format(offset, feed.id))
+        msg = Message.parse(data, feed, verify=False)
+        # the stored data is already the message's canonical form
+        msg._serialized = data
+        return msg
+
+    def __contains__(self, key):
+        return _key_digest(key) in self._by_key
+
+    def __len__(self):
+        return len(self._by_key)
+
+    def get(self, key, feed=None):
+        """Look a message up by its key (``None`` if it isn't in the log)."""
+        offset = self._by_key.get(_key_digest(key))
+        return None if offset is None else self.read(offset, feed)
+
+    def _offset(self, feed_id, sequence):
+        first, offsets = self._by_author.get(_author_bytes(feed_id), (1, ()))
+        if first <= sequence < first + len(offsets):
+            return offsets[sequence - first]
+        return None
+
+    def get_by_sequence(self, feed_id, sequence, feed=None):
+        """Look a message up by author and sequence number (``None`` if it isn't in the log)."""
+        offset = self._offset(feed_id, sequence)
+        return None if offset is None else self.read(offset, feed)
+
+    def tip(self, feed_id):
+        """Return the ``(key, sequence)`` of the latest message stored for ``feed_id``, or ``(None, 0)``."""
+        first, offsets = self._by_author.get(_author_bytes(feed_id), (1, ()))
+        if not offsets:
+            return None, 0
+        length, crc, sequence, author, digest = FRAME_HEADER.unpack_from(self._map_for(offsets[-1]), offsets[-1])
+        return _digest_key(digest), sequence
+
+    def history(self, feed_id, start=1, limit=None, feed=None):
+        """Iterate over the messages of ``feed_id`` from sequence number ``start`` on, reading them one by one."""
+        first, offsets = self._by_author.get(_author_bytes(feed_id), (1, ()))
+        n = max(start - first, 0)
+        end = len(offsets) if limit is None else min(len(offsets), n + limit)
+        while n < end:
+            yield self.read(offsets[n], feed)
+            n += 1
+
+    def scan(self, offset=0):
+        """Iterate over all the messages in the log, in the order they were written, from ``offset`` on."""
+        end = self.size
+        while offset < end:
+            length = FRAME_HEADER.unpack_from(self._map_for(offset), offset)[0]
+            yield self.read(offset)
+            offset += FRAME_HEADER.size + length
+
+    def close(self):
+        self._remap(0)
+        self._file.close()
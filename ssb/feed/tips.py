@@ -0,0 +1,176 @@
+import logging
+import mmap
+import os
+import struct
+from base64 import b64encode
+from collections import OrderedDict
+
+from .store import _author_bytes, _digest_key, _key_digest
+
+
+logger = logging.getLogger('tips')
+
+MAGIC = b'SSBTIPS1'
+# magic, size of the part of the log that is indexed, number of records
+INDEX_HEADER = struct.Struct('>8sQQ')
+# author's public key, sequence, timestamp, SHA-256 of the latest message
+RECORD = struct.Struct('>32sQd32s')
+
+
+def _feed_id(author):
+    return '@' + b64encode(author).decode('ascii') + '.ed25519'
+
+
+class TipIndex(object):
+    """Latest sequence number, key and timestamp of every feed in a log, persisted in a file of fixed-size records.
+
+    The file is memory-mapped, so opening the index only takes a pass over its records (one per feed), and updates
+    are written in place. Attached to a ``store`` (see :class:`ssb.feed.store.LogStore`), the index follows its
+    appends, and catches up on startup with whatever was appended while it was closed.
+
+    :meth:`changes` and :meth:`diff` produce vector clocks (``{feed ID: sequence}``) of the feeds that changed since a
+    given point, or that differ from a peer's clock, without going through any messages.
+    """
+
+    def __init__(self, path, store=None):
+        self.path = path
+        self.store = store
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        self._file = open(path, 'r+b')
+        self._map = None
+        # feed ID -> record number
+        self._slots = {}
+        # feed ID -> version of its last update, least recently updated first
+        self._changed = OrderedDict()
+        self.version = 0
+        self._load()
+
+        if store is not None:
+            if self.indexed_size > store.size:
+                logger.warning('%s is ahead of the log, rebuilding it', path)
+                self._reset()
+            self.update(store.scan(self.indexed_size), store.size)
+            store.listeners.append(self._on_append)
+
+    def _load(self):
+        size = os.fstat(self._file.fileno()).st_size
+        if size < INDEX_HEADER.size:
+            self._reset()
+            return
+        self._map = mmap.mmap(self._file.fileno(), size)
+        magic, indexed_size, count = INDEX_HEADER.unpack_from(self._map)
+        if magic != MAGIC or INDEX_HEADER.size + count * RECORD.size > size:
+            logger.warning('%s is not a valid index, rebuilding it', self.path)
+            self._reset()
+            return
+        for n in range(count):
+            offset = INDEX_HEADER.size + n * RECORD.size
+            self._slots[_feed_id(self._map[offset:offset + 32])] = n
+
+    def _reset(self, capacity=64):
+        self._slots.clear()
+        self._changed.clear()
+        self._resize(capacity)
+        INDEX_HEADER.pack_into(self._map, 0, MAGIC, 0, 0)
+
+    def _resize(self, capacity):
+        if self._map is not None:
+            self._map.close()
+        size = INDEX_HEADER.size + capacity * RECORD.size
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+
+    @property
+    def indexed_size(self):
+        """How much of the log (in bytes) the index covers."""
+        return INDEX_HEADER.unpack_from(self._map)[1]
+
+    def _on_append(self, messages):
+        self.update(messages, self.store.size)
+
+    def update(self, messages, indexed_size=None):
+        """Record the messages in ``messages`` that are newer than the current tips of their feeds."""
+        for msg in messages:
+            feed_id = msg.feed.id
+            slot = self._slots.get(feed_id)
+            if slot is None:
+                slot = self._slots[feed_id] = len(self._slots)
+                if INDEX_HEADER.size + len(self._slots) * RECORD.size > len(self._map):
+                    self._resize(2 * len(self._slots))
+            offset = INDEX_HEADER.size + slot * RECORD.size
+            if msg.sequence <= RECORD.unpack_from(self._map, offset)[1]:
+                continue
+            RECORD.pack_into(self._map, offset, _author_bytes(feed_id), msg.sequence, msg.timestamp,
+                             _key_digest(msg.key))
+
+            self.version += 1
+            self._changed.pop(feed_id, None)
+            self._changed[feed_id] = self.version
+
+        INDEX_HEADER.pack_into(self._map, 0, MAGIC, self.indexed_size if indexed_size is None else indexed_size,
+                               len(self._slots))
+
+    def get(self, feed_id):
+        """Return ``(sequence, key, timestamp)`` of the latest message of ``feed_id``, or ``None``."""
+        slot = self._slots.get(feed_id)
+        if slot is None:
+            return None
+        author, sequence, timestamp, digest = RECORD.unpack_from(self._map, INDEX_HEADER.size + slot * RECORD.size)
+        return sequence, _digest_key(digest), timestamp
+
+    def sequence(self, feed_id):
+        slot = self._slots.get(feed_id)
+        if slot is None:
+            return 0
+        return RECORD.unpack_from(self._map, INDEX_HEADER.size + slot * RECORD.size)[1]
+
+    def __contains__(self, feed_id):
+        return feed_id in self._slots
+
+    def __len__(self):
+        return len(self._slots)
+
+    def clock(self, feed_ids=None):
+        """Return the vector clock of ``feed_ids`` (all feeds, if not given)."""
+        return {feed_id: self.sequence(feed_id) for feed_id in (self._slots if feed_ids is None else feed_ids)}
+
+    def changes(self, since=0):
+        """Return ``(version, clock)``: the current version of the index, and the clock of the feeds that changed after
+        version ``since``.
+
+        Only the feeds that changed are looked at. Versions start over whenever the index is opened, so an exchange
+        with a peer should start with the full :meth:`clock` (at the current :attr:`version`), and only send changes
+        from then on.
+        """
+        clock = {}
+        for feed_id in reversed(self._changed):
+            if self._changed[feed_id] <= since:
+                break
+            clock[feed_id] = self.sequence(feed_id)
+        return self.version, clock
+
+    def diff(self, peer_clock):
+        """Compare a peer's clock with ours, for the feeds in it.
+
+        Returns ``(need, have)``: the feeds that the peer has more of, with our sequence (so ``seq + 1`` is where to
+        ask from), and the feeds that we have more of, with the peer's sequence.
+        """
+        need, have = {}, {}
+        for feed_id, peer_sequence in peer_clock.items():
+            sequence = self.sequence(feed_id)
+            if peer_sequence > sequence:
+                need[feed_id] = sequence
+            elif peer_sequence < sequence:
+                have[feed_id] = peer_sequence
+        return need, have
+
+    def flush(self):
+        self._map.flush()
+
+    def close(self):
+        if self.store is not None and self._on_append in self.store.listeners:
+            self.store.listeners.remove(self._on_append)
+        self._map.flush()
+        self._map.close()
+        self._file.close()
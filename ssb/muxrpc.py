@@ -1,8 +1,13 @@
+import logging
+from asyncio import CancelledError, Semaphore, ensure_future, get_event_loop, iscoroutinefunction, wait
 from functools import wraps
 
 from async_generator import async_generator, yield_
 
-from ssb.packet_stream import PSMessageType
+from ssb.packet_stream import PSMessageType, PSStreamHandler
+
+
+logger = logging.getLogger('muxrpc')
 
 
 class MuxRPCAPIException(Exception):
@@ -29,6 +34,14 @@ class MuxRPCRequestHandler(MuxRPCHandler):
 class MuxRPCSourceHandler(MuxRPCHandler):
     def __init__(self, ps_handler):
         self.ps_handler = ps_handler
+        self._messages = None
+        # what is left of the last binary message, after a short readinto()
+        self._pending = None
+
+    @property
+    def ended(self):
+        """Whether the peer ended the stream, as opposed to the connection closing halfway."""
+        return self.ps_handler.ended
 
     @async_generator
     async def __aiter__(self):
@@ -39,12 +52,74 @@ class MuxRPCSourceHandler(MuxRPCHandler):
             except MuxRPCAPIException:
                 raise
 
+    async def _next_data(self):
+        """Return the body of the next ``BUFFER`` message as a :class:`memoryview`, or ``None`` at the end."""
+        if self._messages is None:
+            self._messages = self.__aiter__()
+        try:
+            msg = await self._messages.__anext__()
+        except StopAsyncIteration:
+            return None
+        if msg.end_err:
+            return None
+        if msg.type != PSMessageType.BUFFER:
+            raise MuxRPCAPIException('Expected binary data, got {}'.format(msg.type.name))
+        return memoryview(msg.data)
+
+    async def readinto(self, buf):
+        """Read binary data from the stream into ``buf``, like :meth:`io.RawIOBase.readinto`.
+
+        Waits for data if there is none yet, and returns the number of bytes read (0 at the end of the stream).
+        """
+        if not self._pending:
+            self._pending = await self._next_data()
+            if self._pending is None:
+                return 0
+        view = memoryview(buf).cast('B')
+        n = min(len(view), len(self._pending))
+        view[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    async def write_to(self, fileobj):
+        """Write the rest of the stream's binary data to ``fileobj``, returning the number of bytes written.
+
+        Message bodies are handed to ``fileobj.write`` as they came off the wire, without copies.
+        """
+        total = 0
+        data = self._pending or await self._next_data()
+        self._pending = None
+        while data is not None:
+            fileobj.write(data)
+            total += len(data)
+            data = await self._next_data()
+        return total
+
 
 class MuxRPCSinkHandlerMixin(object):
 
     def send(self, msg, msg_type=PSMessageType.JSON, end=False):
         self.connection.send(msg, stream=True, msg_type=msg_type, req=self.req, end_err=end)
 
+    async def send_file(self, fileobj, chunk_size=65536, end=True):
+        """Stream the contents of ``fileobj`` as ``BUFFER`` messages of up to ``chunk_size`` bytes.
+
+        Each chunk is read straight into a fresh buffer (with ``readinto``) and sent, waiting for the connection to
+        drain in between. Unless ``end=False``, the stream is ended afterwards. Returns the number of bytes sent.
+        """
+        total = 0
+        while True:
+            buf = bytearray(chunk_size)
+            n = fileobj.readinto(buf)
+            if not n:
+                break
+            self.send(memoryview(buf)[:n], msg_type=PSMessageType.BUFFER)
+            total += n
+            await self.connection.drain()
+        if end:
+            self.send(True, end=True)
+        return total
+
 
 class MuxRPCDuplexHandler(MuxRPCSinkHandlerMixin, MuxRPCSourceHandler):
     def __init__(self, ps_handler, connection, req):
@@ -71,20 +146,36 @@ def _get_appropriate_api_handler(type_, connection, ps_handler, req):
 
 
 class MuxRPCRequest(object):
+    """An incoming call. For ``sink`` and ``duplex`` calls, ``incoming`` is a :class:`MuxRPCSourceHandler` over the
+    data that the caller streams in."""
+
+    __slots__ = ('name', 'args', 'req', 'type', 'incoming', 'task_slots')
+
     @classmethod
     def from_message(cls, message):
         body = message.body
-        return cls('.'.join(body['name']), body['args'])
+        return cls('.'.join(body['name']), body['args'], req=message.req, type_=body.get('type', 'async'))
 
-    def __init__(self, name, args):
+    def __init__(self, name, args, req=None, type_='async'):
         self.name = name
         self.args = args
+        self.req = req
+        self.type = type_
+        self.incoming = None
+        # semaphores held by the task that handles the request (see MuxRPCAPI.release_slots)
+        self.task_slots = []
+
+    @property
+    def stream(self):
+        return self.type in {'sink', 'source', 'duplex'}
 
     def __repr__(self):
         return '<MuxRPCRequest {0.name} {0.args}>'.format(self)
 
 
 class MuxRPCMessage(object):
+    __slots__ = ('body',)
+
     @classmethod
     def from_message(cls, message):
         return cls(message.body)
@@ -93,28 +184,131 @@ class MuxRPCMessage(object):
         self.body = body
 
     def __repr__(self):
-        return '<MuxRPCMessage {0.body}}>'.format(self)
+        return '<MuxRPCMessage {0.body}>'.format(self)
 
 
 class MuxRPCAPI(object):
-    def __init__(self):
+    """A set of MuxRPC methods, served over any number of connections.
+
+    Each connection gets its own dispatch loop (see :meth:`serve`). Calls go to ``self.connection`` (the last
+    connection added) unless another one is passed.
+
+    Coroutine handlers run as tasks; at most ``max_tasks`` of them at a time overall, and ``max_tasks_per_connection``
+    for each connection (``None`` means no limit). Once a limit is reached, new handlers wait for a slot; the dispatch
+    loop itself goes on, so that data streamed into ``sink`` and ``duplex`` calls keeps flowing.
+    Long-lived handlers can give their slots back early with :meth:`release_slots`, as live history streams do. The
+    task of a ``source`` call is cancelled if the caller ends the stream early.
+
+    Given a feed ``store`` (see :class:`ssb.feed.store.LogStore`), the API also serves ``createHistoryStream`` out of it
+    (see :meth:`create_history_stream`). Live streams are fed by ``hub`` (a :class:`ssb.feed.hub.LiveHub`, created if
+    not given), which is registered as a listener of the store. Likewise, given a ``blob_store`` (see
+    :class:`ssb.blobs.BlobStore`), it serves ``blobs.has``, ``blobs.get`` and ``blobs.add``.
+    """
+
+    def __init__(self, max_tasks=None, max_tasks_per_connection=None, store=None, history_page_size=64, hub=None,
+                 blob_store=None):
         self.handlers = {}
+        self.executors = {}
+        self.connections = []
         self.connection = None
+        self.max_tasks = max_tasks
+        self.max_tasks_per_connection = max_tasks_per_connection
+        self._slots = None
+        self._connection_slots = {}
+        self._tasks = {}
+
+        self.store = store
+        self.history_page_size = history_page_size
+        self.hub = hub
+        if store is not None:
+            if hub is None:
+                from ssb.feed.hub import LiveHub
+                self.hub = LiveHub()
+            if self.hub.publish not in store.listeners:
+                store.listeners.append(self.hub.publish)
+            self.handlers['createHistoryStream'] = self.create_history_stream
+        self.blob_store = blob_store
+        if blob_store is not None:
+            self.handlers['blobs.has'] = self.blobs_has
+            self.handlers['blobs.get'] = self.blobs_get
+            self.handlers['blobs.add'] = self.blobs_add
 
     async def __await__(self):
-        async for req_message in self.connection:
-            body = req_message.body
-            if req_message is None:
-                return
-            if isinstance(body, dict) and body.get('name'):
-                self.process(self.connection, MuxRPCRequest.from_message(req_message))
+        await self.serve(self.connection)
+
+    async def serve(self, connection):
+        """Dispatch the requests that arrive over ``connection``, until it is closed."""
+        if connection not in self.connections:
+            self.add_connection(connection)
+        # req -> stream handler of the sink/duplex calls that the peer is still streaming data into
+        incoming = {}
+        # req -> task of the source calls that are still being answered
+        sources = {}
+        try:
+            async for req_message in connection:
+                if req_message is None:
+                    return
+                stream = incoming.get(req_message.req)
+                if stream is not None:
+                    await stream.process(req_message)
+                    if req_message.end_err:
+                        await stream.stop()
+                        del incoming[req_message.req]
+                    continue
+                if req_message.req in sources:
+                    if req_message.end_err:
+                        # the caller doesn't want the rest; once the handler has stopped, the end is acknowledged
+                        task = sources.pop(req_message.req)
+                        if task.cancel():
+                            task.add_done_callback(lambda f, req=req_message.req: connection.send(
+                                True, stream=True, end_err=True, req=-req))
+                    continue
+                body = req_message.body
+                if isinstance(body, dict) and body.get('name'):
+                    request = MuxRPCRequest.from_message(req_message)
+                    if request.type in {'sink', 'duplex'}:
+                        stream = incoming[request.req] = PSStreamHandler(request.req)
+                        request.incoming = MuxRPCSourceHandler(stream)
+                    task = await self.process(connection, request)
+                    if task is not None and request.type == 'source':
+                        sources[request.req] = task
+                        task.add_done_callback(lambda f, req=request.req: sources.pop(req, None))
+            # let the requests that are still being handled finish; data that the peer was streaming in is cut short
+            for stream in incoming.values():
+                await stream.fail(MuxRPCAPIException('Connection closed before the end of the stream'))
+            if self._tasks.get(connection):
+                await wait(self._tasks[connection])
+        finally:
+            self.remove_connection(connection)
 
     def add_connection(self, connection):
+        self.connections.append(connection)
         self.connection = connection
 
-    def define(self, name):
+    def remove_connection(self, connection):
+        if connection in self.connections:
+            self.connections.remove(connection)
+        if self.connection is connection:
+            self.connection = self.connections[-1] if self.connections else None
+        self._connection_slots.pop(connection, None)
+        self._tasks.pop(connection, None)
+
+    def n_tasks(self, connection):
+        """Number of handler tasks still running for requests that came in over ``connection``."""
+        return len(self._tasks.get(connection, ()))
+
+    def define(self, name, executor=None):
+        """Register a handler for method ``name``.
+
+        Handlers are called with ``(connection, request)`` and reply through ``connection``. With ``executor`` (a
+        :class:`concurrent.futures.Executor`, or ``True`` for the event loop's default one), the handler is instead
+        called as ``f(request)`` in the executor, and whatever it returns is sent back as the reply. That is meant for
+        CPU-heavy methods; with a process pool, ``f`` has to be picklable.
+        """
         def _handle(f):
             self.handlers[name] = f
+            if executor is not None:
+                self.executors[name] = None if executor is True else executor
 
             @wraps(f)
             def _f(*args, **kwargs):
@@ -122,19 +316,194 @@ class MuxRPCAPI(object):
             return f
         return _handle
 
-    def process(self, connection, request):
+    async def process(self, connection, request):
+        """Call the handler for ``request``. Coroutine and executor handlers run as a task, which is returned."""
         handler = self.handlers.get(request.name)
         if not handler:
-            raise MuxRPCAPIException('Method {} not found!'.format(request.name))
-        handler(connection, request)
+            self.send_error(connection, request, 'Method {} not found!'.format(request.name))
+            return
 
-    def call(self, name, args, type_='sync'):
-        if not self.connection.is_connected:
+        if request.name not in self.executors and not iscoroutinefunction(handler):
+            try:
+                handler(connection, request)
+            except Exception as e:
+                logger.exception('Error in handler for %r', request)
+                self.send_error(connection, request, str(e))
+            return
+
+        # slots are waited for in the task rather than here, so that the dispatch loop keeps delivering the data of
+        # sink and duplex streams (which the handlers that hold the slots may be waiting for)
+        task = ensure_future(self._run_task(connection, request, handler))
+        tasks = self._tasks.setdefault(connection, set())
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    def _get_slots(self, connection):
+        slots = []
+        if self.max_tasks_per_connection is not None:
+            if connection not in self._connection_slots:
+                self._connection_slots[connection] = Semaphore(self.max_tasks_per_connection)
+            slots.append(self._connection_slots[connection])
+        if self.max_tasks is not None:
+            if self._slots is None:
+                self._slots = Semaphore(self.max_tasks)
+            slots.append(self._slots)
+        return slots
+
+    def release_slots(self, request):
+        """Let other requests take the task slots of ``request``, whose handler goes on without counting against the
+        limits (e.g. a live stream that is only waiting for new messages)."""
+        while request.task_slots:
+            request.task_slots.pop().release()
+
+    async def _run_task(self, connection, request, handler):
+        try:
+            # the connection's own limit comes first, so that a connection that is at its limit doesn't sit on global
+            # slots that others could use
+            for slot in self._get_slots(connection):
+                await slot.acquire()
+                request.task_slots.append(slot)
+            if request.name in self.executors:
+                await self._run_in_executor(self.executors[request.name], handler, connection, request)
+            else:
+                await handler(connection, request)
+        except CancelledError:
+            # e.g. the caller aborted the stream (before Python 3.8, this is an Exception)
+            raise
+        except Exception as e:
+            logger.exception('Error in handler for %r', request)
+            self.send_error(connection, request, str(e))
+        finally:
+            self.release_slots(request)
+
+    async def _run_in_executor(self, executor, handler, connection, request):
+        result = await get_event_loop().run_in_executor(executor, handler, request)
+        connection.send(result, req=-request.req)
+
+    async def create_history_stream(self, connection, request):
+        """Stream the messages of a feed from ``self.store``.
+
+        Supports the ``id``, ``seq``, ``limit``, ``keys`` and ``live`` arguments. Messages are read from the store a
+        page (``history_page_size`` messages) at a time, and each page is sent in one go before the next one is read.
+        With ``live``, the stream then stays open and new messages are sent as ``self.hub`` gets them.
+        """
+        args = request.args[0] if request.args else {}
+        feed_id = args['id']
+        sequence = max(args.get('seq', args.get('sequence', 1)), 1)
+        limit = args.get('limit')
+        if limit is not None and limit < 0:
+            # what JS peers send for "no limit"
+            limit = None
+        keys = args.get('keys', True)
+        live = args.get('live', False)
+        n_sent = 0
+
+        while limit is None or n_sent < limit:
+            page_size = self.history_page_size if limit is None else min(self.history_page_size, limit - n_sent)
+            page = list(self.store.history(feed_id, start=sequence, limit=page_size))
+            if not page:
+                if live:
+                    # caught up; no new message can have come in since the last page was read
+                    remaining = None if limit is None else limit - n_sent
+                    # from now on, the hub does most of the work; don't hold up other requests for as long as it lasts
+                    self.release_slots(request)
+                    await self._stream_live(connection, request, feed_id, keys, remaining)
+                    return
+                break
+            with connection.corked():
+                for msg in page:
+                    body = msg.to_dict()
+                    if keys:
+                        body = {'key': msg.key, 'value': body, 'timestamp': msg.timestamp}
+                    connection.send(body, stream=True, req=-request.req)
+            n_sent += len(page)
+            sequence = page[-1].sequence + 1
+            await connection.drain()
+
+        connection.send(True, stream=True, end_err=True, req=-request.req)
+
+    async def _stream_live(self, connection, request, feed_id, keys, limit):
+        if limit == 0:
+            connection.send(True, stream=True, end_err=True, req=-request.req)
+            return
+        subscription = self.hub.subscribe(feed_id, connection, request.req, keys=keys, limit=limit)
+        # the subscription ends along with the connection
+        closed = ensure_future(connection.wait_closed())
+        closed.add_done_callback(lambda f: subscription.close())
+        try:
+            while True:
+                # only messages that were held back because the connection was busy show up here
+                backlog = await subscription.get()
+                if not backlog:
+                    break
+                with connection.corked():
+                    for data in backlog:
+                        connection.send_encoded(data, -request.req, stream=True)
+                await connection.drain()
+        finally:
+            peer_gone = closed.done()
+            closed.cancel()
+            subscription.close()
+
+        if subscription.dropped:
+            raise MuxRPCAPIException('Too slow, dropped from the live stream')
+        if not peer_gone:
+            connection.send(True, stream=True, end_err=True, req=-request.req)
+
+    def blobs_has(self, connection, request):
+        """Reply whether a blob (or, given a list of IDs, each of them) is in ``self.blob_store``."""
+        ids = request.args[0]
+        if isinstance(ids, list):
+            reply = [self.blob_store.has(id_) for id_ in ids]
+        else:
+            reply = self.blob_store.has(ids)
+        connection.send(reply, req=-request.req)
+
+    async def blobs_get(self, connection, request):
+        """Stream a blob from ``self.blob_store``, in ``BUFFER`` frames of the store's chunk size."""
+        args = request.args[0]
+        if isinstance(args, str):
+            args = {'key': args}
+        id_ = args['key']
+        size = self.blob_store.size(id_)
+        if size is None:
+            raise MuxRPCAPIException('Blob not found: {}'.format(id_))
+        if 'size' in args and args['size'] != size:
+            raise MuxRPCAPIException('Blob {} is {} bytes long, not {}'.format(id_, size, args['size']))
+        if 'max' in args and size > args['max']:
+            raise MuxRPCAPIException('Blob {} is larger than {} bytes'.format(id_, args['max']))
+
+        for chunk in self.blob_store.read(id_):
+            connection.send(chunk, msg_type=PSMessageType.BUFFER, stream=True, req=-request.req)
+            await connection.drain()
+        connection.send(True, stream=True, end_err=True, req=-request.req)
+
+    async def blobs_add(self, connection, request):
+        """Store the blob that the caller streams in, checking it against the ID it was announced with (if any).
+
+        Nothing is stored unless the caller ends the stream: if the connection is lost halfway, the data is dropped.
+        """
+        expected_id = request.args[0] if request.args else None
+        with self.blob_store.writer(expected_id) as writer:
+            await request.incoming.write_to(writer)
+            writer.finish()
+        connection.send(True, stream=True, end_err=True, req=-request.req)
+
+    def send_error(self, connection, request, message):
+        """Reply to ``request`` with a MuxRPC error."""
+        connection.send({'name': 'Error', 'message': message, 'stack': ''}, stream=request.stream, end_err=True,
+                        req=-request.req)
+
+    def call(self, name, args, type_='sync', timeout=None, connection=None):
+        if connection is None:
+            connection = self.connection
+        if connection is None or not connection.is_connected:
             raise Exception('not connected')
-        old_counter = self.connection.req_counter
-        ps_handler = self.connection.send({
+        old_counter = connection.req_counter
+        ps_handler = connection.send({
             'name': name.split('.'),
             'args': args,
             'type': type_
-        }, stream=type_ in {'sink', 'source', 'duplex'})
-        return _get_appropriate_api_handler(type_, self.connection, ps_handler, old_counter)
+        }, stream=type_ in {'sink', 'source', 'duplex'}, timeout=timeout)
+        return _get_appropriate_api_handler(type_, connection, ps_handler, old_counter)
@@ -1,18 +1,22 @@
 import logging
 import struct
-from asyncio import Event, Queue
+from asyncio import Event, Queue, ensure_future, get_event_loop, sleep
+from contextlib import contextmanager
 from enum import Enum
+from heapq import heappop, heappush
 from time import time
-from math import ceil
 
-import simplejson
 from async_generator import async_generator, yield_
 
 from secret_handshake import SHSClient, SHSServer
+from ssb import codec
 
 
 logger = logging.getLogger('packet_stream')
 
+# bodies up to this size are written along with their header (SHS boxes hold up to 4096 bytes)
+MAX_INLINE_BODY = 4096 - 9
+
 
 class PSMessageType(Enum):
     BUFFER = 0
@@ -20,33 +24,106 @@ class PSMessageType(Enum):
     JSON = 2
 
 
+class PSTimeoutException(Exception):
+    pass
+
+
 class PSStreamHandler(object):
-    def __init__(self, req):
+    """Queue of the replies to a stream request.
+
+    The queue can be bounded in number of messages (``max_messages``) and/or in bytes of encoded body
+    (``max_bytes``); ``0`` means unbounded. Once it is full, :meth:`process` waits for the consumer to catch up, which
+    in turn stops the :class:`PacketStream` from reading any more data from the connection. That wait ends, and
+    whatever else comes in for the stream is dropped, once the handler is stopped, failed (e.g. timed out) or closed,
+    or its consumer stops iterating over it. While it lasts, the deadline is pushed back every time the consumer takes
+    a message, so that only a consumer that has stalled makes the stream time out.
+
+    ``ended`` tells whether the peer ended the stream itself, rather than it being stopped because the connection
+    went away.
+    """
+
+    def __init__(self, req, timeout=None, max_messages=0, max_bytes=0):
         super(PSStreamHandler).__init__()
         self.req = req
         self.queue = Queue()
+        # for streams, the timeout counts from the last message received
+        self.timeout = timeout
+        self.deadline = None
+
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.queued_messages = 0
+        self.queued_bytes = 0
+        self.high_water_messages = 0
+        self.high_water_bytes = 0
+        self.closed = False
+        self.ended = False
+        self._not_full = Event()
+        self._not_full.set()
+
+    @property
+    def is_full(self):
+        return ((self.max_messages and self.queued_messages >= self.max_messages) or
+                (self.max_bytes and self.queued_bytes >= self.max_bytes))
 
     async def process(self, msg):
+        if msg.end_err:
+            self.ended = True
+        while self.is_full and not self.closed:
+            self._not_full.clear()
+            await self._not_full.wait()
+        if self.closed:
+            return
+        self.queued_messages += 1
+        self.queued_bytes += msg.size
+        self.high_water_messages = max(self.high_water_messages, self.queued_messages)
+        self.high_water_bytes = max(self.high_water_bytes, self.queued_bytes)
         await self.queue.put(msg)
 
+    def close(self):
+        """Stop accepting messages, and let the reader go on if it was waiting for room in the queue."""
+        self.closed = True
+        self._not_full.set()
+
     async def stop(self):
+        self.close()
         await self.queue.put(None)
 
+    async def fail(self, exc):
+        self.close()
+        await self.queue.put(exc)
+
     @async_generator
     async def __aiter__(self):
-        while True:
-            elem = await self.queue.get()
-            if not elem:
-                return
-            await yield_(elem)
+        try:
+            while True:
+                elem = await self.queue.get()
+                if elem is None:
+                    return
+                if isinstance(elem, Exception):
+                    raise elem
+                if self.is_full and self.timeout is not None:
+                    # the reader is waiting for us, not for the peer
+                    self.deadline = get_event_loop().time() + self.timeout
+                self.queued_messages -= 1
+                self.queued_bytes -= elem.size
+                if not self.is_full:
+                    self._not_full.set()
+                await yield_(elem)
+        finally:
+            # nobody is going to read the rest
+            self.close()
 
 
 class PSRequestHandler(object):
-    def __init__(self, req):
+    def __init__(self, req, timeout=None):
         super(PSRequestHandler).__init__()
         self.req = req
         self.event = Event()
+        self.timeout = timeout
+        self.deadline = None
         self._msg = None
+        self._exc = None
 
     async def process(self, msg):
         self._msg = msg
@@ -56,32 +133,86 @@ class PSRequestHandler(object):
         if not self.event.is_set():
             self.event.set()
 
+    async def fail(self, exc):
+        self._exc = exc
+        self.event.set()
+
     def __await__(self):
         # wait until 'process' is called
         yield from self.event.wait().__await__()
+        if self._exc is not None:
+            raise self._exc
         return self._msg
 
 
+# marks a body that hasn't been decoded from the raw data yet
+_UNDECODED = object()
+
+
 class PSMessage(object):
+    __slots__ = ('stream', 'end_err', 'type', 'req', '_body', '_data', '_size')
 
     @classmethod
-    def from_header_body(cls, flags, req, body):
+    def from_header_body(cls, flags, req, body, lazy=False):
+        """Build a message from a packet's header fields and raw body.
+
+        With ``lazy=True``, the raw body is kept as ``data`` and only decoded when ``body`` is first accessed, which
+        saves the parsing and re-encoding of messages that are just relayed or stored.
+        """
         type_ = PSMessageType(flags & 0x03)
 
+        if lazy:
+            return cls.from_data(type_, body, bool(flags & 0x08), bool(flags & 0x04), req=req)
+
+        msg = cls(type_, cls._decode(type_, body), bool(flags & 0x08), bool(flags & 0x04), req=req)
+        msg._size = len(body)
+        return msg
+
+    @classmethod
+    def from_data(cls, type_, data, stream, end_err, req=None):
+        """Build a message from already encoded data, which is only decoded if ``body`` is accessed."""
+        msg = cls(type_, None, stream, end_err, req=req)
+        msg._body, msg._data, msg._size = _UNDECODED, data, len(data)
+        return msg
+
+    @staticmethod
+    def _decode(type_, data):
         if type_ == PSMessageType.TEXT:
-            body = body.decode('utf-8')
+            return str(data, 'utf-8')
         elif type_ == PSMessageType.JSON:
-            body = simplejson.loads(body)
-
-        return cls(type_, body, bool(flags & 0x08), bool(flags & 0x04), req=req)
+            return codec.loads(data)
+        return data
 
     @property
     def data(self):
-        if self.type == PSMessageType.TEXT:
-            return self.body.encode('utf-8')
-        elif self.type == PSMessageType.JSON:
-            return simplejson.dumps(self.body).encode('utf-8')
-        return self.body
+        """The encoded body. It is computed once and cached until ``body`` changes."""
+        if self._data is None:
+            if self.type == PSMessageType.TEXT:
+                self._data = self.body.encode('utf-8')
+            elif self.type == PSMessageType.JSON:
+                self._data = codec.dumps(self.body)
+            else:
+                self._data = self.body
+        return self._data
+
+    @property
+    def size(self):
+        """Length of the encoded body, known without encoding it for messages that were read from the wire."""
+        if self._size is None:
+            self._size = len(self.data)
+        return self._size
+
+    @property
+    def body(self):
+        if self._body is _UNDECODED:
+            self._body = self._decode(self.type, self._data)
+        return self._body
+
+    @body.setter
+    def body(self, value):
+        self._body = value
+        self._data = None
+        self._size = None
 
     def __init__(self, type_, body, stream, end_err, req=None):
         self.stream = stream
@@ -90,6 +221,11 @@ class PSMessage(object):
         self.body = body
         self.req = req
 
+    @property
+    def header(self):
+        return struct.pack('>BIi', (int(self.stream) << 3) | (int(self.end_err) << 2) | self.type.value,
+                           len(self.data), self.req)
+
     def __repr__(self):
         if self.type == PSMessageType.BUFFER:
             body = '{} bytes'.format(len(self.body))
@@ -101,27 +237,148 @@ class PSMessage(object):
 
 
 class PacketStream(object):
-    def __init__(self, connection):
+    """Packet-stream protocol on top of an SHS connection.
+
+    Replies to stream requests are queued in bounded queues if ``max_queued_messages`` or ``max_queued_bytes`` are set
+    (see :class:`PSStreamHandler`). When one is full, reading stops until its consumer catches up.
+
+    Requests that get no reply within their timeout (``timeout`` by default, or the one passed to :meth:`send`) are
+    failed with :class:`PSTimeoutException`.
+
+    With ``lazy=True``, incoming message bodies are only decoded on access (see :meth:`PSMessage.from_header_body`).
+
+    With ``batch=True``, outgoing frames are buffered and written together once ``flush_bytes`` or
+    ``flush_messages`` is reached, or ``flush_delay`` seconds after the first buffered frame, whichever comes first.
+    """
+
+    def __init__(self, connection, batch=False, flush_bytes=64 * 1024, flush_messages=256, flush_delay=0.005,
+                 lazy=False, timeout=None, max_queued_messages=0, max_queued_bytes=0):
         self.connection = connection
+        self.lazy = lazy
+        self.timeout = timeout
+        self.max_queued_messages = max_queued_messages
+        self.max_queued_bytes = max_queued_bytes
+        # highest number of messages/bytes that any stream had in its queue
+        self.high_water_messages = 0
+        self.high_water_bytes = 0
         self.req_counter = 1
         self._event_map = {}
+        self._inbound = Queue()
+        self._reader = None
+        self._closed = Event()
+        # heap of (deadline, req), see _sweep
+        self._deadlines = []
+        self._sweeper = None
+        self.n_timeouts = 0
+        # event loop time of the last message received
+        self.last_received = 0
+        # unconsumed tail of the last chunk returned by the connection
+        self._chunk = memoryview(b'')
+
+        self.batch = batch
+        self.flush_bytes = flush_bytes
+        self.flush_messages = flush_messages
+        self.flush_delay = flush_delay
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._write_buffer_count = 0
+        self._corked = 0
+        self._flush_handle = None
 
     def register_handler(self, handler):
         self._event_map[handler.req] = (time(), handler)
+        if handler.timeout is not None:
+            handler.deadline = get_event_loop().time() + handler.timeout
+            if self._sweeper is not None and handler.deadline < self._deadlines[0][0]:
+                # the sweeper is sleeping until a later deadline
+                self._sweeper.cancel()
+                self._sweeper = None
+            heappush(self._deadlines, (handler.deadline, handler.req))
+            if self._sweeper is None:
+                self._sweeper = ensure_future(self._sweep())
+
+    @property
+    def in_flight(self):
+        """Number of requests that are still waiting for (more) replies."""
+        return len(self._event_map)
+
+    async def _sweep(self):
+        """Fail requests as their deadlines pass.
+
+        Deadlines that get pushed back (streams receiving data) are not updated in the heap; the entry is simply
+        re-queued when it comes up. Entries of requests that are already gone are dropped.
+        """
+        loop = get_event_loop()
+        while self._deadlines:
+            deadline, req = self._deadlines[0]
+            now = loop.time()
+            if deadline > now:
+                await sleep(deadline - now)
+                continue
+            heappop(self._deadlines)
+
+            entry = self._event_map.get(req)
+            if entry is None:
+                continue
+            handler = entry[1]
+            if handler.deadline > now:
+                heappush(self._deadlines, (handler.deadline, req))
+                continue
+
+            del self._event_map[req]
+            self.n_timeouts += 1
+            logger.info('TIMEOUT [%d]', req)
+            await handler.fail(PSTimeoutException('Request {} timed out after {}s'.format(req, handler.timeout)))
+        self._sweeper = None
 
     @property
     def is_connected(self):
-        return self.connection.is_connected
+        # the SHS stream doesn't notice the peer closing it, but the reader does
+        return not self._closed.is_set() and self.connection.is_connected
+
+    def start(self):
+        """Start reading from the connection in a background task.
+
+        The task dispatches replies to their handlers and queues incoming requests for :meth:`__aiter__`, so that
+        every request and stream progresses independently of how fast the others are being consumed. Once it is
+        running, :meth:`read` shouldn't be called directly.
+        """
+        if self._reader is None:
+            self._reader = ensure_future(self._read_loop())
+        return self._reader
+
+    async def _read_loop(self):
+        try:
+            while True:
+                msg = await self.read()
+                if not msg:
+                    break
+                # replies were already dispatched by 'read'
+                if msg.req >= 0:
+                    self._inbound.put_nowait(msg)
+        finally:
+            # nothing else is coming
+            for t, handler in list(self._event_map.values()):
+                await handler.stop()
+            self._event_map.clear()
+            self._inbound.put_nowait(None)
+            self._closed.set()
+
+    async def wait_closed(self):
+        """Wait until the reader task is done, i.e. the connection was closed."""
+        await self._closed.wait()
 
     @async_generator
     async def __aiter__(self):
+        """Iterate over incoming requests (starting the reader task, if needed)."""
+        self.start()
         while True:
-            msg = await self.read()
-            if not msg:
+            msg = await self._inbound.get()
+            if msg is None:
+                # let any other iterators know as well
+                self._inbound.put_nowait(None)
                 return
-            # filter out replies
-            if msg.req >= 0:
-                await yield_(msg)
+            await yield_(msg)
 
     async def __await__(self):
         async for data in self:
@@ -129,21 +386,45 @@ class PacketStream(object):
             if data is None:
                 return
 
+    async def _readinto(self, buf):
+        """Fill ``buf`` with data from the connection.
+
+        Chunks don't need to line up with packet boundaries; whatever is left over from the last chunk is kept
+        for the next call. Returns ``False`` if the connection ran out of data before ``buf`` was full.
+        """
+        view = memoryview(buf)
+        pos, size = 0, len(view)
+        while pos < size:
+            if not self._chunk:
+                chunk = await self.connection.read()
+                if not chunk:
+                    return False
+                self._chunk = memoryview(chunk)
+            n = min(size - pos, len(self._chunk))
+            view[pos:pos + n] = self._chunk[:n]
+            self._chunk = self._chunk[n:]
+            pos += n
+        return True
+
     async def _read(self):
         try:
-            header = await self.connection.read()
-            if not header or header == b'\x00' * 9:
+            header = bytearray(9)
+            if not await self._readinto(header) or header == b'\x00' * 9:
                 return
             flags, length, req = struct.unpack('>BIi', header)
 
-            n_packets = ceil(length / 4096)
-
-            body = b''
-            for n in range(n_packets):
-                body += await self.connection.read()
-
-            logger.debug('READ %s %s', header, len(body))
-            return PSMessage.from_header_body(flags, req, body)
+            if flags & 0x03 == PSMessageType.BUFFER.value and len(self._chunk) >= length:
+                # binary data that is all in the current chunk is used as is, without copying it
+                body = self._chunk[:length]
+                self._chunk = self._chunk[length:]
+            else:
+                # preallocate the whole body, so that chunks are copied into place only once
+                body = bytearray(length)
+                if not await self._readinto(body):
+                    return
+
+            logger.debug('READ %s %s', header, length)
+            return PSMessage.from_header_body(flags, req, body, lazy=self.lazy)
         except StopAsyncIteration:
             logger.debug('DISCONNECT')
             self.connection.disconnect()
@@ -153,47 +434,168 @@ class PacketStream(object):
         msg = await self._read()
         if not msg:
             return None
+        self.last_received = get_event_loop().time()
         # check whether it's a reply and handle accordingly
         if msg.req < 0:
-            t, handler = self._event_map[-msg.req]
+            entry = self._event_map.get(-msg.req)
+            if entry is None:
+                logger.warning('RESPONSE [%d]: no such request (timed out?)', -msg.req)
+                return msg
+            t, handler = entry
+            if handler.timeout is not None:
+                handler.deadline = get_event_loop().time() + handler.timeout
             await handler.process(msg)
-            logger.info('RESPONSE [%d]: %r', -msg.req, msg)
-            if msg.end_err:
+            if self._event_map.get(-msg.req) is not entry:
+                # it was given up on (e.g. timed out) while waiting for room in its queue
+                return msg
+            if isinstance(handler, PSStreamHandler):
+                self.high_water_messages = max(self.high_water_messages, handler.high_water_messages)
+                self.high_water_bytes = max(self.high_water_bytes, handler.high_water_bytes)
+            if logger.isEnabledFor(logging.INFO):
+                logger.info('RESPONSE [%d]: %r', -msg.req, msg)
+            # a request that isn't a stream only gets one reply
+            if msg.end_err or not msg.stream:
                 await handler.stop()
                 del self._event_map[-msg.req]
                 logger.info('RESPONSE [%d]: EOS', -msg.req)
         return msg
 
     def _write(self, msg):
-        logger.info('SEND [%d]: %r', msg.req, msg)
-        header = struct.pack('>BIi', (int(msg.stream) << 3) | (int(msg.end_err) << 2) | msg.type.value, len(msg.data),
-                             msg.req)
-        self.connection.write(header)
-        self.connection.write(msg.data)
-        logger.debug('WRITE HDR: %s', header)
-        logger.debug('WRITE DATA: %s', msg.data)
-
-    def send(self, data, msg_type=PSMessageType.JSON, stream=False, end_err=False, req=None):
-        update_counter = False
-        if req is None:
-            update_counter = True
-            req = self.req_counter
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('SEND [%d]: %r', msg.req, msg)
+        self._write_frame(msg.header, msg.data)
+
+    def _write_frame(self, header, data):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('WRITE HDR: %s', header)
+            logger.debug('WRITE DATA: %s', data)
+
+        if not self.batch and not self._corked:
+            if len(data) > MAX_INLINE_BODY:
+                # large bodies (e.g. blob chunks) are written on their own rather than copied after the header; the box
+                # stream only takes bytes, though, so views and bytearrays still get copied once
+                self.connection.write(header)
+                self.connection.write(data if isinstance(data, bytes) else bytes(data))
+            else:
+                # header and body go out in a single write (and a single box)
+                self.connection.write(header + data)
+            return
+
+        self._write_buffer += (header, data)
+        self._write_buffer_size += len(header) + len(data)
+        self._write_buffer_count += 1
+
+        if self._write_buffer_size >= self.flush_bytes:
+            # full batches are sent even when corked, so that the buffer doesn't grow without limit
+            self.flush()
+        elif self._corked:
+            return
+        elif self._write_buffer_count >= self.flush_messages:
+            self.flush()
+        elif self._flush_handle is None:
+            self._flush_handle = get_event_loop().call_later(self.flush_delay, self.flush)
+
+    def flush(self):
+        """Write all buffered frames to the connection at once."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if not self._write_buffer:
+            return
+        data = b''.join(self._write_buffer)
+        self._write_buffer = []
+        self._write_buffer_size = 0
+        self._write_buffer_count = 0
+        self.connection.write(data)
+
+    def cork(self):
+        """Hold back outgoing frames until the matching :meth:`uncork`."""
+        self._corked += 1
+
+    def uncork(self):
+        self._corked -= 1
+        if not self._corked:
+            self.flush()
+
+    def _stream_writer(self):
+        # SHS connections keep the underlying asyncio.StreamWriter there
+        return getattr(getattr(self.connection, 'write_stream', None), 'writer', None)
 
+    @property
+    def write_buffer_size(self):
+        """Bytes that were written but haven't gone out yet: buffered frames, plus the connection's (or its
+        transport's) write buffer, if it can tell."""
+        size = self._write_buffer_size
+        get_size = getattr(self.connection, 'get_write_buffer_size', None)
+        if get_size is None:
+            transport = getattr(self._stream_writer(), 'transport', None)
+            get_size = getattr(transport, 'get_write_buffer_size', None)
+        if get_size is not None:
+            size += get_size()
+        return size
+
+    async def drain(self):
+        """Flush buffered frames and, if the connection (or its transport) supports it, wait for its write buffer to
+        empty."""
+        self.flush()
+        drain = getattr(self.connection, 'drain', None) or getattr(self._stream_writer(), 'drain', None)
+        if drain is not None:
+            await drain()
+
+    @contextmanager
+    def corked(self):
+        """Context manager version of :meth:`cork`/:meth:`uncork`.
+
+        Use it around bursts of :meth:`send` calls (e.g. a page of stream replies) so that they end up in as few
+        boxes as possible.
+        """
+        self.cork()
+        try:
+            yield self
+        finally:
+            self.uncork()
+
+    def send(self, data, msg_type=PSMessageType.JSON, stream=False, end_err=False, req=None, timeout=None):
+        """Send a message, returning a handler for its replies.
+
+        If ``req`` is given, the message belongs to an existing exchange (a reply, or more data for a stream), so no
+        new handler is registered and ``None`` is returned.
+        """
+        if req is not None:
+            self._write(PSMessage(msg_type, data, stream=stream, end_err=end_err, req=req))
+            return None
+
+        req = self.req_counter
+        self.req_counter += 1
         msg = PSMessage(msg_type, data, stream=stream, end_err=end_err, req=req)
 
         # send request
         self._write(msg)
 
+        if timeout is None:
+            timeout = self.timeout
         if stream:
-            handler = PSStreamHandler(self.req_counter)
+            handler = PSStreamHandler(req, timeout=timeout, max_messages=self.max_queued_messages,
+                                      max_bytes=self.max_queued_bytes)
         else:
-            handler = PSRequestHandler(self.req_counter)
+            handler = PSRequestHandler(req, timeout=timeout)
         self.register_handler(handler)
-
-        if update_counter:
-            self.req_counter += 1
         return handler
 
+    def send_encoded(self, data, req, msg_type=PSMessageType.JSON, stream=False, end_err=False):
+        """Send a reply (or more data for a stream) whose body is already encoded.
+
+        Handy for the same message going out to many peers: it is only encoded once, and only the header is built for
+        each of them.
+        """
+        if logger.isEnabledFor(logging.INFO):
+            logger.info('SEND [%d]: %d bytes', req, len(data))
+        self._write_frame(struct.pack('>BIi', (int(stream) << 3) | (int(end_err) << 2) | msg_type.value, len(data),
+                                      req), data)
+
     def disconnect(self):
-        self._connected = False
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        self.flush()
         self.connection.disconnect()
@@ -0,0 +1,252 @@
+import logging
+import random
+from asyncio import (CancelledError, IncompleteReadError, TimeoutError, ensure_future, get_event_loop, shield, sleep,
+                     wait_for)
+
+from secret_handshake.network import SHSClient, SHSClientException
+
+from ssb.packet_stream import PacketStream
+
+
+logger = logging.getLogger('peers')
+
+
+class PeerPoolException(Exception):
+    pass
+
+
+class Peer(object):
+    """A peer's address and public key, and the state of the connection to it (see :class:`PeerPool`)."""
+
+    def __init__(self, host, port, key, keep=False):
+        self.host = host
+        self.port = port
+        self.key = key
+        self.keep = keep
+        self.connection = None
+        self._last_used = 0
+        self.failures = 0
+        self.retry_at = 0
+        self._opening = None
+        self._task = None
+
+    @property
+    def is_connected(self):
+        return self.connection is not None and self.connection.is_connected
+
+    @property
+    def last_used(self):
+        """When the peer was last asked for (see :meth:`PeerPool.get`), or last sent us anything."""
+        if self.connection is None:
+            return self._last_used
+        return max(self._last_used, self.connection.last_received)
+
+    @last_used.setter
+    def last_used(self, value):
+        self._last_used = value
+
+    @property
+    def is_idle(self):
+        """Whether the peer isn't kept, and none of our requests to it is in flight (the pool also checks for requests
+        coming the other way)."""
+        return not self.keep and (self.connection is None or not self.connection.in_flight)
+
+    def __repr__(self):
+        return '<Peer {0.host}:{0.port}>'.format(self)
+
+
+class PeerPool(object):
+    """Keeps one connection (a :class:`ssb.packet_stream.PacketStream` over an ``SHSClient``) open per peer, shared by
+    everything that talks to it.
+
+    :meth:`get` returns the peer's connection, opening it first if needed; callers that ask for a peer while its
+    handshake is under way all wait for that same handshake. Every connection is served by ``api``, and can be passed
+    to :meth:`ssb.muxrpc.MuxRPCAPI.call`.
+
+    A handshake that takes longer than ``handshake_timeout`` seconds counts as a failed attempt. After a failed
+    attempt, a peer isn't retried before a backoff delay has passed: ``backoff`` seconds, doubled on
+    every failure up to ``max_backoff``, and jittered (somewhere between half and all of it) so that peers that went
+    down together don't all come back at once. Peers added with ``keep=True`` are reconnected as soon as they
+    drop.
+
+    At most ``max_peers`` connections are open (or being opened) at a time; to open another one, the least recently
+    used idle peer (not kept, no requests in flight either way) is closed. Peers that stay idle for ``idle_timeout``
+    seconds (not asked for, and not sending anything) are closed as well.
+    """
+
+    def __init__(self, api, keypair, max_peers=32, idle_timeout=300, backoff=1, max_backoff=60, stream_options=None,
+                 client_factory=SHSClient, handshake_timeout=10):
+        self.api = api
+        self.keypair = keypair
+        self.max_peers = max_peers
+        self.idle_timeout = idle_timeout
+        self.handshake_timeout = handshake_timeout
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.stream_options = stream_options or {}
+        self.client_factory = client_factory
+        # public key -> peer
+        self.peers = {}
+        self.n_handshakes = 0
+        # peers whose handshake is under way (past _make_room)
+        self._handshaking = set()
+        self._sweeper = None
+        self._closed = False
+
+    def add(self, host, port, key, keep=False):
+        """Register a peer (or update its address), returning its :class:`Peer`. Kept peers are connected right away."""
+        peer = self.peers.get(key)
+        if peer is None:
+            peer = self.peers[key] = Peer(host, port, key, keep=keep)
+        else:
+            peer.host, peer.port = host, port
+            peer.keep = peer.keep or keep
+        if keep and not peer.is_connected and peer._task is None:
+            peer._task = ensure_future(self._reconnect(peer))
+        return peer
+
+    def remove(self, key):
+        peer = self.peers.pop(key, None)
+        if peer is not None:
+            peer.keep = False
+            self._close(peer)
+
+    @property
+    def connected(self):
+        return [peer for peer in self.peers.values() if peer.is_connected]
+
+    def _is_idle(self, peer):
+        # neither our requests to the peer nor its requests to us are in flight
+        return peer.is_idle and (peer.connection is None or not self.api.n_tasks(peer.connection))
+
+    def _delay(self, failures):
+        delay = min(self.max_backoff, self.backoff * 2 ** (failures - 1))
+        return random.uniform(delay / 2, delay)
+
+    async def get(self, key):
+        """Return an open connection to the peer with public ``key`` (see :meth:`add`).
+
+        Raises :class:`PeerPoolException` if the peer can't be reached, if ``max_peers`` connections are open and
+        none of them is idle, or if the pool is (or gets) closed.
+        """
+        if self._closed:
+            raise PeerPoolException('The pool is closed')
+        peer = self.peers.get(key)
+        if peer is None:
+            raise PeerPoolException('Unknown peer: {}'.format(key))
+        peer.last_used = get_event_loop().time()
+        if peer.is_connected:
+            return peer.connection
+
+        if peer._opening is None:
+            peer._opening = ensure_future(self._open(peer))
+            peer._opening.add_done_callback(lambda f: setattr(peer, '_opening', None))
+        opening = peer._opening
+        try:
+            # one caller giving up doesn't cancel the handshake for the others
+            return await shield(opening)
+        except CancelledError:
+            if opening.cancelled():
+                # by close()
+                raise PeerPoolException('The pool is closed') from None
+            raise
+
+    async def _open(self, peer):
+        wait = peer.retry_at - get_event_loop().time()
+        if wait > 0:
+            await sleep(wait)
+        if self._closed:
+            raise PeerPoolException('The pool is closed')
+        self._make_room(peer)
+
+        client = self.client_factory(peer.host, peer.port, self.keypair, peer.key)
+        self.n_handshakes += 1
+        self._handshaking.add(peer)
+        try:
+            await wait_for(client.open(), self.handshake_timeout)
+        except (OSError, IncompleteReadError, SHSClientException, TimeoutError) as e:
+            reason = e
+            if isinstance(e, TimeoutError):
+                reason = 'handshake timed out after {}s'.format(self.handshake_timeout)
+            peer.failures += 1
+            delay = self._delay(peer.failures)
+            peer.retry_at = get_event_loop().time() + delay
+            logger.warning('Could not connect to %s (%s), next attempt in %.1fs', peer, reason, delay)
+            raise PeerPoolException('Could not connect to {}: {}'.format(peer, reason)) from e
+        finally:
+            self._handshaking.discard(peer)
+
+        peer.failures = 0
+        peer.connection = connection = PacketStream(client, **self.stream_options)
+        peer.last_used = get_event_loop().time()
+        ensure_future(self._serve(peer, connection))
+        if self._sweeper is None and self.idle_timeout:
+            self._sweeper = ensure_future(self._sweep())
+        return connection
+
+    def _make_room(self, peer):
+        # handshakes under way take up room too, but can't be closed to make more
+        opening = [other for other in self._handshaking if other is not peer]
+        connected = [other for other in self.peers.values() if other.is_connected and other is not peer]
+        if len(connected) + len(opening) < self.max_peers:
+            return
+        idle = [other for other in connected if self._is_idle(other)]
+        if not idle:
+            raise PeerPoolException('Too many open connections ({})'.format(len(connected) + len(opening)))
+        victim = min(idle, key=lambda other: other.last_used)
+        logger.info('Closing %s to make room for %s', victim, peer)
+        self._close(victim)
+
+    async def _serve(self, peer, connection):
+        try:
+            await self.api.serve(connection)
+        finally:
+            if peer.connection is connection:
+                peer.connection = None
+            if peer.keep and not self._closed and peer._task is None and self.peers.get(peer.key) is peer:
+                peer._task = ensure_future(self._reconnect(peer))
+
+    async def _reconnect(self, peer):
+        try:
+            while peer.keep and not self._closed and not peer.is_connected:
+                try:
+                    await self.get(peer.key)
+                except PeerPoolException:
+                    if peer.retry_at <= get_event_loop().time():
+                        # there was no room for it, rather than a failed attempt
+                        await sleep(self._delay(max(peer.failures, 1)))
+        finally:
+            peer._task = None
+
+    def _close(self, peer):
+        if peer.connection is not None:
+            connection, peer.connection = peer.connection, None
+            connection.disconnect()
+
+    def evict_idle(self):
+        """Close the connections that haven't been asked for (see :meth:`get`) nor received anything in
+        ``idle_timeout`` seconds, and have no requests in flight either way."""
+        deadline = get_event_loop().time() - self.idle_timeout
+        for peer in list(self.peers.values()):
+            if peer.is_connected and self._is_idle(peer) and peer.last_used <= deadline:
+                logger.info('Closing idle %s', peer)
+                self._close(peer)
+
+    async def _sweep(self):
+        while any(peer.is_connected for peer in self.peers.values()):
+            await sleep(self.idle_timeout / 2)
+            self.evict_idle()
+        self._sweeper = None
+
+    def close(self):
+        """Close every connection, and stop reconnecting. Handshakes that are under way are given up on."""
+        self._closed = True
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+        for peer in self.peers.values():
+            if peer._task is not None:
+                peer._task.cancel()
+            if peer._opening is not None:
+                peer._opening.cancel()
+            self._close(peer)
@@ -0,0 +1,10 @@
+import pytest
+
+from .test_packet_stream import MockPipeNetwork
+
+
+@pytest.fixture
+async def pipe_network():
+    network = MockPipeNetwork()
+    yield network
+    await network.close()
@@ -0,0 +1,225 @@
+import os
+from asyncio import ensure_future, gather, sleep, wait_for
+from io import BytesIO
+from hashlib import sha256
+
+import pytest
+
+from ssb.blobs import BlobStore, BlobTooLargeException, InvalidBlobException, blob_id
+from ssb.muxrpc import MuxRPCAPI
+from ssb.packet_stream import PacketStream, PSMessage, PSMessageType
+
+from .test_muxrpc import _frame
+from .test_packet_stream import MockSHSClient, MockSHSPipe, MockSHSServer
+
+DATA = os.urandom(100 * 1024)
+DATA_ID = blob_id(sha256(DATA).digest())
+
+
+def _buffer_frame(data, req, end_err=False):
+    msg = PSMessage(PSMessageType.BUFFER, data, stream=True, end_err=end_err, req=req)
+    return msg.header + msg.data
+
+
+def _parse_frames(data):
+    messages = []
+    while data:
+        header, data = data[:9], data[9:]
+        length = int.from_bytes(header[1:5], 'big')
+        messages.append(PSMessage.from_header_body(header[0], int.from_bytes(header[5:9], 'big', signed=True),
+                                                   data[:length]))
+        data = data[length:]
+    return messages
+
+
+@pytest.fixture
+def blob_store(tmpdir):
+    return BlobStore(str(tmpdir.join('blobs')), max_size=len(DATA), chunk_size=16 * 1024)
+
+
+def test_add_read(blob_store):
+    assert not blob_store.has(DATA_ID)
+    assert blob_store.size(DATA_ID) is None
+
+    assert blob_store.add([DATA[:1000], DATA[1000:]]) == DATA_ID
+    assert DATA_ID in blob_store
+    assert blob_store.size(DATA_ID) == len(DATA)
+
+    chunks = list(blob_store.read(DATA_ID))
+    assert [len(chunk) for chunk in chunks] == [16 * 1024] * 6 + [4 * 1024]
+    assert all(isinstance(chunk, memoryview) for chunk in chunks)
+    assert b''.join(chunks) == DATA
+
+
+def test_add_invalid(blob_store):
+    with pytest.raises(InvalidBlobException):
+        blob_store.add(DATA[:-1], expected_id=DATA_ID)
+    with pytest.raises(BlobTooLargeException):
+        blob_store.add([DATA, b'!'])
+    with pytest.raises(InvalidBlobException):
+        blob_store.has('&foo.sha256')
+
+    # nothing is left behind
+    assert os.listdir(blob_store.path) == []
+
+
+@pytest.mark.asyncio
+async def test_blobs_get_has(blob_store):
+    blob_store.add(DATA)
+    api = MuxRPCAPI(blob_store=blob_store)
+
+    socket = MockSHSServer()
+    socket.listen()
+    missing_id = blob_id(b'\x00' * 32)
+    socket.feed([_frame({'name': ['blobs', 'has'], 'args': [DATA_ID], 'type': 'async'}, req=1),
+                 _frame({'name': ['blobs', 'has'], 'args': [[DATA_ID, missing_id]], 'type': 'async'}, req=2),
+                 _frame({'name': ['blobs', 'get'], 'args': [DATA_ID], 'type': 'source'}, req=3, stream=True),
+                 _frame({'name': ['blobs', 'get'], 'args': [missing_id], 'type': 'source'}, req=4, stream=True),
+                 _frame({'name': ['blobs', 'get'], 'args': [{'key': DATA_ID, 'max': 10}], 'type': 'source'},
+                        req=5, stream=True)])
+    await api.serve(PacketStream(socket))
+
+    replies = {}
+    for msg in _parse_frames(b''.join(socket.get_output())):
+        replies.setdefault(msg.req, []).append(msg)
+
+    assert replies[-1][0].body is True
+    assert replies[-2][0].body == [True, False]
+
+    chunks = replies[-3]
+    assert all(msg.type == PSMessageType.BUFFER for msg in chunks[:-1])
+    assert b''.join(msg.body for msg in chunks[:-1]) == DATA
+    assert chunks[-1].body is True and chunks[-1].end_err
+
+    for req in (-4, -5):
+        assert replies[req][0].body['name'] == 'Error'
+        assert replies[req][0].end_err
+
+
+@pytest.mark.asyncio
+async def test_blobs_get_abort(blob_store):
+    blob_store.add(DATA)
+    api = MuxRPCAPI(blob_store=blob_store)
+
+    socket = MockSHSServer()
+    socket.listen()
+    # the caller changes its mind right away
+    socket.feed([_frame({'name': ['blobs', 'get'], 'args': [DATA_ID], 'type': 'source'}, req=1, stream=True),
+                 _frame(True, req=1, stream=True, end_err=True)])
+    await api.serve(PacketStream(socket))
+
+    replies = _parse_frames(b''.join(socket.get_output()))
+    assert [(msg.req, msg.body, msg.end_err) for msg in replies] == [(-1, True, True)]
+
+
+@pytest.mark.asyncio
+async def test_blobs_add(blob_store):
+    api = MuxRPCAPI(blob_store=blob_store)
+
+    socket = MockSHSServer()
+    socket.listen()
+    socket.feed([_frame({'name': ['blobs', 'add'], 'args': [DATA_ID], 'type': 'sink'}, req=1, stream=True)] +
+                [_buffer_frame(DATA[n:n + 10000], req=1) for n in range(0, len(DATA), 10000)] +
+                [_frame(True, req=1, stream=True, end_err=True)])
+    await api.serve(PacketStream(socket))
+
+    assert [(msg.req, msg.body) for msg in _parse_frames(b''.join(socket.get_output()))] == [(-1, True)]
+    assert b''.join(blob_store.read(DATA_ID)) == DATA
+
+
+@pytest.mark.asyncio
+async def test_blobs_add_task_limit(blob_store):
+    api = MuxRPCAPI(blob_store=blob_store, max_tasks_per_connection=1)
+
+    socket = MockSHSServer()
+    socket.listen()
+    # another request comes in before the data, while blobs.add holds the only slot
+    socket.feed([_frame({'name': ['blobs', 'add'], 'args': [DATA_ID], 'type': 'sink'}, req=1, stream=True),
+                 _frame({'name': ['blobs', 'get'], 'args': [DATA_ID], 'type': 'source'}, req=2, stream=True)] +
+                [_buffer_frame(DATA[n:n + 10000], req=1) for n in range(0, len(DATA), 10000)] +
+                [_frame(True, req=1, stream=True, end_err=True)])
+    await wait_for(api.serve(PacketStream(socket)), 1)
+
+    replies = _parse_frames(b''.join(socket.get_output()))
+    assert [(msg.req, msg.body) for msg in replies if msg.req == -1] == [(-1, True)]
+    assert b''.join(bytes(msg.body) for msg in replies if msg.req == -2 and not msg.end_err) == DATA
+
+
+@pytest.mark.asyncio
+async def test_blobs_add_cut_short(blob_store):
+    api = MuxRPCAPI(blob_store=blob_store)
+
+    socket = MockSHSServer()
+    socket.listen()
+    # the connection is lost before the stream ends
+    socket.feed([_frame({'name': ['blobs', 'add'], 'args': [], 'type': 'sink'}, req=1, stream=True),
+                 _buffer_frame(DATA[:10000], req=1)])
+    await api.serve(PacketStream(socket))
+
+    assert not blob_store.has(blob_id(sha256(DATA[:10000]).digest()))
+    assert os.listdir(blob_store.path) == []
+
+
+@pytest.mark.asyncio
+async def test_fetch(blob_store):
+    api = MuxRPCAPI()
+    socket = MockSHSClient()
+    await socket.connect()
+    connection = PacketStream(socket)
+    api.add_connection(connection)
+    socket.feed([_buffer_frame(DATA[n:n + 4096], req=-1) for n in range(0, len(DATA), 4096)] +
+                [_frame(True, req=-1, stream=True, end_err=True)])
+
+    result, _ = await gather(blob_store.fetch(api, DATA_ID), api.serve(connection))
+    assert result == DATA_ID
+    assert b''.join(blob_store.read(DATA_ID)) == DATA
+
+
+@pytest.mark.asyncio
+async def test_fetch_abort(blob_store):
+    api = MuxRPCAPI()
+    socket = MockSHSClient()
+    await socket.connect()
+    connection = PacketStream(socket)
+    api.add_connection(connection)
+    # the peer sends more than it announced
+    socket.feed([_buffer_frame(DATA[n:n + 4096], req=-1) for n in range(0, len(DATA), 4096)] +
+                [_frame(True, req=-1, stream=True, end_err=True)])
+
+    with pytest.raises(BlobTooLargeException):
+        await gather(blob_store.fetch(api, DATA_ID, size=10000), api.serve(connection))
+
+    request, abort = _parse_frames(b''.join(socket.get_output()))
+    assert request.body['args'] == [{'key': DATA_ID, 'max': 10000, 'size': 10000}]
+    assert (abort.req, abort.body, abort.end_err) == (1, True, True)
+    assert not blob_store.has(DATA_ID)
+    assert os.listdir(blob_store.path) == []
+
+
+@pytest.mark.asyncio
+async def test_send_file_readinto(blob_store):
+    server_api, client_api = MuxRPCAPI(blob_store=blob_store), MuxRPCAPI()
+    a, b = MockSHSPipe.pair()
+    server, client = PacketStream(a), PacketStream(b)
+    tasks = [ensure_future(server_api.serve(server)), ensure_future(client_api.serve(client))]
+
+    sink = client_api.call('blobs.add', [DATA_ID], 'sink', connection=client)
+    assert await sink.send_file(BytesIO(DATA), chunk_size=10000) == len(DATA)
+    while not blob_store.has(DATA_ID):
+        await sleep(0.01)
+
+    source = client_api.call('blobs.get', [DATA_ID], 'source', connection=client)
+    buf = bytearray(len(DATA))
+    view = memoryview(buf)
+    pos = 0
+    while True:
+        # reads never go past the end of a message
+        n = await source.readinto(view[pos:pos + 3000])
+        if not n:
+            break
+        assert n <= 3000
+        pos += n
+    assert pos == len(DATA) and buf == DATA
+
+    a.disconnect()
+    await gather(*tasks)
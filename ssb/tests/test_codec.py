@@ -0,0 +1,120 @@
+from collections import OrderedDict
+
+import pytest
+
+from ssb import codec
+from ssb.codec import CodecException, available_codecs, set_codec
+
+
+SAMPLE = OrderedDict([
+    ('previous', None),
+    ('sequence', 12),
+    ('content', OrderedDict([
+        ('type', 'post'),
+        ('text', 'café \U0001f680 / "quoted" \\ \x1f\n\t'),
+        ('mentions', []),
+        ('meta', {}),
+        ('ratio', 0.5),
+        ('big', 2 ** 70),
+        ('ok', True)
+    ]))
+])
+
+# what JSON.stringify(SAMPLE, null, 2) produces
+SAMPLE_CANONICAL = '''{
+  "previous": null,
+  "sequence": 12,
+  "content": {
+    "type": "post",
+    "text": "café \U0001f680 / \\"quoted\\" \\\\ \\u001f\\n\\t",
+    "mentions": [],
+    "meta": {},
+    "ratio": 0.5,
+    "big": 1180591620717411303424,
+    "ok": true
+  }
+}'''.encode('utf-8')
+
+# what JSON.stringify(SAMPLE) produces
+SAMPLE_COMPACT = ('{"previous":null,"sequence":12,"content":{"type":"post","text":"café \U0001f680 / \\"quoted\\" '
+                  '\\\\ \\u001f\\n\\t","mentions":[],"meta":{},"ratio":0.5,"big":1180591620717411303424,"ok":true}}'
+                  ).encode('utf-8')
+
+
+FLOATS = OrderedDict([
+    ('big', 1e21),
+    ('small', 1e-7),
+    ('tenth', 0.1),
+    ('zero', -0.0),
+    ('nested', [1.5e-7, 0.00001, 1e16, -123.456, 2.5e300, 1496696699331.0, float('nan')]),
+    ('int', 1)
+])
+
+# what JSON.stringify(FLOATS, null, 2) produces
+FLOATS_CANONICAL = b'''{
+  "big": 1e+21,
+  "small": 1e-7,
+  "tenth": 0.1,
+  "zero": 0,
+  "nested": [
+    1.5e-7,
+    0.00001,
+    10000000000000000,
+    -123.456,
+    2.5e+300,
+    1496696699331,
+    null
+  ],
+  "int": 1
+}'''
+
+
+@pytest.fixture(params=available_codecs())
+def json_codec(request):
+    old_codec = codec.get_codec()
+    set_codec(request.param)
+    yield codec.get_codec()
+    set_codec(old_codec)
+
+
+def test_canonical(json_codec):
+    assert codec.dumps_canonical(SAMPLE) == SAMPLE_CANONICAL
+
+
+def test_compact(json_codec):
+    assert codec.dumps(SAMPLE) == SAMPLE_COMPACT
+
+
+def test_floats(json_codec):
+    # canonical forms write numbers the way JavaScript does, whatever the backend
+    assert codec.dumps_canonical(FLOATS) == FLOATS_CANONICAL
+    assert codec.dumps_canonical({'content': {'n': 1e21}}) == b'{\n  "content": {\n    "n": 1e+21\n  }\n}'
+
+    # on the wire, only the values have to be the same
+    values = OrderedDict((key, value) for key, value in FLOATS.items() if key != 'nested')
+    assert codec.loads(codec.dumps(values)) == values
+
+
+def test_loads(json_codec):
+    for data in (SAMPLE_COMPACT, bytearray(SAMPLE_COMPACT), memoryview(SAMPLE_COMPACT)):
+        obj = codec.loads(data)
+        assert obj == SAMPLE
+        # key order must be kept, as the canonical form depends on it
+        assert list(obj) == ['previous', 'sequence', 'content']
+        assert list(obj['content'])[:3] == ['type', 'text', 'mentions']
+        if json_codec.name in {'json', 'simplejson'}:
+            # plain dicts only keep their order from Python 3.6 on
+            assert isinstance(obj, OrderedDict) and isinstance(obj['content'], OrderedDict)
+
+
+def test_set_codec():
+    assert 'json' in available_codecs()
+
+    with pytest.raises(CodecException):
+        set_codec('foo')
+
+    old_codec = codec.get_codec()
+    json_codec = codec.JSONCodec()
+    set_codec(json_codec)
+    assert codec.get_codec() is json_codec
+    set_codec(old_codec)
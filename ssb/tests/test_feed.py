@@ -1,10 +1,15 @@
 from base64 import b64decode
 from collections import OrderedDict
+from hashlib import sha256
+
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from nacl.signing import SigningKey, VerifyKey
 
-from ssb.feed import LocalMessage, LocalFeed, Feed, Message, NoPrivateKeyException
+from ssb import codec
+from ssb.feed import (LocalMessage, LocalFeed, Feed, Message, NoPrivateKeyException, NoStoreException,
+                      InvalidMessageException, InvalidSignatureException, models, verify_messages)
 
 
 SERIALIZED_M1 = b"""{
@@ -81,7 +86,7 @@ def test_local_message(local_feed):
         ('description', 'Dude with big jaw')
     ]), previous=m1, timestamp=1495706447426)
     assert m2.timestamp == 1495706447426
-    assert m2.previous is m1
+    assert m2.previous == m1.key
     assert m2.sequence == 2
     assert m2.signature == \
         '3SY85LX6/ppOfP4SbfwZbKfd6DccbLRiB13pwpzbSK0nU52OEJxOqcJ2Uensr6RkrWztWLIq90sNOn1zRAoOAw==.sig.ed25519'
@@ -110,10 +115,11 @@ def test_remote_message(remote_feed):
         ('description', 'Dude with big jaw')
     ]), signature, previous=m1, timestamp=1495706447426)
     assert m2.timestamp == 1495706447426
-    assert m2.previous is m1
+    assert m2.previous == m1.key
     assert m2.sequence == 2
     assert m2.signature == signature
-    m2.verify(signature)
+    assert m2.verify(signature)
+    assert not m2.verify('foo')
     assert m2.key == '%nx13uks5GUwuKJC49PfYGMS/1pgGTtwwdWT7kbVaroM=.sha256'
 
 
@@ -147,3 +153,138 @@ def test_parse(local_feed):
         'description': 'The Chosen One'
     }
     assert m1.timestamp == 1495706260190
+
+
+def test_cached_hash(local_feed, mocker):
+    mocker.patch('ssb.feed.models.sha256', wraps=sha256)
+
+    m1 = LocalMessage(local_feed, OrderedDict([
+        ('type', 'about'),
+        ('about', local_feed.id),
+        ('name', 'neo'),
+        ('description', 'The Chosen One')
+    ]), timestamp=1495706260190)
+    m2 = LocalMessage(local_feed, OrderedDict([('type', 'post'), ('text', 'Hello')]), previous=m1)
+    assert models.sha256.call_count == 1
+
+    assert m1.key == '%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256'
+    assert m1.key == '%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256'
+    m2.key
+    m2.serialize()
+    # m2 uses the key that was already computed for m1
+    assert models.sha256.call_count == 2
+
+    m1.content = OrderedDict([('type', 'post'), ('text', 'Changed')])
+    assert m1.key != '%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256'
+    assert models.sha256.call_count == 3
+
+
+def test_feed_tip(local_feed, remote_feed):
+    assert local_feed.tip is None
+    assert local_feed.sequence == 0
+
+    m1 = local_feed.publish(OrderedDict([
+        ('type', 'about'),
+        ('about', local_feed.id),
+        ('name', 'neo'),
+        ('description', 'The Chosen One')
+    ]), timestamp=1495706260190)
+    m2 = local_feed.publish(OrderedDict([
+        ('type', 'about'),
+        ('about', local_feed.id),
+        ('name', 'morpheus'),
+        ('description', 'Dude with big jaw')
+    ]), timestamp=1495706447426)
+
+    assert m1.key == '%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256'
+    assert m2.key == '%nx13uks5GUwuKJC49PfYGMS/1pgGTtwwdWT7kbVaroM=.sha256'
+    assert (m2.previous, m2.sequence) == (m1.key, 2)
+    assert (local_feed.tip, local_feed.sequence) == (m2.key, 2)
+
+    # the remote copy of the feed can be followed without the messages themselves
+    remote_feed.append(Message(remote_feed, m1.content, m1.signature, timestamp=m1.timestamp))
+    with pytest.raises(InvalidMessageException):
+        remote_feed.append(Message(remote_feed, m1.content, m1.signature, timestamp=m1.timestamp))
+    with pytest.raises(InvalidMessageException):
+        remote_feed.append(Message(remote_feed, m2.content, m2.signature, sequence=2, previous='%foo.sha256',
+                                   timestamp=m2.timestamp))
+    remote_feed.append(Message(remote_feed, m2.content, m2.signature, sequence=2, previous=m1.key,
+                               timestamp=m2.timestamp))
+    assert (remote_feed.tip, remote_feed.sequence) == (m2.key, 2)
+
+    # ...but then, they can't be looked up
+    with pytest.raises(NoStoreException):
+        remote_feed.get(1)
+    with pytest.raises(NoStoreException):
+        remote_feed.history()
+
+
+def test_verify(local_feed, remote_feed):
+    m1 = local_feed.publish(OrderedDict([('type', 'post'), ('text', 'Hello')]))
+    assert m1.verify()
+
+    forged = Message(remote_feed, OrderedDict([('type', 'post'), ('text', 'Bye')]), m1.signature,
+                     timestamp=m1.timestamp)
+    assert not forged.verify()
+    assert not Message(remote_feed, m1.content, 'foo', timestamp=m1.timestamp).verify()
+    assert not Message(remote_feed, m1.content, '!!!.sig.ed25519', timestamp=m1.timestamp).verify()
+
+    # a message signed by someone else
+    other_feed = LocalFeed(SigningKey.generate())
+    other = Message(remote_feed, m1.content, other_feed.publish(m1.content, timestamp=m1.timestamp).signature,
+                    timestamp=m1.timestamp)
+    assert not other.verify()
+
+
+def test_parse_remote(remote_feed):
+    m1 = Message.parse(SERIALIZED_M1, remote_feed)
+    assert m1.key == '%xRDqws/TrQmOd4aEwZ32jdLhP873ZKjIgHlggPR0eoo=.sha256'
+    assert m1.serialize() == SERIALIZED_M1
+
+    with pytest.raises(InvalidSignatureException):
+        Message.parse(SERIALIZED_M1.replace(b'neo', b'trinity'), remote_feed)
+
+    # not checking the signature
+    m1 = Message.parse(SERIALIZED_M1.replace(b'neo', b'trinity'), remote_feed, verify=False)
+    assert m1.content['name'] == 'trinity'
+
+    with pytest.raises(InvalidMessageException):
+        Message.parse(SERIALIZED_M1, Feed(SigningKey.generate().verify_key))
+
+
+@pytest.mark.parametrize('executor', [None, ThreadPoolExecutor(4)])
+def test_verify_messages(local_feed, remote_feed, executor):
+    messages = []
+    for n in range(200):
+        msg = local_feed.publish({'type': 'post', 'text': str(n)})
+        text = 'forged' if n % 7 == 0 else str(n)
+        messages.append(Message(remote_feed, {'type': 'post', 'text': text}, msg.signature, sequence=msg.sequence,
+                                previous=msg.previous, timestamp=msg.timestamp))
+
+    assert verify_messages(messages, executor=executor, chunk_size=16) == [n % 7 != 0 for n in range(200)]
+
+
+def test_signed_serialization(local_feed):
+    for content in ({'type': 'post', 'text': 'Olá, "mundo" \\o/ ✨'}, {'type': 'vote', 'vote': {'value': 1}}, {}):
+        msg = local_feed.publish(content)
+        # built from the unsigned form when signing
+        assert msg.serialize() == codec.dumps_canonical(msg.to_dict())
+        assert Message.parse(msg.serialize(), local_feed).key == msg.key
+
+
+def test_publish_many(local_feed, mocker):
+    m1 = local_feed.publish({'type': 'post', 'text': 'First'})
+
+    store = mocker.Mock()
+    local_feed.store = store
+    messages = local_feed.publish_many([{'type': 'post', 'text': str(n)} for n in range(5)],
+                                       timestamps=[1495706260190 + n for n in range(5)])
+    store.append_many.assert_called_once_with(messages)
+    assert local_feed.publish_many([]) == []
+    assert store.append_many.call_count == 1
+
+    assert [msg.sequence for msg in messages] == [2, 3, 4, 5, 6]
+    assert [msg.previous for msg in messages] == [m1.key] + [msg.key for msg in messages[:-1]]
+    assert [msg.timestamp for msg in messages] == [1495706260190 + n for n in range(5)]
+    assert all(msg.verify() for msg in messages)
+    assert (local_feed.tip, local_feed.sequence) == (messages[-1].key, 6)
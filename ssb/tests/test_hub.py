@@ -0,0 +1,183 @@
+from asyncio import ensure_future, sleep
+
+import pytest
+from nacl.signing import SigningKey
+
+from ssb import codec
+from ssb.feed import LocalFeed
+from ssb.feed.hub import LiveHub
+from ssb.feed.store import LogStore
+from ssb.muxrpc import MuxRPCAPI
+from ssb.packet_stream import PacketStream
+
+from .test_muxrpc import QueueSHSServer, _history_request, _parse_frames
+
+
+class BusySHSServer(QueueSHSServer):
+    """A socket whose write buffer can be made to look full."""
+
+    buffered = 0
+
+    def get_write_buffer_size(self):
+        return self.buffered
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = LogStore(str(tmpdir.join('log.offset')))
+    yield store
+    store.close()
+
+
+def _replies(socket):
+    replies = {}
+    for req, body in _parse_frames(b''.join(socket.get_output())):
+        replies.setdefault(req, []).append(body)
+    return replies
+
+
+def test_publish(store, mocker):
+    hub = LiveHub()
+    store.listeners.append(hub.publish)
+    feed = LocalFeed(SigningKey.generate(), store=store)
+    other_feed = LocalFeed(SigningKey.generate(), store=store)
+
+    socket = BusySHSServer()
+    connection = PacketStream(socket)
+    subscriptions = [hub.subscribe(feed.id, connection, n + 1, keys=bool(n % 2)) for n in range(10)]
+    hub.subscribe(other_feed.id, connection, 11)
+    assert hub.subscribers(feed.id) == 10
+
+    dumps = mocker.spy(codec, 'dumps')
+    msg = feed.publish({'type': 'post', 'text': 'Hello'})
+    # once with keys, once without
+    assert dumps.call_count == 2
+
+    replies = _replies(socket)
+    assert sorted(replies) == [-(n + 1) for n in reversed(range(10))]
+    for n in range(10):
+        if n % 2:
+            assert replies[-(n + 1)] == [{'key': msg.key, 'value': msg.to_dict(), 'timestamp': msg.timestamp}]
+        else:
+            assert replies[-(n + 1)] == [msg.to_dict()]
+
+    subscriptions[0].close()
+    assert hub.subscribers(feed.id) == 9
+    feed.publish({'type': 'post', 'text': 'Hello again'})
+    assert -1 not in _replies(socket)
+
+
+@pytest.mark.asyncio
+async def test_slow_subscribers(store):
+    for policy, dropped in (('drop', True), ('buffer', False)):
+        hub = LiveHub(max_buffered=1000, max_queued=10, slow_policy=policy)
+        store.listeners[:] = [hub.publish]
+        feed = LocalFeed(SigningKey.generate(), store=store)
+        fast_socket, slow_socket = BusySHSServer(), BusySHSServer()
+        fast = hub.subscribe(feed.id, PacketStream(fast_socket), 1)
+        slow = hub.subscribe(feed.id, PacketStream(slow_socket), 1)
+
+        slow_socket.buffered = 2000
+        for n in range(5):
+            feed.publish({'type': 'post', 'text': str(n)})
+
+        assert len(_replies(fast_socket)[-1]) == 5
+        assert list(slow_socket.get_output()) == []
+        assert fast.queued == 0
+        assert slow.dropped is dropped
+        assert hub.n_dropped == int(dropped)
+        if dropped:
+            assert await slow.get() == []
+            assert hub.subscribers(feed.id) == 1
+        else:
+            assert len(await slow.get()) == 5
+
+    # held back for too long
+    for n in range(11):
+        feed.publish({'type': 'post', 'text': str(n)})
+    assert slow.dropped
+
+    with pytest.raises(ValueError):
+        LiveHub(slow_policy='ignore')
+
+
+@pytest.mark.asyncio
+async def test_live_fan_out(store, mocker):
+    n_subscribers = 50
+    feed = LocalFeed(SigningKey.generate(), store=store)
+    feed.publish({'type': 'post', 'text': 'old'})
+    api = MuxRPCAPI(store=store)
+
+    socket = QueueSHSServer()
+    socket.listen()
+    for n in range(n_subscribers):
+        socket.queue.put_nowait(_history_request(n + 1, id=feed.id, live=True, keys=False))
+    serving = ensure_future(api.serve(PacketStream(socket)))
+    await sleep(0.01)
+    assert len(_parse_frames(b''.join(socket.get_output()))) == n_subscribers
+    assert api.hub.subscribers(feed.id) == n_subscribers
+
+    dumps = mocker.spy(codec, 'dumps')
+    new = [feed.publish({'type': 'post', 'text': 'new {}'.format(n)}) for n in range(3)]
+    assert dumps.call_count == len(new)
+    assert _replies(socket) == {-(n + 1): [msg.to_dict() for msg in new] for n in range(n_subscribers)}
+
+    socket.queue.put_nowait(None)
+    await serving
+    assert api.hub.subscribers(feed.id) == 0
+
+
+@pytest.mark.asyncio
+async def test_live_backlog(store):
+    feed = LocalFeed(SigningKey.generate(), store=store)
+    api = MuxRPCAPI(store=store, hub=LiveHub(max_buffered=1000, max_queued=3, slow_policy='buffer'))
+
+    socket = BusySHSServer()
+    socket.listen()
+    socket.queue.put_nowait(_history_request(1, id=feed.id, live=True, keys=False, limit=4))
+    serving = ensure_future(api.serve(PacketStream(socket)))
+    await sleep(0.01)
+
+    # held back while the connection is busy, then sent all at once
+    socket.buffered = 2000
+    feed.publish({'type': 'post', 'text': '0'})
+    feed.publish({'type': 'post', 'text': '1'})
+    assert list(socket.get_output()) == []
+    socket.buffered = 0
+    await sleep(0.01)
+    assert [body['content']['text'] for body in _replies(socket)[-1]] == ['0', '1']
+
+    # the stream ends after 'limit' messages
+    feed.publish({'type': 'post', 'text': '2'})
+    feed.publish({'type': 'post', 'text': '3'})
+    await sleep(0.01)
+    assert _replies(socket)[-1][-1] is True
+
+    socket.queue.put_nowait(_history_request(2, id=feed.id, seq=5, live=True, keys=False))
+    await sleep(0.01)
+    # too slow for too long
+    socket.buffered = 2000
+    for n in range(5):
+        feed.publish({'type': 'post', 'text': str(n)})
+    await sleep(0.01)
+    assert _replies(socket)[-2][-1]['name'] == 'Error'
+
+    socket.queue.put_nowait(None)
+    await serving
+
+
+def test_publish_burst(store):
+    hub = LiveHub()
+    store.listeners.append(hub.publish)
+    feed = LocalFeed(SigningKey.generate(), store=store)
+
+    sockets = [BusySHSServer() for n in range(3)]
+    for socket in sockets:
+        hub.subscribe(feed.id, PacketStream(socket), 1, keys=False)
+
+    messages = feed.publish_many([{'type': 'post', 'text': str(n)} for n in range(10)])
+    for socket in sockets:
+        # one write for the whole run
+        output = list(socket.get_output())
+        assert len(output) == 1
+        assert [body for req, body in _parse_frames(output[0])] == [msg.to_dict() for msg in messages]
@@ -0,0 +1,108 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from async_generator import async_generator, yield_
+from nacl.signing import SigningKey
+
+from ssb.feed import Feed, LocalFeed, InvalidMessageException, InvalidSignatureException, ingest
+from ssb.feed.store import LogStore
+from ssb.packet_stream import PSMessage, PSMessageType
+
+
+@pytest.fixture()
+def local_feed():
+    return LocalFeed(SigningKey.generate())
+
+
+@pytest.fixture()
+def remote_feed(local_feed):
+    return Feed(local_feed.public_key)
+
+
+@async_generator
+async def _history_stream(objects):
+    for obj in objects:
+        await yield_(PSMessage(PSMessageType.JSON, obj, stream=True, end_err=False, req=-1))
+    await yield_(PSMessage(PSMessageType.JSON, True, stream=True, end_err=True, req=-1))
+
+
+async def _collect_messages(generator):
+    results = []
+    async for msg in generator:
+        results.append(msg)
+    return results
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize('keys', [False, True])
+@pytest.mark.parametrize('executor', [None, ThreadPoolExecutor(2)])
+async def test_ingest(local_feed, remote_feed, keys, executor):
+    published = [local_feed.publish({'type': 'post', 'text': str(n)}) for n in range(100)]
+    if keys:
+        objects = [{'key': msg.key, 'value': msg.to_dict(), 'timestamp': 0} for msg in published]
+    else:
+        objects = [msg.to_dict() for msg in published]
+
+    messages = await _collect_messages(ingest(_history_stream(objects), remote_feed, executor=executor,
+                                              batch_size=8, concurrency=3))
+    assert [msg.key for msg in messages] == [msg.key for msg in published]
+    assert remote_feed.sequence == 100
+    assert remote_feed.tip == published[-1].key
+
+
+@pytest.mark.asyncio
+async def test_ingest_store(local_feed, tmpdir):
+    published = [local_feed.publish({'type': 'post', 'text': str(n)}) for n in range(20)]
+    objects = [msg.to_dict() for msg in published]
+    objects[17]['content']['text'] = 'forged'
+    store = LogStore(str(tmpdir.join('log.offset')))
+    writes = []
+    store.listeners.append(lambda messages: writes.append(len(messages)))
+    remote_feed = Feed(local_feed.public_key, store=store)
+
+    # one write per batch, up to the bad signature
+    with pytest.raises(InvalidSignatureException):
+        await _collect_messages(ingest(_history_stream(objects), remote_feed, batch_size=8))
+    assert writes == [8, 8, 1]
+    assert [msg.key for msg in remote_feed.history()] == [msg.key for msg in published[:17]]
+    store.close()
+
+
+@pytest.mark.asyncio
+async def test_ingest_broken_chain(local_feed, remote_feed):
+    published = [local_feed.publish({'type': 'post', 'text': str(n)}) for n in range(20)]
+    objects = [msg.to_dict() for msg in published]
+    del objects[13]
+
+    received = []
+    with pytest.raises(InvalidMessageException):
+        async for msg in ingest(_history_stream(objects), remote_feed, batch_size=5):
+            received.append(msg)
+
+    # everything up to the broken link went through
+    assert len(received) == 13
+    assert remote_feed.sequence == 13
+
+
+@pytest.mark.asyncio
+async def test_ingest_bad_signature(local_feed, remote_feed):
+    published = [local_feed.publish({'type': 'post', 'text': str(n)}) for n in range(20)]
+    objects = [msg.to_dict() for msg in published]
+    objects[7]['content']['text'] = 'forged'
+
+    received = []
+    with pytest.raises(InvalidSignatureException):
+        async for msg in ingest(_history_stream(objects), remote_feed, batch_size=5):
+            received.append(msg)
+    assert len(received) == 7
+    assert remote_feed.sequence == 7
+
+
+@pytest.mark.asyncio
+async def test_ingest_wrong_key(local_feed, remote_feed):
+    published = [local_feed.publish({'type': 'post', 'text': str(n)}) for n in range(3)]
+    objects = [{'key': '%foo.sha256', 'value': msg.to_dict()} for msg in published]
+
+    with pytest.raises(InvalidMessageException):
+        await _collect_messages(ingest(_history_stream(objects), remote_feed))
+    assert remote_feed.sequence == 0
@@ -0,0 +1,322 @@
+from asyncio import Queue, ensure_future, gather, sleep
+from concurrent.futures import ThreadPoolExecutor
+from hashlib import sha256
+
+import pytest
+from nacl.signing import SigningKey
+
+from ssb import codec
+from ssb.feed import LocalFeed
+from ssb.feed.store import LogStore
+from ssb.muxrpc import MuxRPCAPI
+from ssb.packet_stream import PacketStream, PSMessage, PSMessageType
+
+from .test_packet_stream import MockSHSServer
+
+
+def _frame(body, req, stream=False, end_err=False):
+    msg = PSMessage(PSMessageType.JSON, body, stream=stream, end_err=end_err, req=req)
+    return msg.header + msg.data
+
+
+def _parse_frames(data):
+    messages = []
+    while data:
+        header, data = data[:9], data[9:]
+        length = int.from_bytes(header[1:5], 'big')
+        req = int.from_bytes(header[5:9], 'big', signed=True)
+        messages.append((req, codec.loads(data[:length])))
+        data = data[length:]
+    return messages
+
+
+@pytest.fixture
+def api():
+    api = MuxRPCAPI()
+
+    @api.define('echo')
+    def echo(connection, request):
+        connection.send(request.args, req=-request.req)
+
+    return api
+
+
+@pytest.mark.asyncio
+async def test_many_peers(api):
+    n_peers, n_requests = 300, 5
+
+    sockets = []
+    for peer in range(n_peers):
+        socket = MockSHSServer()
+        socket.listen()
+        socket.feed([_frame({'name': ['echo'], 'args': [peer, n], 'type': 'async'}, req=n + 1)
+                     for n in range(n_requests)])
+        sockets.append(socket)
+    connections = [PacketStream(socket) for socket in sockets]
+
+    # one API, one dispatch loop per connection
+    await gather(*[api.serve(connection) for connection in connections])
+
+    for peer, socket in enumerate(sockets):
+        replies = _parse_frames(b''.join(socket.get_output()))
+        assert replies == [(-(n + 1), [peer, n]) for n in range(n_requests)]
+
+    # connections that go away are forgotten
+    assert api.connections == []
+    assert api.connection is None
+
+
+@pytest.mark.asyncio
+async def test_call_routing(api):
+    sockets = [MockSHSServer() for n in range(3)]
+    connections = [PacketStream(socket) for socket in sockets]
+    for socket, connection in zip(sockets, connections):
+        socket.listen()
+        api.add_connection(connection)
+
+    # by default, calls go to the last connection
+    api.call('whoami', [])
+    api.call('whoami', [], connection=connections[0])
+    api.call('whoami', [], connection=connections[0])
+
+    assert [len(list(socket.get_output())) for socket in sockets] == [2, 0, 1]
+    assert connections[0].in_flight == 2
+
+    api.remove_connection(connections[2])
+    assert api.connection is connections[1]
+
+
+@pytest.mark.asyncio
+async def test_async_handlers():
+    api = MuxRPCAPI(max_tasks=4, max_tasks_per_connection=3)
+    running, max_running = [], []
+
+    @api.define('slow')
+    async def slow(connection, request):
+        running.append(request)
+        max_running.append(len(running))
+        await sleep(0.01)
+        running.remove(request)
+        connection.send(request.args, req=-request.req)
+
+    sockets = [MockSHSServer() for n in range(2)]
+    for socket in sockets:
+        socket.listen()
+        socket.feed([_frame({'name': ['slow'], 'args': [n], 'type': 'async'}, req=n + 1) for n in range(5)])
+
+    await gather(*[api.serve(PacketStream(socket)) for socket in sockets])
+
+    # both connections together stay within the global limit
+    assert max(max_running) == 4
+    for socket in sockets:
+        assert sorted(_parse_frames(b''.join(socket.get_output()))) == [(-(n + 1), [n]) for n in reversed(range(5))]
+
+
+@pytest.mark.asyncio
+async def test_per_connection_limit():
+    api = MuxRPCAPI(max_tasks_per_connection=2)
+    running, max_running = [], []
+
+    @api.define('slow')
+    async def slow(connection, request):
+        running.append(request)
+        max_running.append(len(running))
+        await sleep(0.01)
+        running.remove(request)
+
+    socket = MockSHSServer()
+    socket.listen()
+    socket.feed([_frame({'name': ['slow'], 'args': [], 'type': 'async'}, req=n + 1) for n in range(5)])
+    await api.serve(PacketStream(socket))
+    assert max(max_running) == 2
+    assert len(max_running) == 5
+
+
+@pytest.mark.asyncio
+async def test_limits_across_connections():
+    api = MuxRPCAPI(max_tasks=2, max_tasks_per_connection=1)
+    running = []
+
+    @api.define('slow')
+    async def slow(connection, request):
+        running.append(request.args[0])
+        await sleep(0.05)
+        running.remove(request.args[0])
+
+    sockets = []
+    for name, n_requests in (('busy', 3), ('other', 1)):
+        socket = MockSHSServer()
+        socket.listen()
+        socket.feed([_frame({'name': ['slow'], 'args': [name], 'type': 'async'}, req=n + 1)
+                     for n in range(n_requests)])
+        sockets.append(socket)
+    serving = ensure_future(gather(*[api.serve(PacketStream(socket)) for socket in sockets]))
+
+    # a connection waiting for its own slot doesn't hold a global one meanwhile
+    await sleep(0.02)
+    assert sorted(running) == ['busy', 'other']
+    await serving
+
+
+@pytest.mark.asyncio
+async def test_executor_handler(api):
+    @api.define('sha256', executor=ThreadPoolExecutor(2))
+    def hash_args(request):
+        return sha256(request.args[0].encode('utf-8')).hexdigest()
+
+    socket = MockSHSServer()
+    socket.listen()
+    socket.feed([_frame({'name': ['sha256'], 'args': ['foo'], 'type': 'async'}, req=1)])
+    await api.serve(PacketStream(socket))
+
+    assert _parse_frames(b''.join(socket.get_output())) == [(-1, sha256(b'foo').hexdigest())]
+
+
+@pytest.mark.asyncio
+async def test_errors(api):
+    @api.define('broken')
+    async def broken(connection, request):
+        raise ValueError('oops')
+
+    socket = MockSHSServer()
+    socket.listen()
+    socket.feed([_frame({'name': ['foo', 'bar'], 'args': [], 'type': 'async'}, req=1),
+                 _frame({'name': ['broken'], 'args': [], 'type': 'source'}, req=2, stream=True),
+                 _frame({'name': ['echo'], 'args': [1], 'type': 'async'}, req=3)])
+    await api.serve(PacketStream(socket))
+
+    output = b''.join(socket.get_output())
+    # error replies end the request
+    assert output[0] & 0x0c == 0x04
+    assert _parse_frames(output) == [
+        (-1, {'name': 'Error', 'message': 'Method foo.bar not found!', 'stack': ''}),
+        (-3, [1]),
+        (-2, {'name': 'Error', 'message': 'oops', 'stack': ''})
+    ]
+
+
+class QueueSHSServer(MockSHSServer):
+    """A socket that stays open until ``None`` is fed to it."""
+
+    def __init__(self, *args, **kwargs):
+        super(QueueSHSServer, self).__init__(*args, **kwargs)
+        self.queue = Queue()
+
+    async def read(self):
+        return await self.queue.get()
+
+
+@pytest.fixture
+def history_store(tmpdir):
+    store = LogStore(str(tmpdir.join('log.offset')))
+    yield store
+    store.close()
+
+
+def _history_request(req, **args):
+    return _frame({'name': ['createHistoryStream'], 'args': [args], 'type': 'source'}, req=req, stream=True)
+
+
+@pytest.mark.asyncio
+async def test_create_history_stream(history_store):
+    feed = LocalFeed(SigningKey.generate(), store=history_store)
+    messages = [feed.publish({'type': 'post', 'text': str(n)}) for n in range(10)]
+    api = MuxRPCAPI(store=history_store, history_page_size=3)
+
+    socket = MockSHSServer()
+    socket.listen()
+    socket.feed([_history_request(1, id=feed.id),
+                 _history_request(2, id=feed.id, seq=4, limit=5, keys=False),
+                 _history_request(3, id=feed.id, seq=20),
+                 _history_request(4, id=feed.id, seq=8, limit=-1, keys=False)])
+    await api.serve(PacketStream(socket))
+
+    replies = {}
+    for req, body in _parse_frames(b''.join(socket.get_output())):
+        replies.setdefault(req, []).append(body)
+
+    assert replies[-1][:-1] == [{'key': msg.key, 'value': msg.to_dict(), 'timestamp': msg.timestamp}
+                                for msg in messages]
+    assert replies[-2][:-1] == [msg.to_dict() for msg in messages[3:8]]
+    # every stream is closed, even an empty one
+    assert replies[-1][-1] is True and replies[-2][-1] is True
+    assert replies[-3] == [True]
+    # a negative limit means no limit
+    assert replies[-4] == [msg.to_dict() for msg in messages[7:]] + [True]
+
+
+@pytest.mark.asyncio
+async def test_create_history_stream_live(history_store):
+    feed = LocalFeed(SigningKey.generate(), store=history_store)
+    feed.publish({'type': 'post', 'text': 'old'})
+    api = MuxRPCAPI(store=history_store)
+
+    socket = QueueSHSServer()
+    socket.listen()
+    socket.queue.put_nowait(_history_request(1, id=feed.id, live=True, keys=False))
+    serving = ensure_future(api.serve(PacketStream(socket)))
+    await sleep(0.01)
+    assert [body['content']['text'] for req, body in _parse_frames(b''.join(socket.get_output()))] == ['old']
+
+    # new messages are sent as they are appended
+    feed.publish({'type': 'post', 'text': 'new 1'})
+    feed.publish({'type': 'post', 'text': 'new 2'})
+    await sleep(0.01)
+    texts = [body['content']['text'] for req, body in _parse_frames(b''.join(socket.get_output()))]
+    assert texts == ['new 1', 'new 2']
+
+    # the stream ends along with the connection
+    socket.queue.put_nowait(None)
+    await serving
+    assert list(socket.get_output()) == []
+    assert api.connections == []
+
+
+@pytest.mark.asyncio
+async def test_create_history_stream_abort(history_store):
+    feed = LocalFeed(SigningKey.generate(), store=history_store)
+    feed.publish({'type': 'post', 'text': 'old'})
+    api = MuxRPCAPI(store=history_store)
+
+    socket = QueueSHSServer()
+    socket.listen()
+    socket.queue.put_nowait(_history_request(1, id=feed.id, live=True, keys=False))
+    serving = ensure_future(api.serve(PacketStream(socket)))
+    await sleep(0.01)
+    assert [req for req, body in _parse_frames(b''.join(socket.get_output()))] == [-1]
+
+    # the caller ends the stream; the subscription is closed, and the end acknowledged
+    socket.queue.put_nowait(_frame(True, req=1, stream=True, end_err=True))
+    await sleep(0.01)
+    assert api.hub.subscribers(feed.id) == 0
+    feed.publish({'type': 'post', 'text': 'new'})
+    await sleep(0.01)
+    assert _parse_frames(b''.join(socket.get_output())) == [(-1, True)]
+
+    socket.queue.put_nowait(None)
+    await serving
+    assert list(socket.get_output()) == []
+
+
+@pytest.mark.asyncio
+async def test_create_history_stream_live_slots(history_store):
+    feed = LocalFeed(SigningKey.generate(), store=history_store)
+    feed.publish({'type': 'post', 'text': 'old'})
+    api = MuxRPCAPI(max_tasks=1, store=history_store)
+
+    @api.define('ping')
+    async def ping(connection, request):
+        connection.send('pong', req=-request.req)
+
+    socket = QueueSHSServer()
+    socket.listen()
+    socket.queue.put_nowait(_history_request(1, id=feed.id, live=True, keys=False))
+    socket.queue.put_nowait(_frame({'name': ['ping'], 'args': [], 'type': 'async'}, req=2))
+    serving = ensure_future(api.serve(PacketStream(socket)))
+    await sleep(0.01)
+
+    # live streams don't take up a task slot while they wait for messages
+    assert [req for req, body in _parse_frames(b''.join(socket.get_output()))] == [-1, -2]
+
+    socket.queue.put_nowait(None)
+    await serving
@@ -1,12 +1,15 @@
 import json
-from asyncio import ensure_future, gather, Event
+from asyncio import ensure_future, gather, sleep, wait_for, Event, Queue, StreamReader
+from types import SimpleNamespace
 
 import pytest
 from asynctest import patch
 from nacl.signing import SigningKey
 
+from secret_handshake.boxstream import BoxStream, UnboxStream
 from secret_handshake.network import SHSDuplexStream
-from ssb.packet_stream import PacketStream, PSMessageType
+from ssb import codec
+from ssb.packet_stream import PacketStream, PSMessage, PSMessageType, PSTimeoutException
 
 
 async def _collect_messages(generator):
@@ -77,6 +80,60 @@ class MockSHSServer(MockSHSSocket):
             ensure_future(cb())
 
 
+class MockSHSPipe(MockSHSSocket):
+    """One end of an in-memory connection between two peers (see :meth:`pair`)."""
+
+    def __init__(self, *args, **kwargs):
+        super(MockSHSPipe, self).__init__(*args, **kwargs)
+        self.queue = Queue()
+        self.peer = None
+        self.is_connected = True
+
+    @classmethod
+    def pair(cls):
+        a, b = cls(), cls()
+        a.peer, b.peer = b, a
+        return a, b
+
+    async def read(self):
+        return await self.queue.get()
+
+    def write(self, data):
+        self.peer.queue.put_nowait(bytes(data))
+
+    def disconnect(self):
+        # like an SHS stream, the peer's end only notices by reading the end of the data
+        if self.is_connected:
+            self.is_connected = False
+            self.queue.put_nowait(None)
+            self.peer.queue.put_nowait(None)
+
+
+class MockPipeNetwork(object):
+    """Peers connected through :class:`MockSHSPipe` pairs. :meth:`close` hangs up and waits for whatever served them."""
+
+    def __init__(self):
+        self.connections = []
+        self.tasks = []
+
+    def connect(self, serve_a, serve_b, **options):
+        """Connect two peers, each served by calling ``serve_x(connection)``. ``options`` go to ``a``'s end only."""
+        pipe_a, pipe_b = MockSHSPipe.pair()
+        a, b = PacketStream(pipe_a, **options), PacketStream(pipe_b)
+        self.serve(a, serve_a)
+        self.serve(b, serve_b)
+        return a, b
+
+    def serve(self, connection, serve):
+        self.connections.append(connection)
+        self.tasks.append(ensure_future(serve(connection)))
+
+    async def close(self):
+        for connection in self.connections:
+            connection.disconnect()
+        await gather(*self.tasks, return_exceptions=True)
+
+
 @pytest.fixture
 def ps_client(event_loop):
     return MockSHSClient()
@@ -150,9 +207,11 @@ async def test_message_encoding(ps_client):
         'type': 'source'
     }, stream=True)
 
-    header, body = list(ps_client.get_output())
+    # header and body are written at once
+    output, = list(ps_client.get_output())
+    header, body = output[:9], output[9:]
 
-    assert header == b'\x0a\x00\x00\x00\xa6\x00\x00\x00\x01'
+    assert header == b'\x0a\x00\x00\x00\x9a\x00\x00\x00\x01'
     assert json.loads(body.decode('utf-8')) == {
         "name": ["createHistoryStream"],
         "args": [
@@ -162,6 +221,21 @@ async def test_message_encoding(ps_client):
     }
 
 
+def test_message_data_cached():
+    msg = PSMessage(PSMessageType.JSON, {'name': ['whoami'], 'args': []}, stream=False, end_err=False, req=1)
+
+    with patch('ssb.codec.dumps', wraps=codec.dumps) as mock_dumps:
+        assert msg.header == b'\x02\x00\x00\x00\x1d\x00\x00\x00\x01'
+        assert msg.data == b'{"name":["whoami"],"args":[]}'
+        assert msg.data is msg.data
+        assert mock_dumps.call_count == 1
+
+        # changing the body invalidates the cached data
+        msg.body = {'name': ['whoami']}
+        assert msg.data == b'{"name":["whoami"]}'
+        assert mock_dumps.call_count == 2
+
+
 @pytest.mark.asyncio
 async def test_message_stream(ps_client, mocker):
     await ps_client.connect()
@@ -242,8 +316,9 @@ async def test_message_request(ps_server, mocker):
         'args': []
     })
 
-    header, body = list(ps_server.get_output())
-    assert header == b'\x02\x00\x00\x00 \x00\x00\x00\x01'
+    output, = list(ps_server.get_output())
+    header, body = output[:9], output[9:]
+    assert header == b'\x02\x00\x00\x00\x1d\x00\x00\x00\x01'
     assert json.loads(body.decode('utf-8')) == {"name": ["whoami"], "args": []}
 
     assert ps.req_counter == 2
@@ -260,3 +335,334 @@ async def test_message_request(ps_server, mocker):
         assert msg.req == -1
         assert msg.body['id'] == '@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519'
         assert ps.req_counter == 2
+
+
+@pytest.mark.asyncio
+async def test_message_decoding_unaligned_chunks(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    raw = b'\n\x00\x00\x02\xc5\x00\x00\x00\x01' + MSG_BODY_1 + b'\x0e\x00\x00\x023\x00\x00\x00\x02' + MSG_BODY_2
+    # chunk boundaries cut through headers and bodies alike
+    ps_client.feed([raw[i:i + 100] for i in range(0, len(raw), 100)])
+
+    messages = (await _collect_messages(ps))
+    assert len(messages) == 2
+    assert messages[0].req == 1
+    assert messages[0].body['sequence'] == 116
+    assert messages[1].req == 2
+    assert messages[1].body['sequence'] == 103
+    assert messages[1].end_err
+
+
+@pytest.mark.asyncio
+async def test_message_decoding_large_body(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    body = bytes(range(256)) * 1000
+    ps_client.feed([b'\x08\x00\x03\xe8\x00\x00\x00\x00\x01'] + [body[i:i + 4096] for i in range(0, len(body), 4096)])
+
+    msg = await ps.read()
+    assert msg.type == PSMessageType.BUFFER
+    assert msg.body == body
+
+
+@pytest.mark.asyncio
+async def test_buffer_zero_copy(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    # binary bodies are handed out as views of the chunk they came in
+    ps_client.feed([b'\x08\x00\x00\x00\x03\x00\x00\x00\x01abc\x08\x00\x00\x00\x02\x00\x00\x00\x02de'])
+    first, second = await _collect_messages(ps)
+    assert isinstance(first.body, memoryview) and first.body == b'abc'
+    assert isinstance(second.body, memoryview) and second.body == b'de'
+
+    # large bodies are written on their own, after their header (as bytes, which is all the box stream takes)
+    data = b'\x01' * 10000
+    ps.send(data, msg_type=PSMessageType.BUFFER, stream=True, req=-1)
+    header, body = ps_client.get_output()
+    assert header == b'\x08\x00\x00\x27\x10\xff\xff\xff\xff'
+    assert body is data
+    ps.send(memoryview(bytearray(data)), msg_type=PSMessageType.BUFFER, stream=True, req=-1)
+    header, body = ps_client.get_output()
+    assert type(body) is bytes and body == data
+
+    # small ones go out in a single write
+    ps.send(b'abc', msg_type=PSMessageType.BUFFER, stream=True, req=-1)
+    assert list(ps_client.get_output()) == [b'\x08\x00\x00\x00\x03\xff\xff\xff\xffabc']
+
+
+class LoopbackBoxStream(SHSDuplexStream):
+    """A connection whose frames go through real boxing and unboxing, and come back to the same end."""
+
+    def __init__(self):
+        super(LoopbackBoxStream, self).__init__()
+        key, nonce = b'\x01' * 32, b'\x02' * 24
+        reader = StreamReader()
+        self.write_stream = BoxStream(SimpleNamespace(write=reader.feed_data), key, nonce)
+        self.read_stream = UnboxStream(reader, key, nonce)
+        self.is_connected = True
+
+    def disconnect(self):
+        if self.is_connected:
+            self.write_stream.close()
+            self.is_connected = False
+
+
+@pytest.mark.asyncio
+async def test_box_stream():
+    connection = LoopbackBoxStream()
+    ps = PacketStream(connection)
+
+    # views and bytearrays (e.g. blob chunks, or bodies read lazily off the wire) make it through the box stream
+    bodies = [memoryview(bytearray(b'\x01' * 10000)), bytearray(b'\x02' * 5000), memoryview(b'\x03' * 10)]
+    for n, body in enumerate(bodies):
+        ps.send(body, msg_type=PSMessageType.BUFFER, stream=True, req=n + 1)
+    ps.disconnect()
+    received = await wait_for(_collect_messages(ps), 1)
+    assert [(msg.req, bytes(msg.body)) for msg in received] == [(n + 1, bytes(body)) for n, body in enumerate(bodies)]
+
+
+@pytest.mark.asyncio
+async def test_remote_disconnect():
+    pipe_a, pipe_b = MockSHSPipe.pair()
+    ps_a, ps_b = PacketStream(pipe_a), PacketStream(pipe_b)
+    ps_a.start()
+    handler = ps_a.send(['whoami'], stream=True)
+
+    # the SHS stream itself doesn't notice; the reader does
+    ps_b.disconnect()
+    await wait_for(ps_a.wait_closed(), 1)
+    assert pipe_a.is_connected
+    assert not ps_a.is_connected
+    assert await _collect_messages(handler) == []
+    assert not handler.ended
+
+
+@pytest.mark.asyncio
+async def test_message_batching(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client, batch=True, flush_messages=3, flush_delay=0.01)
+
+    ps.send({'name': ['whoami'], 'args': []})
+    ps.send({'name': ['whoami'], 'args': []})
+    assert list(ps_client.get_output()) == []
+
+    # reaching the message threshold flushes everything in a single write
+    ps.send({'name': ['whoami'], 'args': []})
+    output, = list(ps_client.get_output())
+    assert output.count(b'{"name":["whoami"],"args":[]}') == 3
+
+    # otherwise, the timer takes care of it
+    ps.send({'name': ['whoami'], 'args': []})
+    assert list(ps_client.get_output()) == []
+    await sleep(0.02)
+    output, = list(ps_client.get_output())
+    assert output == b'\x02\x00\x00\x00\x1d\x00\x00\x00\x04{"name":["whoami"],"args":[]}'
+
+
+@pytest.mark.asyncio
+async def test_message_cork(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client, flush_bytes=1024)
+
+    with ps.corked():
+        for n in range(10):
+            ps.send(n, stream=True, req=-1)
+        assert list(ps_client.get_output()) == []
+    output, = list(ps_client.get_output())
+    assert output == b''.join(b'\x0a\x00\x00\x00\x01\xff\xff\xff\xff' + str(n).encode() for n in range(10))
+
+    # a full buffer is flushed even while corked
+    with ps.corked():
+        ps.send('x' * 2000, msg_type=PSMessageType.TEXT, stream=True, req=-1)
+        assert len(list(ps_client.get_output())) == 1
+
+    # not batching, not corked
+    ps.send(1, stream=True, req=-1)
+    assert len(list(ps_client.get_output())) == 1
+
+
+@pytest.mark.asyncio
+async def test_message_lazy_decoding(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client, lazy=True)
+
+    ps_client.feed([b'\n\x00\x00\x02\xc5\xff\xff\xff\xff', MSG_BODY_1])
+    with patch('ssb.codec.loads', wraps=codec.loads) as mock_loads:
+        msg = await ps._read()
+        assert mock_loads.call_count == 0
+
+        # relaying the message doesn't need decoding nor re-encoding
+        ps._write(PSMessage.from_data(msg.type, msg.data, stream=True, end_err=False, req=1))
+        output, = list(ps_client.get_output())
+        assert output == b'\n\x00\x00\x02\xc5\x00\x00\x00\x01' + MSG_BODY_1
+        assert mock_loads.call_count == 0
+
+        assert msg.body['sequence'] == 116
+        assert msg.body['author'] == '@1+Iwm79DKvVBqYKFkhT6fWRbAVvNNVH4F2BSxwhYmx8=.ed25519'
+        assert mock_loads.call_count == 1
+        assert msg.data == MSG_BODY_1
+
+
+@pytest.mark.asyncio
+async def test_request_timeout(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client, timeout=0.05)
+
+    slow = ps.send({'name': ['whoami'], 'args': []}, timeout=10)
+    handler = ps.send({'name': ['whoami'], 'args': []})
+    assert ps.in_flight == 2
+
+    with pytest.raises(PSTimeoutException):
+        await handler
+    assert ps.in_flight == 1
+    assert ps.n_timeouts == 1
+
+    # a late reply is dropped
+    ps_client.feed([b'\x02\x00\x00\x00\x04\xff\xff\xff\xfe', b'true'])
+    msg = await ps.read()
+    assert msg.req == -2
+    assert ps.in_flight == 1
+
+    # replies are not requests, so they don't wait for anything
+    assert ps.send(True, req=-5) is None
+    assert ps.in_flight == 1
+
+    ps_client.feed([b'\x02\x00\x00\x00\x04\xff\xff\xff\xff', b'true'])
+    await ps.read()
+    assert (await slow).body is True
+    assert ps.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_timeout(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    handler = ps.send({'name': ['createHistoryStream'], 'args': []}, stream=True, timeout=0.05)
+
+    # receiving data keeps the stream alive
+    for n in range(3):
+        await sleep(0.03)
+        ps_client.feed([b'\x0a\x00\x00\x00\x01\xff\xff\xff\xff', str(n).encode()])
+        await ps.read()
+
+    with pytest.raises(PSTimeoutException):
+        await _collect_messages(handler)
+    assert ps.in_flight == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_backpressure(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client, max_queued_messages=10, max_queued_bytes=5000)
+    handler = ps.send({'name': ['createHistoryStream'], 'args': []}, stream=True)
+
+    # a fast peer...
+    n_messages = 2000
+    for n in range(n_messages):
+        ps_client.feed([b'\n\x00\x00\x02\xc5\xff\xff\xff\xff', MSG_BODY_1])
+    ps_client.feed([b'\x0e\x00\x00\x00\x04\xff\xff\xff\xff', b'true'])
+
+    # ...and a slow consumer
+    async def _consume():
+        n_received = 0
+        async for msg in handler:
+            if msg.end_err:
+                continue
+            n_received += 1
+            # whatever hasn't been queued yet was left unread in the connection
+            assert len(ps_client.input) >= 2 * (n_messages - n_received - handler.queued_messages)
+            await sleep(0)
+        return n_received
+
+    n_received, _ = await gather(_consume(), _collect_messages(ps))
+    assert n_received == n_messages
+
+    # messages are accepted while the queue is under 5000 bytes, which makes for 8 of these
+    assert ps.high_water_messages == 8
+    assert ps.high_water_bytes == 8 * len(MSG_BODY_1)
+    assert handler.queued_messages == 0
+    assert handler.queued_bytes == 0
+
+
+@pytest.mark.asyncio
+async def test_stream_backpressure_timeout(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client, max_queued_messages=2)
+    abandoned = ps.send({'name': ['createHistoryStream'], 'args': []}, stream=True, timeout=0.05)
+    request = ps.send({'name': ['whoami'], 'args': []}, timeout=1)
+
+    # nobody reads the stream, which fills up and holds the reader back...
+    ps_client.feed([b'\x0a\x00\x00\x00\x01\xff\xff\xff\xff', b'1'] * 4 +
+                   [b'\x02\x00\x00\x00\x04\xff\xff\xff\xfe', b'true'])
+    ps.start()
+
+    # ...until it times out, and the rest of the connection goes on
+    assert (await wait_for(request, 0.5)).body is True
+    assert ps.n_timeouts == 1
+    with pytest.raises(PSTimeoutException):
+        await _collect_messages(abandoned)
+
+
+@pytest.mark.asyncio
+async def test_stream_backpressure_slow_consumer(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client, max_queued_bytes=2)
+    handler = ps.send({'name': ['createHistoryStream'], 'args': []}, stream=True, timeout=0.05)
+    # the queue stays full for a few messages in a row, so the reader waits for longer than the timeout
+    ps_client.feed([b'\x0a\x00\x00\x00\x01\xff\xff\xff\xff', b'1',
+                    b'\x0a\x00\x00\x00\x05\xff\xff\xff\xff', b'12345',
+                    b'\x0a\x00\x00\x00\x05\xff\xff\xff\xff', b'12345'] * 3 +
+                   [b'\x0e\x00\x00\x00\x04\xff\xff\xff\xff', b'true'])
+    ps.start()
+
+    # but as long as the consumer keeps going, the stream doesn't time out
+    messages = []
+    async for msg in handler:
+        messages.append(msg)
+        await sleep(0.03)
+    assert len(messages) == 10
+    assert ps.n_timeouts == 0
+
+
+@pytest.mark.asyncio
+async def test_reader_task(ps_client):
+    await ps_client.connect()
+
+    ps = PacketStream(ps_client)
+
+    stream_handler = ps.send({'name': ['createHistoryStream'], 'args': []}, stream=True)
+    request_handler = ps.send({'name': ['whoami'], 'args': []})
+
+    ps_client.feed([b'\n\x00\x00\x02\xc5\xff\xff\xff\xff', MSG_BODY_1,
+                    b'\n\x00\x00\x023\xff\xff\xff\xff', MSG_BODY_2,
+                    b'\x02\x00\x00\x00\x1d\x00\x00\x00\x07', b'{"name":["whoami"],"args":[]}',
+                    b'\x02\x00\x00\x00\x04\xff\xff\xff\xfe', b'true'])
+    reader = ps.start()
+
+    # nobody is consuming the stream, but that doesn't hold the reply back
+    assert (await request_handler).body is True
+
+    # requests from the peer go to the inbound queue
+    requests = await _collect_messages(ps)
+    assert [msg.req for msg in requests] == [7]
+
+    # the connection is gone, so the stream ends after what was already received
+    await reader
+    assert [msg.body['sequence'] for msg in await _collect_messages(stream_handler)] == [116, 103]
+    assert ps.in_flight == 0
@@ -0,0 +1,255 @@
+from asyncio import Event, ensure_future, gather, get_event_loop, sleep, wait_for
+
+import pytest
+
+from ssb.muxrpc import MuxRPCAPI
+from ssb.packet_stream import PacketStream
+from ssb.peers import PeerPool, PeerPoolException
+
+from .test_packet_stream import MockPipeNetwork, MockSHSPipe
+
+
+class MockSHSNetwork(MockPipeNetwork):
+    """Peers served by an ``echo`` API, reached through :meth:`client` (which stands in for ``SHSClient``)."""
+
+    def __init__(self):
+        super(MockSHSNetwork, self).__init__()
+        self.api = MuxRPCAPI()
+        self.api.handlers['echo'] = self.echo
+        self.down = set()
+        # peers that accept the connection, but never finish the handshake
+        self.stalled = set()
+        self.handshakes = []
+        # key -> server end of the connection
+        self.streams = {}
+
+    def echo(self, connection, request):
+        connection.send(request.args, req=-request.req)
+
+    def client(self, host, port, keypair, key):
+        return MockSHSNetworkClient(self, key)
+
+
+class MockSHSNetworkClient(MockSHSPipe):
+    def __init__(self, network, key):
+        super(MockSHSNetworkClient, self).__init__()
+        self.network = network
+        self.key = key
+        self.is_connected = False
+
+    async def open(self):
+        network = self.network
+        network.handshakes.append(self.key)
+        await sleep(0.01)
+        if self.key in network.stalled:
+            await Event().wait()
+        if self.key in network.down:
+            raise ConnectionRefusedError('{} is down'.format(self.key))
+        server = MockSHSPipe()
+        self.peer, server.peer = server, self
+        self.is_connected = True
+        network.streams[self.key] = PacketStream(server)
+        network.serve(network.streams[self.key], network.api.serve)
+
+
+@pytest.fixture
+async def network():
+    network = MockSHSNetwork()
+    pools = []
+
+    def _pool(**kwargs):
+        pool = PeerPool(MuxRPCAPI(), None, client_factory=network.client, **kwargs)
+        pools.append(pool)
+        for n in range(4):
+            pool.add('127.0.0.1', 8000 + n, 'peer{}'.format(n))
+        return pool
+
+    yield network, _pool
+
+    for pool in pools:
+        pool.close()
+    await network.close()
+    await sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_shared_connection(network):
+    network, pool = network
+    pool = pool()
+
+    # concurrent callers wait for the same handshake
+    connections = await gather(*[pool.get('peer0') for n in range(10)])
+    assert len(set(connections)) == 1
+    assert network.handshakes == ['peer0']
+
+    replies = await gather(*[pool.api.call('echo', [n], 'async', connection=connections[0]) for n in range(10)])
+    assert [msg.body for msg in replies] == [[n] for n in range(10)]
+    assert await pool.get('peer0') is connections[0]
+    assert network.handshakes == ['peer0']
+
+    with pytest.raises(PeerPoolException):
+        await pool.get('stranger')
+
+
+@pytest.mark.asyncio
+async def test_backoff(network):
+    network, pool = network
+    pool = pool(backoff=0.05, max_backoff=0.1)
+    network.down.add('peer0')
+    peer = pool.peers['peer0']
+
+    loop = get_event_loop()
+    for max_delay in (0.05, 0.1, 0.1):
+        with pytest.raises(PeerPoolException):
+            await pool.get('peer0')
+        # jittered, doubled on every failure, capped
+        assert max_delay / 2 - 0.01 <= peer.retry_at - loop.time() <= max_delay
+
+    # nobody else is held up by the peer being down
+    assert await pool.get('peer1')
+
+    network.down.clear()
+    assert await pool.get('peer0')
+    assert pool.peers['peer0'].failures == 0
+    assert network.handshakes == ['peer0'] * 3 + ['peer1', 'peer0']
+
+
+@pytest.mark.asyncio
+async def test_handshake_timeout(network):
+    network, pool = network
+    pool = pool(max_peers=1, backoff=0.05, handshake_timeout=0.05)
+    network.stalled.add('peer0')
+    peer = pool.peers['peer0']
+
+    # a failed attempt, which doesn't keep the room it took
+    with pytest.raises(PeerPoolException):
+        await wait_for(pool.get('peer0'), 1)
+    assert peer.failures == 1
+    assert peer.retry_at > get_event_loop().time()
+    assert await pool.get('peer1')
+
+
+@pytest.mark.asyncio
+async def test_reconnect(network):
+    network, pool = network
+    pool = pool(backoff=0.01)
+    peer = pool.add('127.0.0.1', 8000, 'peer0', keep=True)
+    await sleep(0.05)
+    assert peer.is_connected
+
+    network.down.add('peer0')
+    network.streams['peer0'].disconnect()
+    await sleep(0.1)
+    assert not peer.is_connected
+    assert peer.failures > 1
+
+    network.down.clear()
+    await sleep(0.1)
+    assert peer.is_connected
+    assert peer.failures == 0
+
+
+@pytest.mark.asyncio
+async def test_max_peers(network):
+    network, pool = network
+    pool = pool(max_peers=2)
+
+    first = await pool.get('peer0')
+    await pool.get('peer1')
+    # the least recently used peer makes room
+    await pool.get('peer0')
+    await pool.get('peer2')
+    assert sorted(peer.key for peer in pool.connected) == ['peer0', 'peer2']
+    assert pool.peers['peer0'].connection is first
+
+    # peers with requests in flight are never closed
+    network.api.handlers['echo'] = lambda connection, request: None
+    pool.api.call('echo', [], 'async', connection=first)
+    pool.api.call('echo', [], 'async', connection=pool.peers['peer2'].connection)
+    with pytest.raises(PeerPoolException):
+        await pool.get('peer3')
+
+
+@pytest.mark.asyncio
+async def test_max_peers_concurrent(network):
+    network, pool = network
+    pool = pool(max_peers=2)
+
+    # handshakes under way count against the limit
+    results = await gather(*[pool.get('peer{}'.format(n)) for n in range(3)], return_exceptions=True)
+    assert len(pool.connected) == 2
+    assert len([result for result in results if isinstance(result, PeerPoolException)]) == 1
+    assert len(network.handshakes) == 2
+
+
+@pytest.mark.asyncio
+async def test_idle_timeout(network):
+    network, pool = network
+    pool = pool(idle_timeout=0.05)
+    pool.add('127.0.0.1', 8003, 'peer3', keep=True)
+
+    await pool.get('peer0')
+    await sleep(0.15)
+    assert [peer.key for peer in pool.connected] == ['peer3']
+
+    # closed peers are reopened on demand
+    assert await pool.get('peer0')
+    assert network.handshakes.count('peer0') == 2
+
+
+@pytest.mark.asyncio
+async def test_inbound_activity(network):
+    network, pool = network
+    pool = pool(max_peers=1, idle_timeout=0.05)
+    done = Event()
+
+    async def _slow(connection, request):
+        await done.wait()
+        connection.send(True, req=-request.req)
+
+    pool.api.handlers['slow'] = _slow
+    pool.api.handlers['ping'] = lambda connection, request: connection.send(True, req=-request.req)
+
+    # a peer whose request to us is still being handled is neither evicted nor closed to make room
+    await pool.get('peer0')
+    reply = ensure_future(network.api.call('slow', [], 'async', connection=network.streams['peer0']))
+    await sleep(0.15)
+    assert [peer.key for peer in pool.connected] == ['peer0']
+    with pytest.raises(PeerPoolException):
+        await pool.get('peer1')
+
+    done.set()
+    assert (await reply).body is True
+    await sleep(0.15)
+    assert pool.connected == []
+
+    # nor is one that keeps sending us requests
+    await pool.get('peer1')
+    for n in range(15):
+        await network.api.call('ping', [], 'async', connection=network.streams['peer1'])
+        await sleep(0.01)
+    assert [peer.key for peer in pool.connected] == ['peer1']
+
+
+@pytest.mark.asyncio
+async def test_close(network):
+    network, pool = network
+    pool = pool(backoff=0.05)
+    network.down.add('peer1')
+    with pytest.raises(PeerPoolException):
+        await pool.get('peer1')
+
+    # a handshake under way, and one waiting for the peer's backoff to pass
+    opening = [ensure_future(pool.get(key)) for key in ('peer0', 'peer1')]
+    await sleep(0.005)
+    pool.close()
+    for future in opening:
+        with pytest.raises(PeerPoolException):
+            await future
+    await sleep(0.1)
+    assert pool.connected == []
+    assert network.handshakes == ['peer1', 'peer0']
+
+    with pytest.raises(PeerPoolException):
+        await pool.get('peer2')
+    assert network.handshakes == ['peer1', 'peer0']
@@ -0,0 +1,194 @@
+from asyncio import wait_for
+
+import pytest
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed, Replicator
+from ssb.feed.store import LogStore
+from ssb.muxrpc import MuxRPCAPI, MuxRPCAPIException
+
+N_FEEDS = 10
+N_MESSAGES = 20
+
+
+class Server(object):
+    """A peer serving createHistoryStream, which keeps track of the calls it gets."""
+
+    def __init__(self, store):
+        self.api = MuxRPCAPI(store=store)
+        self.requests = []
+        self.active, self.peak = 0, 0
+        create_history_stream = self.api.handlers['createHistoryStream']
+
+        async def _create_history_stream(connection, request):
+            self.requests.append(request.args[0])
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+            try:
+                await create_history_stream(connection, request)
+            finally:
+                self.active -= 1
+        self.api.handlers['createHistoryStream'] = _create_history_stream
+
+
+@pytest.fixture
+def source_store(tmpdir):
+    store = LogStore(str(tmpdir.join('source.offset')))
+    for n in range(N_FEEDS):
+        feed = LocalFeed(SigningKey.generate(), store=store)
+        for i in range(N_MESSAGES):
+            feed.publish({'type': 'post', 'text': 'Message #{}'.format(i)})
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def store(tmpdir):
+    store = LogStore(str(tmpdir.join('log.offset')))
+    yield store
+    store.close()
+
+
+@pytest.fixture
+def network(pipe_network):
+    def _connect(replicator, server, **options):
+        client, connection = pipe_network.connect(replicator.api.serve, server.api.serve, **options)
+        replicator.add_peer(client)
+        return client
+
+    return _connect
+
+
+def _feed_ids(store):
+    return sorted(set(msg.feed.id for msg in (store.read(offset) for offset in store._by_key.values())))
+
+
+def _feed_messages(store, feed_id):
+    return [msg.key for msg in store.history(feed_id)]
+
+
+@pytest.mark.asyncio
+async def test_replicate(network, source_store, store):
+    feed_ids = _feed_ids(source_store)
+    servers = [Server(source_store) for n in range(3)]
+    replicator = Replicator(MuxRPCAPI(), store, follows=feed_ids, max_streams=4)
+    for server in servers:
+        network(replicator, server)
+
+    assert await wait_for(replicator.sync(), 5) == []
+    assert replicator.n_messages == N_FEEDS * N_MESSAGES
+    for feed_id in feed_ids:
+        assert _feed_messages(store, feed_id) == _feed_messages(source_store, feed_id)
+
+    # one stream per feed, spread over the peers, at most 4 at a time
+    requests = [request for server in servers for request in server.requests]
+    assert sorted(request['id'] for request in requests) == feed_ids
+    assert all(server.requests for server in servers)
+    assert sum(server.peak for server in servers) <= 4
+
+    # only what's new is asked for next time
+    for server in servers:
+        server.requests.clear()
+    assert await wait_for(replicator.sync(), 5) == []
+    requests = [request for server in servers for request in server.requests]
+    assert len(requests) == N_FEEDS
+    assert set(request['seq'] for request in requests) == {N_MESSAGES + 1}
+    assert replicator.n_messages == N_FEEDS * N_MESSAGES
+
+
+@pytest.mark.asyncio
+async def test_resume(network, source_store, store):
+    feed_id = _feed_ids(source_store)[0]
+    # a previous run got halfway through
+    for msg in list(source_store.history(feed_id, limit=N_MESSAGES // 2)):
+        store.append(msg)
+
+    server = Server(source_store)
+    replicator = Replicator(MuxRPCAPI(), store, follows=[feed_id])
+    network(replicator, server)
+
+    assert await wait_for(replicator.sync(), 5) == []
+    assert server.requests[0]['seq'] == N_MESSAGES // 2 + 1
+    assert replicator.n_messages == N_MESSAGES - N_MESSAGES // 2
+    assert _feed_messages(store, feed_id) == _feed_messages(source_store, feed_id)
+
+
+@pytest.mark.asyncio
+async def test_failover(network, source_store, store):
+    feed_ids = _feed_ids(source_store)
+    broken, dropping, good = Server(source_store), Server(source_store), Server(source_store)
+
+    async def _error(connection, request):
+        raise MuxRPCAPIException('Nope')
+
+    async def _drop(connection, request):
+        connection.disconnect()
+
+    broken.api.handlers['createHistoryStream'] = _error
+    dropping.api.handlers['createHistoryStream'] = _drop
+    replicator = Replicator(MuxRPCAPI(), store, follows=feed_ids, max_streams=2)
+    for server in (broken, dropping, good):
+        network(replicator, server)
+
+    assert await wait_for(replicator.sync(), 5) == []
+    assert sorted(request['id'] for request in good.requests) == feed_ids
+    for feed_id in feed_ids:
+        assert _feed_messages(store, feed_id) == _feed_messages(source_store, feed_id)
+
+
+@pytest.mark.asyncio
+async def test_failover_errors(network, source_store, store):
+    feed_ids = _feed_ids(source_store)[:2]
+    stalled, cut_short, good = Server(source_store), Server(source_store), Server(source_store)
+
+    async def _stall(connection, request):
+        stalled.requests.append(request.args[0])
+        await connection.wait_closed()
+
+    async def _cut_short(connection, request):
+        # the peer goes away halfway through, without ending the stream
+        cut_short.requests.append(request.args[0])
+        for msg in source_store.history(request.args[0]['id'], limit=N_MESSAGES // 2):
+            connection.send(msg.to_dict(), stream=True, req=-request.req)
+        connection.disconnect()
+
+    stalled.api.handlers['createHistoryStream'] = _stall
+    cut_short.api.handlers['createHistoryStream'] = _cut_short
+    replicator = Replicator(MuxRPCAPI(), store, follows=feed_ids, max_streams=1)
+    network(replicator, stalled, timeout=0.05)
+    network(replicator, cut_short)
+    network(replicator, good)
+
+    assert await wait_for(replicator.sync(), 5) == []
+    assert sorted(request['id'] for request in stalled.requests) == feed_ids
+    assert [request['id'] for request in cut_short.requests] == feed_ids[:1]
+    # the rest of the first feed, and the whole second one
+    assert sorted((request['id'], request['seq']) for request in good.requests) == sorted(
+        [(feed_ids[0], N_MESSAGES // 2 + 1), (feed_ids[1], 1)])
+    for feed_id in feed_ids:
+        assert _feed_messages(store, feed_id) == _feed_messages(source_store, feed_id)
+
+
+@pytest.mark.asyncio
+async def test_broken_listener(network, source_store, store, caplog):
+    feed_id = _feed_ids(source_store)[0]
+    server = Server(source_store)
+    replicator = Replicator(MuxRPCAPI(), store, follows=[feed_id])
+    network(replicator, server)
+
+    def _listener(messages):
+        raise RuntimeError('Broken listener')
+    store.listeners.append(_listener)
+
+    # it gets logged, and replication goes on
+    assert await wait_for(replicator.sync(), 5) == []
+    assert len(server.requests) == 1
+    assert _feed_messages(store, feed_id) == _feed_messages(source_store, feed_id)
+    assert 'Broken listener' in caplog.text
+
+
+@pytest.mark.asyncio
+async def test_no_peers(store):
+    feed_id = LocalFeed(SigningKey.generate()).id
+    replicator = Replicator(MuxRPCAPI(), store, follows=[feed_id])
+    assert await replicator.sync() == [feed_id]
@@ -0,0 +1,114 @@
+import os
+
+import pytest
+from nacl.signing import SigningKey
+
+from ssb.feed import Feed, LocalFeed
+from ssb.feed.store import FRAME_HEADER, LogStore, StoreException
+
+
+@pytest.fixture()
+def log_path(tmpdir):
+    return str(tmpdir.join('log.offset'))
+
+
+@pytest.fixture()
+def store(log_path):
+    store = LogStore(log_path)
+    yield store
+    store.close()
+
+
+def _publish(feed, n):
+    return [feed.publish({'type': 'post', 'text': 'Message #{}'.format(i)}) for i in range(n)]
+
+
+def test_append_lookup(store):
+    feed1 = LocalFeed(SigningKey.generate(), store=store)
+    feed2 = LocalFeed(SigningKey.generate(), store=store)
+    messages1 = _publish(feed1, 10)
+    messages2 = _publish(feed2, 5)
+
+    assert len(store) == 15
+    assert messages1[3].key in store
+
+    msg = store.get(messages1[3].key)
+    assert msg.key == messages1[3].key
+    assert msg.sequence == 4
+    assert msg.feed.id == feed1.id
+    assert msg.verify()
+    assert store.get('%' + 'A' * 43 + '=.sha256') is None
+
+    assert feed2.get(5).key == messages2[4].key
+    assert feed2.get(6) is None
+    assert [msg.key for msg in feed1.history(start=8)] == [msg.key for msg in messages1[7:]]
+    assert [msg.sequence for msg in feed1.history(start=2, limit=3)] == [2, 3, 4]
+    assert store.tip(feed2.id) == (messages2[-1].key, 5)
+
+    # only whole feeds, in order
+    with pytest.raises(StoreException):
+        store.append(messages1[0])
+
+
+def test_reopen(log_path):
+    store = LogStore(log_path)
+    secret = SigningKey.generate()
+    messages = _publish(LocalFeed(secret, store=store), 20)
+    store.close()
+
+    store = LogStore(log_path)
+    feed = LocalFeed(secret, store=store)
+    assert (feed.tip, feed.sequence) == (messages[-1].key, 20)
+    assert store.get(messages[10].key).serialize() == messages[10].serialize()
+
+    # the remote view of the feed, from the same store
+    remote_feed = Feed(feed.public_key, store=store)
+    assert remote_feed.sequence == 20
+    assert remote_feed.get(20).key == messages[-1].key
+
+    feed.publish({'type': 'post', 'text': 'after'})
+    assert feed.get(21).content['text'] == 'after'
+    store.close()
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'corrupt', 'header', 'garbage'])
+def test_recovery(log_path, damage):
+    store = LogStore(log_path)
+    secret = SigningKey.generate()
+    messages = _publish(LocalFeed(secret, store=store), 5)
+    store.close()
+    size = os.path.getsize(log_path)
+    last_frame = FRAME_HEADER.size + len(messages[-1].serialize())
+
+    with open(log_path, 'r+b') as f:
+        if damage == 'truncate':
+            # a crash halfway through writing the last frame
+            f.truncate(size - 10)
+        elif damage == 'corrupt':
+            f.seek(size - 10)
+            f.write(b'X')
+        elif damage == 'header':
+            # the last frame claims another sequence number
+            f.seek(size - last_frame + 15)
+            f.write(b'\x07')
+        else:
+            f.seek(size)
+            f.write(b'\x00\x00\x01')
+
+    store = LogStore(log_path)
+    if damage == 'garbage':
+        assert os.path.getsize(log_path) == size
+        assert len(store) == 5
+    else:
+        assert os.path.getsize(log_path) == size - last_frame
+        assert len(store) == 4
+        assert messages[-1].key not in store
+
+    # the log can be appended to again
+    feed = LocalFeed(secret, store=store)
+    msg = feed.publish({'type': 'post', 'text': 'recovered'})
+    store.close()
+
+    store = LogStore(log_path)
+    assert store.get(msg.key).content['text'] == 'recovered'
+    store.close()
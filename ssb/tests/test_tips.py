@@ -0,0 +1,105 @@
+import os
+
+import pytest
+from nacl.signing import SigningKey
+
+from ssb.feed import LocalFeed
+from ssb.feed.store import LogStore
+from ssb.feed.tips import INDEX_HEADER, RECORD, TipIndex
+
+
+@pytest.fixture
+def paths(tmpdir):
+    return str(tmpdir.join('log.offset')), str(tmpdir.join('tips'))
+
+
+def _publish(feed, n):
+    return [feed.publish({'type': 'post', 'text': 'Message #{}'.format(i)}) for i in range(n)]
+
+
+def test_incremental(paths):
+    store = LogStore(paths[0])
+    index = TipIndex(paths[1], store=store)
+    # more feeds than the initial capacity
+    feeds = [LocalFeed(SigningKey.generate(), store=store) for n in range(100)]
+    for n, feed in enumerate(feeds):
+        _publish(feed, n % 5 + 1)
+
+    assert len(index) == 100
+    for n, feed in enumerate(feeds):
+        assert index.get(feed.id) == (feed.sequence, feed.tip, store.get(feed.tip).timestamp)
+        assert feed.id in index
+    assert index.get(LocalFeed(SigningKey.generate()).id) is None
+    assert index.clock() == {feed.id: feed.sequence for feed in feeds}
+    assert index.indexed_size == store.size
+
+    # older messages don't move the tip back
+    index.update([store.get_by_sequence(feeds[4].id, 1)])
+    assert index.sequence(feeds[4].id) == 5
+
+    index.close()
+    store.close()
+
+
+def test_reopen(paths):
+    store = LogStore(paths[0])
+    index = TipIndex(paths[1], store=store)
+    feed1 = LocalFeed(SigningKey.generate(), store=store)
+    feed2 = LocalFeed(SigningKey.generate(), store=store)
+    _publish(feed1, 3)
+    _publish(feed2, 2)
+    index.close()
+    # appended while the index was closed
+    _publish(feed2, 2)
+    feed3 = LocalFeed(SigningKey.generate(), store=store)
+    _publish(feed3, 1)
+    store.close()
+
+    store = LogStore(paths[0])
+    index = TipIndex(paths[1], store=store)
+    assert index.clock() == {feed1.id: 3, feed2.id: 4, feed3.id: 1}
+    assert os.path.getsize(paths[1]) == INDEX_HEADER.size + 64 * RECORD.size
+    index.close()
+    store.close()
+
+    # an index that is ahead of its log is rebuilt
+    with open(paths[0], 'r+b') as f:
+        f.truncate(0)
+    store = LogStore(paths[0])
+    index = TipIndex(paths[1], store=store)
+    assert len(index) == 0
+    index.close()
+
+    # and so is one that is broken
+    with open(paths[1], 'r+b') as f:
+        f.write(b'garbage!')
+    index = TipIndex(paths[1], store=store)
+    assert len(index) == 0
+    index.close()
+    store.close()
+
+
+def test_changes_diff(paths):
+    store = LogStore(paths[0])
+    index = TipIndex(paths[1], store=store)
+    feeds = [LocalFeed(SigningKey.generate(), store=store) for n in range(5)]
+    for feed in feeds:
+        _publish(feed, 2)
+
+    version, clock = index.changes()
+    assert clock == {feed.id: 2 for feed in feeds}
+
+    _publish(feeds[1], 1)
+    _publish(feeds[3], 2)
+    _publish(feeds[1], 1)
+    new_version, clock = index.changes(version)
+    assert clock == {feeds[1].id: 4, feeds[3].id: 4}
+    assert index.changes(new_version) == (new_version, {})
+
+    stranger = LocalFeed(SigningKey.generate()).id
+    need, have = index.diff({feeds[0].id: 2, feeds[1].id: 6, feeds[2].id: 1, stranger: 3})
+    assert need == {feeds[1].id: 4, stranger: 0}
+    assert have == {feeds[2].id: 1}
+
+    index.close()
+    store.close()
@@ -0,0 +1,195 @@
+import os
+from asyncio import TimeoutError, ensure_future, gather, sleep, wait_for
+from hashlib import sha256
+
+import pytest
+
+from ssb.blobs import BlobStore, WantManager, blob_id
+from ssb.muxrpc import MuxRPCAPI, MuxRPCAPIException
+from ssb.packet_stream import PSTimeoutException
+
+BLOBS = [os.urandom(10000 + n) for n in range(6)]
+BLOB_IDS = [blob_id(sha256(data).digest()) for data in BLOBS]
+
+
+class Peer(object):
+    def __init__(self, path, max_tasks=None, **kwargs):
+        self.blob_store = BlobStore(path)
+        self.api = MuxRPCAPI(blob_store=self.blob_store, max_tasks=max_tasks)
+        self.wants = WantManager(self.api, self.blob_store, **kwargs)
+        self.n_gets = 0
+
+        blobs_get = self.api.handlers['blobs.get']
+
+        async def _counting_get(connection, request):
+            self.n_gets += 1
+            await blobs_get(connection, request)
+        self.api.handlers['blobs.get'] = _counting_get
+
+    async def serve(self, connection):
+        await gather(self.api.serve(connection), self.wants.track(connection))
+
+
+@pytest.fixture
+def network(tmpdir, pipe_network):
+    def _peer(name, **kwargs):
+        return Peer(str(tmpdir.join(name)), **kwargs)
+
+    def _connect(a, b):
+        pipe_network.connect(a.serve, b.serve)
+
+    return _peer, _connect
+
+
+@pytest.mark.asyncio
+async def test_want_dedup(network):
+    peer, connect = network
+    leecher = peer('leecher')
+    seeders = [peer('seeder{}'.format(n)) for n in range(3)]
+    for seeder in seeders:
+        seeder.blob_store.add(BLOBS[0])
+        connect(leecher, seeder)
+    await sleep(0.01)
+
+    # asked for twice, announced by three peers, downloaded once
+    assert await wait_for(gather(leecher.wants.want(BLOB_IDS[0]), leecher.wants.want(BLOB_IDS[0])), 1) == \
+        [BLOB_IDS[0]] * 2
+    await sleep(0.01)
+    assert sum(seeder.n_gets for seeder in seeders) == 1
+    assert leecher.wants.n_downloads == 1
+    assert leecher.wants.wants == []
+    assert b''.join(leecher.blob_store.read(BLOB_IDS[0])) == BLOBS[0]
+
+    # already there
+    assert await leecher.wants.want(BLOB_IDS[0]) == BLOB_IDS[0]
+    assert leecher.wants.n_downloads == 1
+
+
+@pytest.mark.asyncio
+async def test_want_failover(network):
+    peer, connect = network
+    leecher = peer('leecher')
+    broken, seeder = peer('broken'), peer('seeder')
+    for other in (broken, seeder):
+        other.blob_store.add(BLOBS[0])
+
+    async def _failing_get(connection, request):
+        raise MuxRPCAPIException('Nope')
+    broken.api.handlers['blobs.get'] = _failing_get
+
+    # wanted before any peer is connected
+    want = ensure_future(leecher.wants.want(BLOB_IDS[0]))
+    connect(leecher, broken)
+    await sleep(0.01)
+    connect(leecher, seeder)
+
+    assert await wait_for(want, 1) == BLOB_IDS[0]
+    assert seeder.n_gets == 1
+    assert leecher.blob_store.has(BLOB_IDS[0])
+
+
+@pytest.mark.asyncio
+async def test_want_failover_timeout(network):
+    peer, connect = network
+    leecher = peer('leecher')
+    seeders = [peer('seeder{}'.format(n)) for n in range(2)]
+    fetch = leecher.blob_store.fetch
+    calls = []
+
+    async def _fetch(*args, **kwargs):
+        calls.append(kwargs['connection'])
+        if len(calls) == 1:
+            raise PSTimeoutException('Request 1 timed out after 10s')
+        return await fetch(*args, **kwargs)
+    leecher.blob_store.fetch = _fetch
+
+    want = ensure_future(leecher.wants.want(BLOB_IDS[0]))
+    for seeder in seeders:
+        seeder.blob_store.add(BLOBS[0])
+        connect(leecher, seeder)
+
+    assert await wait_for(want, 1) == BLOB_IDS[0]
+    assert len(set(calls)) == 2
+
+
+@pytest.mark.asyncio
+async def test_want_cancelled(network):
+    peer, connect = network
+    leecher, seeder = peer('leecher'), peer('seeder')
+    seeder.blob_store.add(BLOBS[0])
+
+    # one caller giving up doesn't affect the others
+    want = ensure_future(leecher.wants.want(BLOB_IDS[0]))
+    with pytest.raises(TimeoutError):
+        await wait_for(leecher.wants.want(BLOB_IDS[0]), 0.01)
+    connect(leecher, seeder)
+    assert await wait_for(want, 1) == BLOB_IDS[0]
+    assert leecher.wants.n_downloads == 1
+
+
+@pytest.mark.asyncio
+async def test_task_limit(network):
+    peer, connect = network
+    leecher, seeder = peer('leecher'), peer('seeder', max_tasks=1)
+    seeder.blob_store.add(BLOBS[0])
+    connect(leecher, seeder)
+
+    # the leecher's createWants call doesn't keep the seeder's only task slot for itself
+    assert await wait_for(leecher.wants.want(BLOB_IDS[0]), 1) == BLOB_IDS[0]
+
+
+@pytest.mark.asyncio
+async def test_max_downloads(network):
+    peer, connect = network
+    leecher = peer('leecher', max_downloads=2)
+    seeder = peer('seeder')
+    for data in BLOBS:
+        seeder.blob_store.add(data)
+    connect(leecher, seeder)
+
+    active, peak = 0, 0
+    fetch = leecher.blob_store.fetch
+
+    async def _fetch(*args, **kwargs):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        try:
+            await sleep(0.01)
+            return await fetch(*args, **kwargs)
+        finally:
+            active -= 1
+    leecher.blob_store.fetch = _fetch
+
+    assert await wait_for(gather(*[leecher.wants.want(id_) for id_ in BLOB_IDS]), 2) == BLOB_IDS
+    assert peak == 2
+    assert leecher.wants.n_downloads == len(BLOBS)
+
+
+@pytest.mark.asyncio
+async def test_invalid_wants(network, pipe_network, caplog):
+    peer, connect = network
+    seeder = peer('seeder')
+    seeder.blob_store.add(BLOBS[1])
+
+    # a peer that sends garbage along with a valid want, and calls createWants twice
+    rogue = MuxRPCAPI()
+
+    async def _create_wants(connection, request):
+        connection.send({'&foo.sha256': -1, BLOB_IDS[0]: 'lots', BLOB_IDS[1]: -1}, stream=True, req=-request.req)
+        await connection.wait_closed()
+    rogue.handlers['blobs.createWants'] = _create_wants
+
+    seeder_end, rogue_end = pipe_network.connect(seeder.serve, rogue.serve)
+    rogue.call('blobs.createWants', [], 'source', connection=rogue_end)
+    haves = rogue.call('blobs.createWants', [], 'source', connection=rogue_end)
+
+    # the valid want is answered, and the connection is still followed
+    msg = await wait_for(haves.__aiter__().__anext__(), 1)
+    assert msg.body == {BLOB_IDS[1]: len(BLOBS[1])}
+    assert not any(task.done() for task in pipe_network.tasks)
+
+    rogue_end.disconnect()
+    await gather(*pipe_network.tasks)
+    assert seeder.wants._peers == {}
+    assert not [record for record in caplog.records if record.levelname == 'ERROR']